@@ -0,0 +1,207 @@
+"""
+Benchmark de los exportadores y control de conformidad de ancho fijo.
+
+Genera N comprobantes sintéticos (mezcla realista: la mayoría con pocos
+ítems, algunos con cientos, alícuotas variadas, importes vacíos, acentos,
+textos largos y separadores dentro de los valores) y para cada exportador
+mide líneas/s y MB/s. Aparte, con tracemalloc, compara el pico de memoria
+de armar el archivo entero (build_txt_content_*) contra el streaming de
+export_lines.
+
+Cada línea distinta que sale de los exportadores se controla contra su
+layout (layouts.conformance_errors): largo exacto, offsets de cada campo y
+forma del valor. Los N comprobantes salen de un pool de POOL variantes que
+se repite, así que controlar el pool cubre todas las líneas. Uso:
+
+    python bench_exporters.py [N ...]     # sale con código 1 si alguna línea no cumple
+"""
+import argparse
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+
+import main
+from layouts import conformance_errors
+
+
+POOL = 10_000
+MEMORY_SAMPLE = 10_000
+
+_WORDS = [
+    "Distribuidora", "Norte", "Ñandú", "Comercial", "Córdoba", "Logística", "Panadería",
+    "San", "José", "Hnos.", "y", "Cía", "S.A.", "SRL", "Agropecuaria", "Servicios",
+    "Integrales", "Papelera", "del", "Sur", "Ferretería", "López;Pérez", "O'Higgins",
+]
+_TIPOS = ["Factura", "Nota de Crédito", "Nota de Débito", "Recibo", "Factura de Crédito Electrónica MiPyME"]
+_ALICUOTAS = [21.0, 10.5, 27.0, 5.0, 2.5, 0.0]
+
+
+def _text(rng, words: int) -> str:
+    sep = "\n" if rng.random() < 0.02 else " "  # textos en dos renglones
+    return sep.join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _cuit(rng) -> str:
+    digits = f"{rng.choice((20, 23, 27, 30, 33))}{rng.randrange(10**8):08d}{rng.randrange(10)}"
+    return digits if rng.random() < 0.3 else f"{digits[:2]}-{digits[2:10]}-{digits[10]}"
+
+
+def _amount(rng, top: float):
+    roll = rng.random()
+    if roll < 0.08:
+        return None
+    if roll < 0.1:
+        return ""
+    return round(rng.uniform(0, top), 2)
+
+
+def _date(rng) -> str:
+    d, m, y = rng.randint(1, 28), rng.randint(1, 12), rng.randint(2019, 2026)
+    return rng.choice((f"{d:02d}/{m:02d}/{y}", f"{y}-{m:02d}-{d:02d}", ""))
+
+
+def _items(rng) -> list:
+    roll = rng.random()
+    n = rng.randint(0, 3) if roll < 0.7 else rng.randint(5, 20) if roll < 0.95 else rng.randint(50, 200)
+    return [{
+        "codigo": f"A-{rng.randrange(10**6)}" if rng.random() < 0.7 else "",
+        "descripcion": _text(rng, rng.randint(1, 25)),
+        "unidad_medida": rng.choice(("u", "kg", "lt", "")),
+        "cantidad": _amount(rng, 1000),
+        "precio_unitario": _amount(rng, 1e6),
+        "bonificacion": rng.choice((None, 0.0, 5.0)),
+        "alicuota_iva": rng.choice(_ALICUOTAS),
+        "importe_total_renglon": _amount(rng, 1e7),
+    } for _ in range(n)]
+
+
+def synthetic_invoice(rng) -> dict:
+    """Un comprobante con la forma del JSON del modelo (ver check_layouts.SAMPLE)."""
+    ivas = [{"alicuota": a, "importe_iva": _amount(rng, 1e6)}
+            for a in rng.sample(_ALICUOTAS[:5], rng.choice((0, 1, 1, 1, 2, 3)))]
+    neto = _amount(rng, 1e8)
+    return {
+        "datos_comprobante": {
+            "tipo": rng.choice(_TIPOS), "letra": rng.choice("ABCEM"),
+            "punto_venta": str(rng.randrange(1, 99999)).zfill(rng.choice((4, 5))),
+            "numero_comprobante": str(rng.randrange(1, 10**8)).zfill(8),
+            "fecha_emision": _date(rng), "fecha_vencimiento": _date(rng),
+            "condicion_venta": rng.choice(("", "Contado", "Cuenta corriente")),
+            "moneda": rng.choice(("PES", "DOL", None)), "cotizacion_moneda": rng.choice((None, 1.0, 985.5)),
+        },
+        "emisor": {
+            "razon_social": _text(rng, rng.randint(1, 12)), "cuit": _cuit(rng),
+            "domicilio_comercial": _text(rng, rng.randint(0, 8)),
+            "condicion_iva": rng.choice(("Responsable Inscripto", "Monotributo", "Exento", "")),
+            "condicion_ingresos_brutos": rng.choice(("", "901-123456-7", "Convenio Multilateral")),
+            "localidad": rng.choice(("Córdoba", "Rosario", "San Miguel de Tucumán", "")),
+            "provincia": rng.choice(("Córdoba", "Santa Fe", "Buenos Aires", "Tierra del Fuego", "")),
+            "pais": "Argentina",
+        },
+        "receptor": {
+            "razon_social": _text(rng, rng.randint(1, 6)), "cuit": _cuit(rng), "domicilio_comercial": "",
+            "condicion_iva": "", "condicion_ingresos_brutos": "", "tipo_documento": "", "numero_documento": "",
+        },
+        "totales": {
+            "importe_neto_gravado": neto, "importe_neto_no_gravado": _amount(rng, 1e5),
+            "importe_exento": _amount(rng, 1e5), "ivAs": ivas,
+            "percepciones_iva": _amount(rng, 1e4), "percepciones_ingresos_brutos": _amount(rng, 1e4),
+            "percepciones_otras": _amount(rng, 1e4), "descuentos_generales": None, "subtotal": None,
+            "total_comprobante": _amount(rng, 1.3e8),
+        },
+        "items": _items(rng),
+        "datos_fiscales_afip": {
+            "cae": str(rng.randrange(10**13, 10**14)) if rng.random() < 0.9 else "",
+            "fecha_vencimiento_cae": _date(rng), "codigo_barras_qr": "",
+            "tipo_documento_receptor": "", "numero_documento_receptor": "",
+        },
+        "datos_compras_importaciones": {},
+    }
+
+
+def invoice_pool(size: int = POOL, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    return [synthetic_invoice(rng) for _ in range(size)]
+
+
+# (nombre, layout, líneas de un comprobante, archivo de export_lines, build_txt_content_*)
+EXPORTERS = [
+    ("generico", main.GENERIC_LAYOUT, lambda d: (main.build_txt_line(d),), "generico", main.build_txt_content),
+    ("holistor", main.HOLISTOR_LAYOUT, lambda d: (main.build_txt_line_holistor(d),), "holistor",
+     main.build_txt_content_holistor),
+    ("bejerman_ccabecer", main.CCABECER_LAYOUT, lambda d: (main.build_bejerman_ccabecer_line(d),), "ccabecer",
+     main.build_txt_content_bejerman),
+    ("bejerman_citems", main.CITEMS_LAYOUT, main.bejerman_citems_lines, "citems", main.build_txt_citems_bejerman),
+    ("bejerman_cregesp", main.CREGESP_LAYOUT, main.bejerman_cregesp_lines, "cregesp",
+     main.build_txt_cregesp_bejerman),
+]
+
+
+def conformance(pool: list) -> list:
+    errors = []
+    for name, layout, lines, _, _ in EXPORTERS:
+        for n, data in enumerate(pool):
+            for line in lines(data):
+                for e in conformance_errors(layout, line):
+                    errors.append(f"{name} (comprobante {n}): {e}")
+    return errors
+
+
+def throughput(pool: list, n: int):
+    print(f"\n{n:,} comprobantes")
+    print(f"{'exportador':<20} {'líneas':>10} {'seg':>8} {'líneas/s':>12} {'MB/s':>8}")
+    for name, _, lines, _, _ in EXPORTERS:
+        count = chars = 0
+        started = time.perf_counter()
+        for data in itertools.islice(itertools.cycle(pool), n):
+            for line in lines(data):
+                count += 1
+                chars += len(line)
+        secs = time.perf_counter() - started
+        print(f"{name:<20} {count:>10,} {secs:>8.2f} {count / secs:>12,.0f} {chars / secs / 1e6:>8.1f}")
+
+
+def _peak(fn) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    fn()
+    _, p = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return p
+
+
+def memory(pool: list):
+    results = [{"data": d} for d in pool[:MEMORY_SAMPLE]]
+    print(f"\nPico de memoria con {len(results):,} comprobantes (archivo entero vs export_lines)")
+    print(f"{'exportador':<20} {'entero':>10} {'streaming':>10}")
+    for name, _, _, archivo, build_content in EXPORTERS:
+        whole = _peak(lambda: build_content(results))
+        streamed = _peak(lambda: sum(len(chunk) for chunk in main._joined(main.export_lines(archivo, results))))
+        print(f"{name:<20} {whole / 1e6:>8.1f}MB {streamed / 1e6:>8.2f}MB")
+
+
+def run(sizes) -> int:
+    started = time.perf_counter()
+    pool = invoice_pool()
+    items = sum(len(d["items"]) for d in pool)
+    print(f"Pool: {len(pool):,} comprobantes, {items:,} ítems ({time.perf_counter() - started:.1f} s)")
+
+    errors = conformance(pool)
+    for e in errors[:20]:
+        print(e)
+    print("Conformidad: OK" if not errors else f"Conformidad: {len(errors)} línea(s)/campo(s) no cumplen")
+
+    for n in sizes:
+        throughput(pool, n)
+    memory(pool)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de exportadores y conformidad de ancho fijo")
+    parser.add_argument("sizes", nargs="*", type=int, default=[10_000, 100_000],
+                        help="cantidades de comprobantes a exportar (por defecto 10000 100000)")
+    args = parser.parse_args()
+    sys.exit(run(args.sizes))
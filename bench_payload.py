@@ -0,0 +1,90 @@
+"""
+Benchmark de memoria: pico de bytes por imagen en vuelo al armar el request.
+
+Compara el camino anterior (base64 -> str -> f-string -> JSON del SDK -> bytes)
+contra payload.write_chat_body (base64 copiado una sola vez a un buffer
+reutilizable). Uso:
+
+    python bench_payload.py [MB de imagen ...]
+"""
+import base64
+import json
+import os
+import sys
+import tracemalloc
+
+from cpu_pool import b64_ref, release_ref
+from invoice_schema import RESPONSE_FORMAT, SYSTEM_PROMPT, USER_PROMPT
+from payload import acquire_buffer, release_buffer, write_chat_body
+
+
+def legacy_body(image_bytes: bytes) -> bytes:
+    """Lo que hacía extract_invoice_data + la serialización del SDK."""
+    b64_image = base64.b64encode(image_bytes).decode("utf-8")
+    image_url = f"data:image/jpeg;base64,{b64_image}"
+    body = {
+        "model": "gpt-4.1-mini",
+        "response_format": RESPONSE_FORMAT,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": USER_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ],
+            },
+        ],
+    }
+    return json.dumps(body).encode("utf-8")
+
+
+def buffered_body(ref) -> int:
+    """Camino nuevo: el ref ya viene en base64 desde el pool de CPU."""
+    buf = acquire_buffer()
+    try:
+        write_chat_body(buf, "gpt-4.1-mini", RESPONSE_FORMAT, SYSTEM_PROMPT,
+                        [("text", USER_PROMPT), ("image", ref)])
+        chunks = buf.chunks()
+        return sum(len(c) for c in chunks)
+    finally:
+        release_buffer(buf)
+
+
+def peak(fn, *args) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    fn(*args)
+    _, p = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return p
+
+
+def main(sizes_mb):
+    # "nuevo" = body retenido en el buffer reutilizable mientras el request
+    # está en vuelo + lo que se asigna de más al armarlo
+    print(f"{'imagen':>10} {'anterior':>12} {'nuevo(mem)':>12} {'nuevo(spool)':>13}")
+    for mb in sizes_mb:
+        image = os.urandom(int(mb * 1024 * 1024))
+
+        legacy = peak(legacy_body, image)
+
+        # base64 en memoria (imágenes chicas que vuelven por el pipe del pool):
+        # se cuenta fuera del pico porque lo produce el proceso del pool
+        b64 = base64.b64encode(image)
+        buffered_body(b64)  # calienta el buffer reutilizable
+        body_len = buffered_body(b64)
+        mem = peak(buffered_body, b64) + body_len
+        del b64
+
+        # base64 en archivo del spool (imágenes grandes)
+        ref = b64_ref(image)
+        buffered_body(ref)
+        spool = peak(buffered_body, ref) + body_len
+        release_ref(ref)
+
+        print(f"{mb:>8.1f}MB {legacy / 1e6:>10.2f}MB {mem / 1e6:>10.2f}MB {spool / 1e6:>11.2f}MB")
+
+
+if __name__ == "__main__":
+    main([float(x) for x in sys.argv[1:]] or [0.5, 2.0, 8.0])
@@ -0,0 +1,122 @@
+"""
+Control de los layouts de exportación contra salidas "golden".
+
+Para un comprobante fijo se compara cada línea generada con la esperada y,
+en los layouts de ancho fijo, además se controla campo por campo que cada
+valor caiga en su offset (así un ancho mal declarado se ve en el campo
+exacto, no como "la línea no coincide") y que la línea cumpla su layout
+(largo, constantes, forma de cada valor). Uso:
+
+    python check_layouts.py        # sale con código 1 si algo no coincide
+"""
+import sys
+
+import main
+from layouts import conformance_errors, split_line
+
+
+SAMPLE = {
+    "datos_comprobante": {
+        "tipo": "Factura", "letra": "A", "punto_venta": "0003", "numero_comprobante": "00001234",
+        "fecha_emision": "15/03/2025", "fecha_vencimiento": "14/04/2025", "condicion_venta": "",
+        "moneda": "PES", "cotizacion_moneda": None,
+    },
+    "emisor": {
+        "razon_social": "Distribuidora Norte S.A.", "cuit": "30-71234567-8",
+        "domicilio_comercial": "Av. Colón 1234", "condicion_iva": "Responsable Inscripto",
+        "condicion_ingresos_brutos": "901-123456-7", "localidad": "Córdoba", "provincia": "Córdoba",
+        "pais": "Argentina",
+    },
+    "receptor": {
+        "razon_social": "Estudio Contable SRL", "cuit": "30-70000000-1", "domicilio_comercial": "",
+        "condicion_iva": "", "condicion_ingresos_brutos": "", "tipo_documento": "", "numero_documento": "",
+    },
+    "totales": {
+        "importe_neto_gravado": 1000.0, "importe_neto_no_gravado": None, "importe_exento": None,
+        "ivAs": [{"alicuota": 21.0, "importe_iva": 210.0}],
+        "percepciones_iva": 30.0, "percepciones_ingresos_brutos": None, "percepciones_otras": None,
+        "descuentos_generales": None, "subtotal": None, "total_comprobante": 1240.0,
+    },
+    "items": [{
+        "codigo": "A-1", "descripcion": "Resmas A4", "unidad_medida": "u", "cantidad": 10.0,
+        "precio_unitario": 121.0, "bonificacion": None, "alicuota_iva": 21.0,
+        "importe_total_renglon": 1210.0,
+    }],
+    "datos_fiscales_afip": {
+        "cae": "75123456789012", "fecha_vencimiento_cae": "25/03/2025", "codigo_barras_qr": "",
+        "tipo_documento_receptor": "", "numero_documento_receptor": "",
+    },
+    "datos_compras_importaciones": {},
+}
+
+# (nombre, layout, función que genera la línea, línea esperada, campos a controlar por offset)
+GOLDEN = [
+    (
+        "generico", main.GENERIC_LAYOUT, main.build_txt_line,
+        "15/03/2025;Factura;A;0003;00001234;30-71234567-8;Distribuidora Norte S.A.;"
+        "30-70000000-1;Estudio Contable SRL;1000.0;210.0;1240.0",
+        {"numero": "00001234", "iva_21": "210.0", "total": "1240.0"},
+    ),
+    (
+        "holistor", main.HOLISTOR_LAYOUT, main.build_txt_line_holistor,
+        "Factura;A;0003;00001234;15/03/2025;15/03/2025;1;1000.00;;0.00;;0.00;1;30.00;21.00;"
+        "210.00;210.00;1240.00;Responsable Inscripto;30-71234567-8;Distribuidora Norte S.A.;"
+        "Av. Colón 1234;;Córdoba;80;PES;;75123456789012",
+        {"neto_gravado": "1000.00", "percepciones": "30.00", "tipo_doc_cliente": "80", "cai": "75123456789012"},
+    ),
+    (
+        "bejerman_ccabecer", main.CCABECER_LAYOUT, main.build_bejerman_ccabecer_line,
+        "FC A0003000012340000000020250315@@@#@@Distribuidora Norte S.A.                01000130712345678"
+        "901-123456-7           001    202504140000000001240.00    Av. Colón 1234                    "
+        "    Córdoba                  N                              000000000000000000000000000000"
+        "00        000000000000                          ",
+        {
+            "punto_venta": "0003", "numero": "00001234", "fecha": "20250315",
+            "codigo_proveedor": "@@@#@@", "cuit": "30712345678", "condicion_pago": "001",
+            "fecha_vencimiento": "20250414", "importe_total": "0000000001240.00",
+            "actualiza_stock": "N", "fecha_despacho_plaza": "00000000",
+        },
+    ),
+    (
+        "bejerman_citems", main.CITEMS_LAYOUT, lambda d: next(main.bejerman_citems_lines(d)),
+        "FC A0003000012340000000020250315@@@#@@CA-1                    0000000000010.000000000000000.00"
+        "Resmas A4                                         0000000000121.0000021.0000000.000000000000210.00"
+        "0000000000000.000000000001000.000000000000000.000000000000000.0000000000000000000.001000000000000"
+        "0.00000                          00000.000000000001210.0010",
+        {
+            "tipo_item": "C", "cantidad": "0000000000010.00", "tasa_iva_inscripto": "00021.00",
+            "importe_iva_inscripto": "0000000000210.00", "importe_total_neto": "0000000001000.00",
+            "tipo_iva": "1", "deposito": "000", "importe_renglon": "0000000001210.00",
+            "imputacion_cf": "1", "rubro_cf": "0",
+        },
+    ),
+    (
+        "bejerman_cregesp", main.CREGESP_LAYOUT, lambda d: next(main.bejerman_cregesp_lines(d)),
+        "FC A0003000012340000000020250315@@@#@@000100010000000000030.00",
+        {"codigo_regimen": "0001", "codigo_articulo": "0001", "importe": "0000000000030.00"},
+    ),
+]
+
+
+def check() -> list:
+    errors = []
+    for name, layout, build, expected, fields in GOLDEN:
+        line = build(SAMPLE)
+        errors.extend(f"{name}: {e}" for e in conformance_errors(layout, line))
+        got = split_line(layout, line)
+        for field_name, value in fields.items():
+            if got.get(field_name) != value:
+                errors.append(f"{name}.{field_name}: {got.get(field_name)!r} != {value!r}")
+        if line != expected:
+            want = split_line(layout, expected)
+            diff = [k for k in want if want[k] != got.get(k)]
+            errors.append(f"{name}: la línea no coincide con la golden (campos: {', '.join(diff)})")
+    return errors
+
+
+if __name__ == "__main__":
+    errors = check()
+    for e in errors:
+        print(e)
+    print("OK" if not errors else f"{len(errors)} diferencia(s)")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,302 @@
+"""
+Etapa de CPU: rasterizado de PDFs, re-codificación de imágenes y base64 en un
+pool de procesos, para que el event loop sólo haga I/O.
+
+PyMuPDF (get_pixmap / tobytes) y base64 corren en el hilo del event loop y,
+con carga concurrente, se serializan detrás del GIL bloqueando todo lo demás.
+Acá se mandan a procesos aparte:
+
+  - CPU_WORKERS        cantidad de procesos (por defecto, núcleos de la máquina)
+  - CPU_QUEUE_DEPTH    tope de trabajos en vuelo/encolados (el resto espera)
+  - CPU_HANDOFF_BYTES  a partir de este tamaño los buffers viajan por archivo
+                       temporal (CPU_SPOOL_DIR) en vez de por el pipe del pool
+
+Las imágenes subidas se normalizan acá (prepare_image_job): JPEG, PNG, WebP y
+GIF van tal cual (el modelo los acepta); BMP, TIFF y HEIC, y cualquier imagen
+con el lado largo mayor a IMAGE_MAX_LONG_EDGE o un PNG de más de
+IMAGE_REENCODE_BYTES, se pasan a JPEG (IMAGE_JPEG_QUALITY). Los TIFF de
+escáner (varias hojas) se convierten a PDF (image_to_pdf_job) y siguen el
+camino de los PDF. HEIC, y WebP a re-codificar, necesitan Pillow /
+pillow-heif (opcionales; MuPDF no los lee). Un HEIC en un worker sin
+pillow-heif no es un error a reintentar: prepare_image_job devuelve la
+imagen con "error" y esa fila sale con el error (las demás del paquete siguen).
+
+Las funciones *_job son de nivel módulo (picklables) y NO importan main.
+PyMuPDF se importa recién dentro de los trabajos: el proceso web no lo carga.
+"""
+import asyncio
+import base64
+import binascii
+import os
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from lanes import PriorityGate
+
+
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "0")) or (os.cpu_count() or 2)
+CPU_QUEUE_DEPTH = int(os.getenv("CPU_QUEUE_DEPTH", "0")) or CPU_WORKERS * 2
+CPU_HANDOFF_BYTES = int(os.getenv("CPU_HANDOFF_BYTES", str(256 * 1024)))
+CPU_SPOOL_DIR = os.getenv("CPU_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "facturas_cpu")
+
+IMAGE_MAX_LONG_EDGE = int(os.getenv("IMAGE_MAX_LONG_EDGE", "2048"))
+IMAGE_REENCODE_BYTES = int(os.getenv("IMAGE_REENCODE_BYTES", str(1024 * 1024)))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+# Formatos que el modelo acepta tal cual
+NATIVE_IMAGE_TYPES = ("image/jpeg", "image/png", "image/webp", "image/gif")
+
+_pool = None
+_slots = None
+
+
+class UnreadableImage(ValueError):
+    """Imagen que este proceso no puede leer (p. ej. HEIC sin pillow-heif)."""
+
+
+# ---------- Handoff de buffers ----------
+# Un "ref" es el buffer en sí (bytes chicos) o la ruta (str) de un archivo del spool.
+
+def spool_bytes(data: bytes) -> str:
+    os.makedirs(CPU_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(CPU_SPOOL_DIR, uuid.uuid4().hex)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def to_ref(data: bytes):
+    """Buffer para mandar a (o devolver desde) un proceso del pool."""
+    if len(data) >= CPU_HANDOFF_BYTES:
+        return spool_bytes(data)
+    return data
+
+
+def b64_ref(raw: bytes):
+    """
+    base64 de `raw` como ref. Si es grande se codifica por bloques directo al
+    archivo del spool, sin armar el base64 completo en memoria.
+    """
+    if len(raw) * 4 // 3 < CPU_HANDOFF_BYTES:
+        return base64.b64encode(raw)
+
+    os.makedirs(CPU_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(CPU_SPOOL_DIR, uuid.uuid4().hex)
+    view = memoryview(raw)
+    step = 3 * 16 * 1024  # múltiplo de 3: sin padding intermedio
+    with open(path, "wb") as f:
+        for i in range(0, len(view), step):
+            f.write(binascii.b2a_base64(view[i:i + step], newline=False))
+    return path
+
+
+def load_ref(ref) -> bytes:
+    if isinstance(ref, str):
+        with open(ref, "rb") as f:
+            return f.read()
+    return ref
+
+
+def take_ref(ref) -> bytes:
+    """Lee el buffer y, si venía por archivo, lo borra."""
+    data = load_ref(ref)
+    release_ref(ref)
+    return data
+
+
+def release_ref(ref):
+    if isinstance(ref, str):
+        try:
+            os.remove(ref)
+        except OSError:
+            pass
+
+
+# ---------- Trabajos (corren en el pool) ----------
+
+def _open_pdf(pdf_ref):
+    import fitz  # PyMuPDF
+
+    if isinstance(pdf_ref, str):
+        return fitz.open(pdf_ref)
+    return fitz.open(stream=pdf_ref, filetype="pdf")
+
+
+def classify_pdf_job(pdf_ref) -> dict:
+    """classify_pdf + lado largo (pt) de la primera hoja de cada comprobante."""
+    from pdf_pages import classify_pdf
+
+    doc = _open_pdf(pdf_ref)
+    if doc.page_count == 0:
+        return {"page_count": 0, "invoices": [], "skipped": []}
+    plan = classify_pdf(doc)
+    for inv in plan["invoices"]:
+        r = doc.load_page(inv["pages"][0]).rect
+        inv["long_edge_pt"] = max(r.width, r.height)
+    plan["page_count"] = doc.page_count
+    return plan
+
+
+def render_pdf_job(pdf_ref, pages, dpi, tiling, dpi_factors, max_dpi, max_pages) -> dict:
+    """Renderiza las hojas de un comprobante y devuelve las imágenes ya en base64."""
+    from pdf_pages import render_pages
+
+    doc = _open_pdf(pdf_ref)
+    if doc.page_count == 0:
+        return {"images_b64": [], "tiled": False, "payload_bytes": 0}
+    images, tiled = render_pages(doc, pages, dpi, tiling, dpi_factors, max_dpi, max_pages)
+    return {
+        "images_b64": [b64_ref(img) for img in images],
+        "tiled": tiled,
+        "payload_bytes": sum(len(img) for img in images),
+    }
+
+
+def page_layout_job(pdf_ref, page: int):
+    """Spans de texto de una hoja (supplier_templates.page_layout); None si es un escaneo."""
+    from supplier_templates import page_layout
+
+    doc = _open_pdf(pdf_ref)
+    layout = page_layout(doc.load_page(page))
+    return layout if layout["spans"] else None
+
+
+def heic_available() -> bool:
+    """¿Se pueden leer HEIC? (pillow-heif instalado; sin importarlo)."""
+    import importlib.util
+
+    return importlib.util.find_spec("pillow_heif") is not None and importlib.util.find_spec("PIL") is not None
+
+
+def _pillow_png(image_bytes: bytes):
+    """PNG del primer cuadro vía Pillow (WebP, HEIC); None si no está instalado."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        import pillow_heif
+
+        pillow_heif.register_heif_opener()
+    except ImportError:
+        pass
+    import io
+
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(image_bytes)) as im:
+        im.save(out, "PNG")
+    return out.getvalue()
+
+
+def _decode_image(image_bytes: bytes, content_type: str):
+    """Pixmap del primer cuadro (None si no hay con qué leerlo)."""
+    import fitz  # PyMuPDF
+
+    if content_type in ("image/webp", "image/heic"):
+        image_bytes = _pillow_png(image_bytes)
+        if image_bytes is None:
+            return None
+    pix = fitz.Pixmap(image_bytes)
+    if pix.alpha:
+        # Transparencia sobre blanco (sacar el canal alfa sin más deja fondo negro)
+        doc = fitz.open()
+        page = doc.new_page(width=pix.width, height=pix.height)
+        page.insert_image(page.rect, pixmap=pix)
+        pix = page.get_pixmap(alpha=False)
+    elif pix.colorspace is None or pix.colorspace.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)  # CMYK de algunos TIFF
+    return pix
+
+
+def _to_jpeg(pix):
+    """(JPEG, ancho, alto), achicada a IMAGE_MAX_LONG_EDGE si hace falta."""
+    import fitz  # PyMuPDF
+
+    long_edge = max(pix.width, pix.height)
+    if long_edge > IMAGE_MAX_LONG_EDGE:
+        scale = IMAGE_MAX_LONG_EDGE / long_edge
+        pix = fitz.Pixmap(pix, round(pix.width * scale), round(pix.height * scale), None)
+    return pix.tobytes("jpg", jpg_quality=IMAGE_JPEG_QUALITY), pix.width, pix.height
+
+
+def normalize_image(image_bytes: bytes):
+    """
+    (bytes para el modelo, ancho, alto). Ver docstring del módulo: qué pasa
+    tal cual y qué se re-codifica a JPEG. Si no se puede leer, va tal cual
+    (ancho y alto 0) y el modelo dirá si la entiende.
+    """
+    from ingest import sniff_content_type
+
+    content_type = sniff_content_type(image_bytes[:16])
+    try:
+        pix = _decode_image(image_bytes, content_type)
+    except Exception:
+        pix = None
+    if pix is None:
+        if content_type == "image/heic":
+            raise UnreadableImage("HEIC: falta pillow-heif en el servidor")
+        return image_bytes, 0, 0
+
+    if (
+        content_type not in NATIVE_IMAGE_TYPES
+        or max(pix.width, pix.height) > IMAGE_MAX_LONG_EDGE
+        or (content_type == "image/png" and len(image_bytes) > IMAGE_REENCODE_BYTES)
+    ):
+        return _to_jpeg(pix)
+    return image_bytes, pix.width, pix.height
+
+
+def prepare_image_job(image_ref) -> dict:
+    """
+    Imagen normalizada (normalize_image) en base64 + tamaño en píxeles (para
+    estimar tokens). Si no se puede leer: {"b64": None, ..., "error": motivo}.
+    """
+    try:
+        image_bytes, width, height = normalize_image(load_ref(image_ref))
+    except UnreadableImage as e:
+        return {"b64": None, "width": 0, "height": 0, "error": str(e)}
+    return {
+        "b64": b64_ref(image_bytes),
+        "width": width,
+        "height": height,
+    }
+
+
+def image_to_pdf_job(image_ref):
+    """TIFF (uno o varios cuadros) -> PDF con una hoja por cuadro, como ref."""
+    import fitz  # PyMuPDF
+
+    doc = fitz.open(stream=load_ref(image_ref), filetype="tiff")
+    if doc.page_count == 0:
+        raise ValueError("TIFF sin imágenes")
+    return to_ref(doc.convert_to_pdf())
+
+
+# ---------- Lado async ----------
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=CPU_WORKERS)
+    return _pool
+
+
+async def run_cpu(fn, *args):
+    """
+    Corre `fn(*args)` en el pool, respetando CPU_QUEUE_DEPTH trabajos en
+    vuelo; con espera, el turno se reparte por carril (lanes.PriorityGate).
+    """
+    global _slots
+    if _slots is None:
+        _slots = PriorityGate(CPU_QUEUE_DEPTH)
+    async with _slots.slot():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_pool(), fn, *args)
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,513 @@
+"""
+Evaluación de exactitud vs. costo de la extracción sobre un corpus etiquetado.
+
+Corre los documentos del corpus por el camino de siempre (main.process_task:
+clasificación de páginas, render, recortes, plantillas, cascada de modelos)
+con distintas configuraciones y, para cada una, informa exactitud por campo
+y por sección del esquema, latencia, tokens y costo, marcando el frente de
+Pareto (las configuraciones que ninguna otra supera a la vez en exactitud,
+costo y latencia).
+
+    corpus/
+      factura1.pdf                        el documento (PDF o imagen)
+      factura1.json                       lo que debería salir: un comprobante con la
+                                          forma de INVOICE_SCHEMA, o una lista si el PDF
+                                          trae varios. Se controlan sólo los campos que
+                                          están en la etiqueta
+      grabaciones/<configuración>/factura1.json   respuestas del modelo grabadas
+
+    python eval_extraction.py corpus/                 # reproduce lo grabado (sin API)
+    python eval_extraction.py corpus/ --grabar        # llama al modelo donde falte grabación (cuesta)
+    python eval_extraction.py corpus/ --config "modelo=gpt-4.1-nano;dpi=150" --config "dpi=adaptivo"
+    python eval_extraction.py corpus/ --json reporte.json
+
+Las respuestas se graban por configuración (otro DPI, otras imágenes, otra
+respuesta) y se reproducen en el mismo orden de llamadas. Un documento sin
+grabación (o cuya grabación quedó desfasada porque cambió el flujo: volver a
+grabar borrando su archivo) corre con un suplente que responde la etiqueta:
+pasa por todo el camino local y suma al tiempo local, pero no cuenta para
+exactitud, latencia, tokens ni costo (columna "grab").
+
+Configuraciones ("clave=valor;..."; lo que no se indica queda como en el entorno):
+  modelo    cascada de modelos separados por coma (MODEL_CASCADE)
+  dpi       DPI fijo del render de PDF, o "adaptivo" (PDF_DPI_LADDER)
+  recortes  ROI_TILING: off / auto / on
+  texto     1 = plantillas por proveedor sobre la capa de texto del PDF, 0 = sólo visión
+
+  EVAL_PRICES   USD por millón de tokens "modelo=entrada/salida,..."
+
+La base (plantillas aprendidas) es una temporal, salvo que se indique
+FACTURAS_DATA_DIR; las plantillas se vacían al empezar cada configuración.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import time
+import unicodedata
+
+if not os.getenv("FACTURAS_DATA_DIR"):
+    os.environ["FACTURAS_DATA_DIR"] = tempfile.mkdtemp(prefix="eval_facturas_")
+    _TEMP_DATA_DIR = os.environ["FACTURAS_DATA_DIR"]
+else:
+    _TEMP_DATA_DIR = None
+
+import main
+import store
+from ingest import sniff_content_type
+from invoice_schema import INVOICE_SCHEMA, NUM, coerce_number
+from layouts import fmt_date8
+
+
+EVAL_PRICES = os.getenv(
+    "EVAL_PRICES",
+    "gpt-4.1=2/8,gpt-4.1-mini=0.4/1.6,gpt-4.1-nano=0.1/0.4,gpt-4o=2.5/10,gpt-4o-mini=0.15/0.6",
+)
+AMOUNT_TOLERANCE = 0.01
+
+RECORDINGS_DIR = "grabaciones"
+
+DEFAULT_CONFIGS = [
+    "modelo=gpt-4.1-mini;dpi=200;texto=0",  # referencia
+    "modelo=gpt-4.1-mini;dpi=150;texto=0",
+    "modelo=gpt-4.1-mini;dpi=300;texto=0",
+    "modelo=gpt-4.1-nano;dpi=200;texto=0",
+    "modelo=gpt-4.1-nano,gpt-4.1-mini;dpi=adaptivo;texto=0",
+    "modelo=gpt-4.1-nano,gpt-4.1-mini;dpi=adaptivo;texto=1",  # lo de producción por defecto
+]
+
+# Encabezados cortos de las secciones del esquema
+_SECTION_NAMES = {
+    "datos_comprobante": "comprob", "emisor": "emisor", "receptor": "receptor", "totales": "totales",
+    "items": "items", "datos_fiscales_afip": "afip", "datos_compras_importaciones": "compras",
+}
+
+_DEFAULT_LADDER = list(main.PDF_DPI_LADDER)
+_live_post_chat = main.post_chat
+
+
+def parse_prices(spec: str) -> dict:
+    """"modelo=entrada/salida,..." -> {modelo: (USD por millón de entrada, de salida)}."""
+    prices = {}
+    for part in spec.split(","):
+        model, _, pair = part.strip().partition("=")
+        prompt, _, completion = pair.partition("/")
+        if model and prompt and completion:
+            prices[model] = (float(prompt), float(completion))
+    return prices
+
+
+PRICES = parse_prices(EVAL_PRICES)
+
+
+# ---------- Configuraciones ----------
+
+def parse_config(spec: str) -> dict:
+    cfg = {
+        "modelo": list(main.MODEL_CASCADE),
+        "dpi": None,
+        "recortes": main.ROI_TILING,
+        "texto": main.TEMPLATES_ENABLED,
+    }
+    for part in spec.split(";"):
+        key, _, value = (x.strip() for x in part.partition("="))
+        if not key:
+            continue
+        if key == "modelo":
+            cfg["modelo"] = [m.strip() for m in value.split(",") if m.strip()]
+        elif key == "dpi":
+            cfg["dpi"] = None if value in ("", "adaptivo") else int(value)
+        elif key == "recortes":
+            if value not in ("off", "auto", "on"):
+                raise ValueError(f"recortes: off / auto / on, no {value!r}")
+            cfg["recortes"] = value
+        elif key == "texto":
+            cfg["texto"] = value == "1"
+        else:
+            raise ValueError(f"Clave desconocida en la configuración: {key!r}")
+    if not cfg["modelo"]:
+        raise ValueError(f"Configuración sin modelo: {spec!r}")
+    return cfg
+
+
+def config_name(cfg: dict) -> str:
+    dpi = f"{cfg['dpi']}dpi" if cfg["dpi"] else "adaptivo"
+    return f"{','.join(cfg['modelo'])} {dpi} recortes={cfg['recortes']} {'texto' if cfg['texto'] else 'vision'}"
+
+
+def _slug(name: str) -> str:
+    return re.sub(r"[^\w.,=-]+", "_", name)
+
+
+def apply_config(cfg: dict):
+    """Fija la configuración en main (las funciones de extracción leen estos globales)."""
+    main.MODEL_CASCADE = cfg["modelo"]
+    main.PDF_DPI_LADDER = [cfg["dpi"]] if cfg["dpi"] else _DEFAULT_LADDER
+    main.ROI_TILING = cfg["recortes"]
+    main.TEMPLATES_ENABLED = cfg["texto"]
+    conn = store.connect()
+    try:
+        conn.execute("DELETE FROM supplier_templates")
+    finally:
+        conn.close()
+
+
+# ---------- Corpus ----------
+
+def load_corpus(corpus_dir: str) -> list:
+    """Documentos con etiqueta: [{"name", "path", "content_type", "labels": [comprobante, ...]}]."""
+    docs = []
+    for name in sorted(os.listdir(corpus_dir)):
+        path = os.path.join(corpus_dir, name)
+        stem, ext = os.path.splitext(name)
+        if ext.lower() == ".json" or not os.path.isfile(path):
+            continue
+        label_path = os.path.join(corpus_dir, stem + ".json")
+        if not os.path.isfile(label_path):
+            print(f"{name}: sin etiqueta ({stem}.json), se saltea")
+            continue
+        with open(label_path, encoding="utf-8") as fh:
+            labels = json.load(fh)
+        with open(path, "rb") as fh:
+            content_type = sniff_content_type(fh.read(64))
+        docs.append({
+            "name": name,
+            "path": path,
+            "content_type": content_type,
+            "labels": labels if isinstance(labels, list) else [labels],
+        })
+    return docs
+
+
+# ---------- Comparación campo a campo ----------
+
+def _norm_text(key: str, v):
+    s = "" if v is None else str(v).strip()
+    if not s:
+        return None
+    if key.startswith("fecha"):
+        d = fmt_date8(s)
+        if d != "00000000":
+            return d
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(ch for ch in s.casefold() if ch.isalnum())
+    if s.isdigit():
+        s = s.lstrip("0") or "0"  # "0001" == "1"; "30-71234567-8" == "30712345678"
+    return s or None
+
+
+def _leaf_ok(spec, key: str, expected, got):
+    """None si los dos están vacíos (no cuenta); si no, si coinciden."""
+    if spec == NUM:
+        a, b = coerce_number(expected), coerce_number(got)
+        if a is None and b is None:
+            return None
+        return a is not None and b is not None and abs(a - b) <= AMOUNT_TOLERANCE
+    a, b = _norm_text(key, expected), _norm_text(key, got)
+    if a is None and b is None:
+        return None
+    return a == b
+
+
+def _filled_fields(spec, value, path: str):
+    """Campos con valor de algo que sobra (un ítem o comprobante de más)."""
+    if isinstance(spec, dict):
+        for k, sub in spec.items():
+            if isinstance(value, dict):
+                yield from _filled_fields(sub, value.get(k), f"{path}.{k}" if path else k)
+    elif isinstance(spec, list):
+        for item in value if isinstance(value, list) else []:
+            yield from _filled_fields(spec[0], item, path + "[]")
+    elif _leaf_ok(spec, path.rsplit(".", 1)[-1], None, value) is not None:
+        yield path
+
+
+def compare(spec, expected, got, path: str, out: dict):
+    """Suma a out {campo: [bien, total]} los campos presentes en `expected`."""
+    if isinstance(spec, dict):
+        if not isinstance(expected, dict):
+            return
+        got = got if isinstance(got, dict) else {}
+        for k, v in expected.items():
+            if k in spec:
+                compare(spec[k], v, got.get(k), f"{path}.{k}" if path else k, out)
+    elif isinstance(spec, list):
+        if not isinstance(expected, list):
+            return
+        got = got if isinstance(got, list) else []
+        for i, item in enumerate(expected):
+            compare(spec[0], item, got[i] if i < len(got) else None, path + "[]", out)
+        for item in got[len(expected):]:  # renglones de más: cada campo con valor es un error
+            for field_path in _filled_fields(spec[0], item, path + "[]"):
+                out.setdefault(field_path, [0, 0])[1] += 1
+    else:
+        ok = _leaf_ok(spec, path.rsplit(".", 1)[-1], expected, got)
+        if ok is not None:
+            counts = out.setdefault(path, [0, 0])
+            counts[0] += ok
+            counts[1] += 1
+
+
+def score_document(labels: list, datas: list) -> dict:
+    fields = {}
+    for i, expected in enumerate(labels):
+        compare(INVOICE_SCHEMA, expected, datas[i] if i < len(datas) else None, "", fields)
+    for extra in datas[len(labels):]:
+        for field_path in _filled_fields(INVOICE_SCHEMA, extra, ""):
+            fields.setdefault(field_path, [0, 0])[1] += 1
+    return fields
+
+
+def _section(field_path: str) -> str:
+    return re.split(r"[.\[]", field_path, maxsplit=1)[0]
+
+
+# ---------- Respuestas del modelo: grabadas, en vivo o suplente ----------
+
+class _Recording:
+    """Llamadas al modelo de un documento en una configuración (ver post_chat)."""
+
+    def __init__(self, path: str, labels: list, live: bool):
+        self.path = path
+        self.labels = labels
+        self.live = live
+        self.calls = None
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as fh:
+                self.calls = json.load(fh)["llamadas"]
+        self.pos = 0
+        self.made = []
+        self.stand_in = False
+        self.live_wall = 0.0
+        self.seconds = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+    def _count(self, call: dict):
+        self.seconds += call["seconds"]
+        self.prompt_tokens += call["prompt_tokens"]
+        self.completion_tokens += call["completion_tokens"]
+        price = PRICES.get(call["model"])
+        if price is None or self.cost is None:
+            self.cost = None
+        else:
+            self.cost += (call["prompt_tokens"] * price[0] + call["completion_tokens"] * price[1]) / 1e6
+
+    async def post_chat(self, response_format, parts, model=main.MODEL, followup=None) -> str:
+        if self.calls is not None:
+            if self.pos < len(self.calls) and self.calls[self.pos]["model"] == model:
+                call = self.calls[self.pos]
+                self.pos += 1
+                self._count(call)
+                return call["content"]
+            self.stand_in = True  # el flujo pide otra llamada que la grabada: desfasada
+        elif self.live:
+            before = dict(main._model_entry(model))
+            t0 = time.perf_counter()
+            content = await _live_post_chat(response_format, parts, model=model, followup=followup)
+            wall = time.perf_counter() - t0
+            after = main._model_stats[model]
+            call = {
+                "model": model,
+                "seconds": round(wall, 3),
+                "prompt_tokens": after["prompt_tokens"] - before["prompt_tokens"],
+                "completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+                "content": content,
+            }
+            self.live_wall += wall
+            self.made.append(call)
+            self._count(call)
+            return content
+        else:
+            self.stand_in = True
+        return json.dumps(self.labels[0], ensure_ascii=False)
+
+    @property
+    def recorded(self) -> bool:
+        """¿Todas las respuestas del documento fueron del modelo (grabadas o en vivo)?"""
+        if self.stand_in:
+            return False
+        if self.calls is not None:
+            return self.pos == len(self.calls)
+        return bool(self.made)
+
+    def save(self, config: str):
+        if not self.made or self.stand_in:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as fh:
+            json.dump({"config": config, "llamadas": self.made}, fh, ensure_ascii=False, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+
+_recording = None
+
+
+async def _post_chat(response_format, parts, model=main.MODEL, followup=None) -> str:
+    return await _recording.post_chat(response_format, parts, model=model, followup=followup)
+
+
+# ---------- Corrida ----------
+
+async def evaluate_document(doc: dict, cfg_name: str, corpus_dir: str, live: bool) -> dict:
+    global _recording
+    stem = os.path.splitext(doc["name"])[0]
+    rec = _Recording(os.path.join(corpus_dir, RECORDINGS_DIR, _slug(cfg_name), stem + ".json"), doc["labels"], live)
+    _recording = rec
+    task = {
+        "id": 0,
+        "filename": doc["name"],
+        "path": doc["path"],
+        "content_type": doc["content_type"],
+        "kind": store._task_kind(doc["content_type"]),
+    }
+    t0 = time.perf_counter()
+    try:
+        rows = await main.process_task(task)
+    finally:
+        _recording = None
+    wall = time.perf_counter() - t0
+    rec.save(cfg_name)
+    if rec.calls is not None and not rec.recorded:
+        print(f"  {doc['name']}: grabación desfasada ({rec.path}), corre con suplente")
+
+    local = wall - rec.live_wall
+    return {
+        "doc": doc["name"],
+        "grabado": rec.recorded,
+        "local_s": local,
+        "latencia_s": local + rec.seconds,
+        "prompt_tokens": rec.prompt_tokens,
+        "completion_tokens": rec.completion_tokens,
+        "costo": rec.cost,
+        "campos": score_document(doc["labels"], [r["data"] for r in rows]),
+    }
+
+
+def _mean(values):
+    values = list(values)
+    return sum(values) / len(values) if values else None
+
+
+def _p95(values):
+    values = sorted(values)
+    return values[math.ceil(0.95 * len(values)) - 1] if values else None
+
+
+def summarize(cfg: dict, results: list) -> dict:
+    scored = [r for r in results if r["grabado"]]
+    fields = {}
+    for r in scored:
+        for path, (ok, total) in r["campos"].items():
+            counts = fields.setdefault(path, [0, 0])
+            counts[0] += ok
+            counts[1] += total
+    sections = {}
+    for path, (ok, total) in fields.items():
+        counts = sections.setdefault(_section(path), [0, 0])
+        counts[0] += ok
+        counts[1] += total
+    ok = sum(c[0] for c in fields.values())
+    total = sum(c[1] for c in fields.values())
+    costs = [r["costo"] for r in scored]
+    return {
+        "config": config_name(cfg),
+        "documentos": len(results),
+        "grabados": len(scored),
+        "exactitud": ok / total if total else None,
+        "perfectos": _mean(all(c[0] == c[1] for c in r["campos"].values()) for r in scored),
+        "secciones": {s: c[0] / c[1] for s, c in sections.items() if c[1]},
+        "campos": {p: c[0] / c[1] for p, c in sorted(fields.items()) if c[1]},
+        "latencia_media_s": _mean(r["latencia_s"] for r in scored),
+        "latencia_p95_s": _p95(r["latencia_s"] for r in scored),
+        "local_media_s": _mean(r["local_s"] for r in results),
+        "prompt_tokens": _mean(r["prompt_tokens"] for r in scored),
+        "completion_tokens": _mean(r["completion_tokens"] for r in scored),
+        "usd_por_1000": 1000 * _mean(costs) if costs and None not in costs else None,
+        "documentos_detalle": results,
+    }
+
+
+def mark_pareto(summaries: list):
+    """pareto=True en las configuraciones que ninguna otra supera en exactitud, costo y latencia."""
+    def key(s):
+        return s["exactitud"], -s["usd_por_1000"], -s["latencia_media_s"]
+
+    candidates = [s for s in summaries if None not in (s["exactitud"], s["usd_por_1000"], s["latencia_media_s"])]
+    for s in summaries:
+        s["pareto"] = any(s is c for c in candidates) and not any(
+            all(a >= b for a, b in zip(key(o), key(s))) and key(o) != key(s) for o in candidates
+        )
+
+
+def _fmt(v, spec: str) -> str:
+    return "-" if v is None else format(v, spec)
+
+
+def print_report(summaries: list):
+    print(f"\n{'configuración':<52} {'grab':>7} {'exact':>6} {'perf':>6} {'lat s':>6} {'p95 s':>6} "
+          f"{'local s':>7} {'tok ent':>8} {'tok sal':>7} {'USD/1000':>9}")
+    for s in summaries:
+        print(f"{s['config'][:52]:<52} {s['grabados']:>3}/{s['documentos']:<3} {_fmt(s['exactitud'], '.1%'):>6} "
+              f"{_fmt(s['perfectos'], '.0%'):>6} {_fmt(s['latencia_media_s'], '.2f'):>6} "
+              f"{_fmt(s['latencia_p95_s'], '.2f'):>6} {_fmt(s['local_media_s'], '.2f'):>7} "
+              f"{_fmt(s['prompt_tokens'], ',.0f'):>8} {_fmt(s['completion_tokens'], ',.0f'):>7} "
+              f"{_fmt(s['usd_por_1000'], '.2f'):>9}{'  *' if s['pareto'] else ''}")
+
+    print(f"\nExactitud por sección\n{'configuración':<52} "
+          + " ".join(f"{name:>8}" for name in _SECTION_NAMES.values()))
+    for s in summaries:
+        print(f"{s['config'][:52]:<52} "
+              + " ".join(f"{_fmt(s['secciones'].get(sec), '.1%'):>8}" for sec in _SECTION_NAMES))
+    print("\n* frente de Pareto (exactitud / costo / latencia)")
+
+
+async def run(corpus_dir: str, configs: list, live: bool) -> list:
+    docs = load_corpus(corpus_dir)
+    if not docs:
+        raise SystemExit(f"No hay documentos etiquetados en {corpus_dir}")
+    print(f"Corpus: {len(docs)} documento(s), {sum(len(d['labels']) for d in docs)} comprobante(s)")
+
+    main.post_chat = _post_chat
+    summaries = []
+    try:
+        for cfg in configs:
+            name = config_name(cfg)
+            print(f"{name} ...")
+            apply_config(cfg)
+            results = [await evaluate_document(doc, name, corpus_dir, live) for doc in docs]
+            summaries.append(summarize(cfg, results))
+    finally:
+        main.post_chat = _live_post_chat
+        await main.close_client()
+        main.shutdown_cpu_pool()
+    mark_pareto(summaries)
+    return summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exactitud vs. costo de la extracción sobre un corpus etiquetado")
+    parser.add_argument("corpus", help="carpeta con los documentos y sus etiquetas .json")
+    parser.add_argument("--config", action="append", default=[], help='"modelo=...;dpi=...;recortes=...;texto=..."')
+    parser.add_argument("--grabar", action="store_true", help="llamar al modelo donde falte grabación")
+    parser.add_argument("--json", help="guardar el reporte completo (por campo y por documento)")
+    args = parser.parse_args()
+
+    try:
+        configs = [parse_config(spec) for spec in args.config or DEFAULT_CONFIGS]
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        summaries = asyncio.run(run(args.corpus, configs, args.grabar))
+    finally:
+        if _TEMP_DATA_DIR:
+            shutil.rmtree(_TEMP_DATA_DIR, ignore_errors=True)
+    print_report(summaries)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(summaries, fh, ensure_ascii=False, indent=1)
@@ -0,0 +1,172 @@
+"""
+Deadlines y "hedging" de las llamadas al modelo, para cortar la cola de latencia.
+
+Unas pocas llamadas de cada lote tardan varias veces la mediana. Con hedging,
+si una llamada pasa el percentil LLM_HEDGE_PERCENTILE de las latencias
+recientes (aprendido por tipo de llamada), se dispara un duplicado y gana la
+que conteste primero; la otra se cancela.
+
+  LLM_DEADLINE_SECONDS    tope total de una llamada (con duplicado incluido)
+  LLM_HEDGE               1 = habilitado
+  LLM_HEDGE_PERCENTILE    percentil de latencia que dispara el duplicado
+  LLM_HEDGE_MAX_RATE      fracción máxima de llamadas que se pueden duplicar
+                          (sobre las últimas LATENCY_WINDOW más las que están
+                          en curso; un duplicado cuenta desde que sale, así
+                          una ráfaga de llamadas lentas no se duplica entera):
+                          el costo extra queda acotado a ese porcentaje
+  LLM_HEDGE_MIN_SAMPLES   muestras necesarias antes de empezar a duplicar
+"""
+import asyncio
+import os
+import time
+from collections import deque
+
+
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "180"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+LLM_HEDGE_MAX_RATE = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+LATENCY_WINDOW = 200
+
+
+class DeadlineExceeded(Exception):
+    """La llamada (y su duplicado, si hubo) no terminó dentro del deadline."""
+
+
+# Latencias recientes (s) por tipo de llamada y, para el tope, si cada llamada se duplicó.
+# Las llamadas en curso y sus duplicados ya lanzados cuentan aparte hasta que terminan.
+_latencies = {}
+_hedged = deque(maxlen=LATENCY_WINDOW)
+_in_flight = {"calls": 0, "hedges": 0}
+_stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+
+
+def _percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def record_latency(key, seconds: float):
+    _latencies.setdefault(key, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+def hedge_delay(key):
+    """Segundos tras los cuales conviene duplicar una llamada `key` (None = no duplicar)."""
+    samples = _latencies.get(key)
+    if not LLM_HEDGE or not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return _percentile(samples, LLM_HEDGE_PERCENTILE)
+
+
+def _hedge_allowed() -> bool:
+    hedges = sum(_hedged) + _in_flight["hedges"]
+    return hedges < LLM_HEDGE_MAX_RATE * max(len(_hedged) + _in_flight["calls"], 1)
+
+
+async def _timed(call):
+    started = time.perf_counter()
+    result = await call()
+    return result, time.perf_counter() - started
+
+
+def _start(call, starts: dict):
+    task = asyncio.create_task(_timed(call))
+    starts[task] = time.perf_counter()
+    return task
+
+
+def _record_cut(key, tasks, starts: dict):
+    """Intentos que se van a cancelar: tardaban al menos lo que llevan."""
+    now = time.perf_counter()
+    for t in tasks:
+        record_latency(key, now - starts[t])
+
+
+async def _finish(tasks):
+    for t in tasks:
+        t.cancel()
+    # Que terminen de verdad antes de volver: pueden estar leyendo el body
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def hedged_call(call, key, deadline: float = None, info: dict = None):
+    """
+    await call() con deadline y, si tarda más que el percentil aprendido para
+    `key`, con una segunda llamada en paralelo. `call` es una función sin
+    argumentos que devuelve una corrutina nueva cada vez.
+
+    Al percentil va la latencia de la que gana y, como cota inferior, lo que
+    llevaba cada intento cortado (por el deadline o porque ganó el otro): si
+    no, las lentas nunca entrarían a la ventana. `info` (opcional) recibe
+    "requests": cuántos requests salieron (2 si se duplicó), para que quien
+    llama cuente el costo del duplicado.
+    """
+    deadline = LLM_DEADLINE_SECONDS if deadline is None else deadline
+    started = time.monotonic()
+    _stats["calls"] += 1
+    _in_flight["calls"] += 1
+
+    starts = {}
+    tasks = [_start(call, starts)]
+    hedged = False
+    error = None
+    try:
+        delay = hedge_delay(key)
+        while tasks:
+            left = deadline - (time.monotonic() - started)
+            if left <= 0:
+                break
+            wait = left if hedged or delay is None else min(left, max(delay - (time.monotonic() - started), 0))
+            done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+
+            for t in done:
+                tasks.remove(t)
+                if t.exception() is not None:
+                    error = error or t.exception()
+                    continue
+                result, seconds = t.result()
+                record_latency(key, seconds)
+                if hedged and t is not first:
+                    _stats["hedge_wins"] += 1
+                _record_cut(key, tasks, starts)
+                return result
+
+            if not done and not hedged and delay is not None and _hedge_allowed():
+                hedged = True
+                _stats["hedged"] += 1
+                _in_flight["hedges"] += 1
+                first = tasks[0]
+                tasks.append(_start(call, starts))
+            elif not done and not hedged:
+                delay = None  # ya no se puede duplicar: se espera hasta el deadline
+
+        if error is not None and not tasks:
+            raise error
+        _stats["deadline_exceeded"] += 1
+        _record_cut(key, tasks, starts)
+        raise DeadlineExceeded(f"El modelo no respondió en {deadline:g} s")
+    finally:
+        _in_flight["calls"] -= 1
+        if hedged:
+            _in_flight["hedges"] -= 1
+        _hedged.append(hedged)
+        if info is not None:
+            info["requests"] = len(starts)
+        await _finish(tasks)
+
+
+def latency_stats() -> dict:
+    """p50/p95 por tipo de llamada y contadores de hedging (para /health)."""
+    return {
+        **_stats,
+        "latencia": {
+            str(key): {
+                "n": len(samples),
+                "p50": round(_percentile(samples, 0.5), 2),
+                "p95": round(_percentile(samples, 0.95), 2),
+            }
+            for key, samples in _latencies.items() if samples
+        },
+    }
@@ -0,0 +1,176 @@
+"""
+Ingesta de archivos subidos al lote (store.py).
+
+  - El tipo de cada archivo se detecta por su contenido (magic bytes), no por
+    el Content-Type que manda el navegador.
+  - Los ZIP se recorren entrada por entrada: cada una se descomprime en
+    streaming directo a su archivo del lote y se encola en cuanto termina,
+    así los workers arrancan mientras sigue la descompresión. El ZIP nunca
+    se extrae entero (ni a disco ni a memoria).
+  - Límites contra zip bombs; se cuentan los bytes REALES descomprimidos (el
+    tamaño declarado en el ZIP se puede falsificar):
+      ZIP_MAX_ENTRIES      entradas por ZIP
+      ZIP_MAX_ENTRY_BYTES  tamaño descomprimido por entrada
+      ZIP_MAX_TOTAL_BYTES  tamaño descomprimido total del ZIP
+      ZIP_MAX_RATIO        relación descomprimido / comprimido por entrada
+    Una entrada que se pasa queda como fallida con el motivo; si se pasa el
+    total, el resto del ZIP se descarta.
+"""
+import itertools
+import os
+import zipfile
+
+from store import add_file, add_rejected
+
+
+CHUNK_BYTES = 64 * 1024
+
+ZIP_MAX_ENTRIES = int(os.getenv("ZIP_MAX_ENTRIES", "2000"))
+ZIP_MAX_ENTRY_BYTES = int(os.getenv("ZIP_MAX_ENTRY_BYTES", str(50 * 1024 * 1024)))
+ZIP_MAX_TOTAL_BYTES = int(os.getenv("ZIP_MAX_TOTAL_BYTES", str(2 * 1024 * 1024 * 1024)))
+ZIP_MAX_RATIO = int(os.getenv("ZIP_MAX_RATIO", "100"))
+
+# Un PDF o una foto casi no comprimen; por debajo de esto no se mira el ratio
+_RATIO_MIN_BYTES = 1024 * 1024
+
+# Basura que agregan los compresores de macOS / Windows
+_JUNK_PREFIXES = ("__MACOSX/",)
+_JUNK_NAMES = (".DS_Store", "Thumbs.db", "desktop.ini")
+
+
+class IngestError(Exception):
+    """Un archivo (o entrada de ZIP) que no se puede encolar."""
+
+
+def sniff_content_type(head: bytes) -> str:
+    """Content-Type según los primeros bytes del archivo."""
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"hevc", b"mif1", b"msf1"):
+        return "image/heic"
+    if head.startswith(b"BM"):
+        return "image/bmp"
+    if head[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+        return "application/zip"
+    return "application/octet-stream"
+
+
+class _Budget:
+    """Bytes descomprimidos que le quedan al ZIP."""
+
+    def __init__(self, total: int):
+        self.left = total
+
+
+def _limited_chunks(raw, limit: int, budget: _Budget, name: str):
+    """Lee `raw` de a CHUNK_BYTES y corta si se pasa de `limit` o del total del ZIP."""
+    read = 0
+    while True:
+        chunk = raw.read(CHUNK_BYTES)
+        if not chunk:
+            return
+        read += len(chunk)
+        budget.left -= len(chunk)
+        if read > limit:
+            raise IngestError(f"{name}: supera el tamaño permitido descomprimido")
+        if budget.left < 0:
+            raise IngestError(f"{name}: el ZIP supera el tamaño total permitido descomprimido")
+        yield chunk
+
+
+def _enqueue(batch_id: str, seq: int, name: str, chunks):
+    """Detecta el tipo con el primer bloque y guarda el archivo entero en el lote."""
+    head = next(chunks, b"")
+    if not head:
+        raise IngestError(f"{name}: archivo vacío")
+    content_type = sniff_content_type(head)
+    return add_file(batch_id, seq, name, content_type, itertools.chain([head], chunks))
+
+
+def _is_junk(entry: zipfile.ZipInfo) -> bool:
+    base = entry.filename.rsplit("/", 1)[-1]
+    return (
+        entry.is_dir()
+        or entry.filename.startswith(_JUNK_PREFIXES)
+        or base in _JUNK_NAMES
+        or base.startswith("._")
+    )
+
+
+def _ingest_zip(batch_id: str, seq: int, zip_name: str, fileobj) -> int:
+    """Encola cada entrada del ZIP. Devuelve el próximo `seq` libre."""
+    try:
+        zf = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        add_rejected(batch_id, seq, zip_name, "ZIP dañado o ilegible")
+        return seq + 1
+
+    budget = _Budget(ZIP_MAX_TOTAL_BYTES)
+    with zf:
+        entries = [e for e in zf.infolist() if not _is_junk(e)]
+        if len(entries) > ZIP_MAX_ENTRIES:
+            add_rejected(
+                batch_id, seq, zip_name,
+                f"El ZIP tiene {len(entries)} archivos (máximo {ZIP_MAX_ENTRIES})",
+            )
+            return seq + 1
+
+        for entry in entries:
+            name = f"{zip_name}/{entry.filename}"
+            if budget.left <= 0:
+                add_rejected(batch_id, seq, name, "Descartado: el ZIP supera el tamaño total permitido")
+                seq += 1
+                continue
+
+            # Primero lo declarado (barato); después se controla lo real al leer
+            limit = min(ZIP_MAX_ENTRY_BYTES, max(entry.compress_size * ZIP_MAX_RATIO, _RATIO_MIN_BYTES))
+            try:
+                if entry.flag_bits & 0x1:
+                    raise IngestError(f"{name}: entrada encriptada")
+                if entry.file_size > limit:
+                    raise IngestError(f"{name}: supera el tamaño permitido descomprimido")
+                with zf.open(entry) as raw:
+                    _enqueue(batch_id, seq, name, _limited_chunks(raw, limit, budget, name))
+            except IngestError as e:
+                add_rejected(batch_id, seq, name, str(e))
+            except (zipfile.BadZipFile, NotImplementedError, OSError) as e:
+                add_rejected(batch_id, seq, name, f"{name}: no se pudo descomprimir ({e})")
+            seq += 1
+    return seq
+
+
+def ingest_uploads(batch_id: str, uploads: list, start_seq: int = 0) -> int:
+    """
+    Encola en el lote los archivos subidos: uploads es una lista de
+    (filename, archivo binario con seek). Los ZIP se expanden. Devuelve la
+    cantidad de archivos encolados o rechazados. `start_seq` es el primer
+    número libre del lote (al agregar a un lote que ya tiene archivos).
+    """
+    seq = start_seq
+    for filename, fileobj in uploads:
+        filename = filename or f"archivo_{seq + 1}"
+        fileobj.seek(0)
+        head = fileobj.read(8)
+        fileobj.seek(0)
+
+        if sniff_content_type(head) == "application/zip":
+            seq = _ingest_zip(batch_id, seq, filename or "archivo.zip", fileobj)
+            continue
+
+        chunks = iter(lambda: fileobj.read(CHUNK_BYTES), b"")
+        try:
+            _enqueue(batch_id, seq, filename, chunks)
+        except IngestError as e:
+            add_rejected(batch_id, seq, filename, str(e))
+        seq += 1
+    return seq - start_seq
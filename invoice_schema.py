@@ -0,0 +1,318 @@
+"""
+Esquema único del comprobante.
+
+De esta definición salen:
+  - el prompt de sistema compacto (byte-estable, para que aplique el cache
+    de prefijo del proveedor),
+  - el response_format estricto (json_schema),
+  - el parseo tipado de la respuesta (coerce_invoice).
+
+Si hay que agregar o sacar un campo, se toca SOLO acá.
+
+El esquema del response_format se cobra como entrada en cada llamada (y se
+multiplica por la cascada, la escalera de DPI y las continuaciones), así que
+al modelo no se le piden los campos que se completan localmente (LOCAL_FIELDS);
+el JSON que ve el usuario los tiene igual. prompt_token_report() mide la
+entrada fija entera: prompts + esquema.
+"""
+import json
+import math
+
+
+# Tipos de hoja del esquema
+STR = "str"   # texto: "" si no se ve
+NUM = "num"   # número: null si no se ve
+INT = "int"   # entero obligatorio (uso interno, p.ej. índice de imagen)
+
+
+INVOICE_SCHEMA = {
+    "datos_comprobante": {
+        "tipo": STR,
+        "letra": STR,
+        "punto_venta": STR,
+        "numero_comprobante": STR,
+        "fecha_emision": STR,
+        "fecha_vencimiento": STR,
+        "condicion_venta": STR,
+        "moneda": STR,
+        "cotizacion_moneda": NUM,
+    },
+    "emisor": {
+        "razon_social": STR,
+        "cuit": STR,
+        "domicilio_comercial": STR,
+        "condicion_iva": STR,
+        "condicion_ingresos_brutos": STR,
+        "localidad": STR,
+        "provincia": STR,
+        "pais": STR,
+    },
+    "receptor": {
+        "razon_social": STR,
+        "cuit": STR,
+        "domicilio_comercial": STR,
+        "condicion_iva": STR,
+        "condicion_ingresos_brutos": STR,
+        "tipo_documento": STR,
+        "numero_documento": STR,
+    },
+    "totales": {
+        "importe_neto_gravado": NUM,
+        "importe_neto_no_gravado": NUM,
+        "importe_exento": NUM,
+        "ivAs": [
+            {
+                "alicuota": NUM,
+                "importe_iva": NUM,
+            }
+        ],
+        "percepciones_iva": NUM,
+        "percepciones_ingresos_brutos": NUM,
+        "percepciones_otras": NUM,
+        "descuentos_generales": NUM,
+        "subtotal": NUM,
+        "total_comprobante": NUM,
+    },
+    "items": [
+        {
+            "codigo": STR,
+            "descripcion": STR,
+            "unidad_medida": STR,
+            "cantidad": NUM,
+            "precio_unitario": NUM,
+            "bonificacion": NUM,
+            "alicuota_iva": NUM,
+            "importe_total_renglon": NUM,
+        }
+    ],
+    "datos_fiscales_afip": {
+        "cae": STR,
+        "fecha_vencimiento_cae": STR,
+        "codigo_barras_qr": STR,
+        "tipo_documento_receptor": STR,
+        "numero_documento_receptor": STR,
+    },
+    "datos_compras_importaciones": {
+        "condicion_bienes": STR,
+        "centro_costo": STR,
+        "numero_remito": STR,
+        "numero_despacho_importacion": STR,
+        "gastos_relacionados": STR,
+    },
+}
+
+
+# Campos que no se le piden al modelo, con de dónde salen al parsear:
+#   - el tipo y número de documento del receptor están repetidos en
+#     datos_fiscales_afip: se copian de receptor;
+#   - el QR de AFIP codifica una URL que el modelo no puede decodificar
+#     de la imagen: queda "" (antes volvía vacío o inventado).
+LOCAL_FIELDS = {
+    ("datos_fiscales_afip", "tipo_documento_receptor"): ("receptor", "tipo_documento"),
+    ("datos_fiscales_afip", "numero_documento_receptor"): ("receptor", "numero_documento"),
+    ("datos_fiscales_afip", "codigo_barras_qr"): None,
+}
+
+# Importes que, si no figuran, valen 0. El modelo los devuelve null igual que
+# cualquier número (no se le pide que invente un 0); el 0 lo pone coerce_invoice.
+ZERO_IF_MISSING = {
+    ("totales", "importe_neto_no_gravado"),
+    ("totales", "importe_exento"),
+    ("totales", "percepciones_iva"),
+    ("totales", "percepciones_ingresos_brutos"),
+    ("totales", "percepciones_otras"),
+    ("totales", "descuentos_generales"),
+}
+
+
+# ---------- JSON Schema estricto (response_format) ----------
+
+def _model_spec(spec: dict) -> dict:
+    """INVOICE_SCHEMA sin los campos de LOCAL_FIELDS (lo que se le pide al modelo)."""
+    return {
+        section: {k: v for k, v in sub.items() if (section, k) not in LOCAL_FIELDS}
+        if isinstance(sub, dict) else sub
+        for section, sub in spec.items()
+    }
+
+
+def _to_json_schema(spec) -> dict:
+    """Convierte un nodo de INVOICE_SCHEMA a JSON Schema (modo strict de OpenAI)."""
+    if spec == STR:
+        return {"type": "string"}
+    if spec == NUM:
+        return {"type": ["number", "null"]}
+    if spec == INT:
+        return {"type": "integer"}
+    if isinstance(spec, list):
+        return {"type": "array", "items": _to_json_schema(spec[0])}
+    # strict exige: todas las claves en "required" y sin propiedades extra
+    return {
+        "type": "object",
+        "properties": {k: _to_json_schema(v) for k, v in spec.items()},
+        "required": list(spec.keys()),
+        "additionalProperties": False,
+    }
+
+
+INVOICE_JSON_SCHEMA = _to_json_schema(_model_spec(INVOICE_SCHEMA))
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "comprobante",
+        "strict": True,
+        "schema": INVOICE_JSON_SCHEMA,
+    },
+}
+
+# Modo empaquetado: varias imágenes en un solo request => un array de
+# comprobantes, cada uno marcado con el número de imagen de la que salió.
+PACKED_SCHEMA = {"comprobantes": [dict({"imagen": INT}, **_model_spec(INVOICE_SCHEMA))]}
+
+PACKED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "comprobantes",
+        "strict": True,
+        "schema": _to_json_schema(PACKED_SCHEMA),
+    },
+}
+
+
+# ---------- Prompt compacto ----------
+# La estructura ya viaja en RESPONSE_FORMAT, así que el prompt sólo lleva las
+# reglas. Es una constante armada una sola vez: mismo texto byte a byte en
+# cada llamada => el proveedor puede cachear el prefijo.
+
+SYSTEM_PROMPT = (
+    "Extraes datos de comprobantes argentinos (facturas, notas de crédito/débito, tickets). "
+    "Si un dato no se ve: \"\" o null; no inventes. "
+    "Importes con punto decimal. ivAs: una entrada por alícuota."
+)
+
+USER_PROMPT = "Extrae los datos del comprobante de la imagen adjunta."
+
+TILED_USER_HINT = (
+    "Las imágenes son recortes del mismo comprobante: "
+    "encabezado, tabla de ítems y totales/CAE."
+)
+
+PACKED_USER_PROMPT = (
+    "Cada imagen adjunta es un comprobante distinto. "
+    "Devuelve un objeto por imagen en \"comprobantes\", con \"imagen\" = número de la imagen."
+)
+
+# Pedido de continuación cuando el JSON vino cortado (main.parse_with_continuation)
+CONTINUE_PROMPT = (
+    "Tu respuesta anterior se cortó. Continúala exactamente desde el último carácter, "
+    "sin repetir nada y sin agregar texto ni ``` alrededor."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación rápida de tokens (~4 caracteres por token), sin dependencias."""
+    return math.ceil(len(text) / 4)
+
+
+# Entrada fija por llamada antes del esquema único: la plantilla JSON de ~1970
+# caracteres como prompt de sistema, con response_format json_object
+BASELINE_FIXED_TOKENS = 494
+
+
+def prompt_token_report() -> dict:
+    """
+    Mide la entrada fija de cada llamada. El esquema del response_format se
+    cobra como entrada, así que la cifra que se compara es fixed_input_tokens
+    (prompts + esquema), no sólo el texto del prompt.
+    """
+    schema_txt = json.dumps(RESPONSE_FORMAT, ensure_ascii=False, separators=(",", ":"))
+    packed_txt = json.dumps(PACKED_RESPONSE_FORMAT, ensure_ascii=False, separators=(",", ":"))
+    prompt_tokens = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(USER_PROMPT)
+    return {
+        "system_prompt_chars": len(SYSTEM_PROMPT),
+        "system_prompt_tokens": estimate_tokens(SYSTEM_PROMPT),
+        "user_prompt_tokens": estimate_tokens(USER_PROMPT),
+        "schema_chars": len(schema_txt),
+        "schema_tokens": estimate_tokens(schema_txt),
+        "fixed_input_tokens": prompt_tokens + estimate_tokens(schema_txt),
+        "packed_fixed_input_tokens": (
+            estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(PACKED_USER_PROMPT) + estimate_tokens(packed_txt)
+        ),
+        "baseline_fixed_tokens": BASELINE_FIXED_TOKENS,
+    }
+
+
+# ---------- Parseo tipado ----------
+
+def parse_number(token: str):
+    """'1.240,00' / '1,240.00' / '1240.5' / '-3,5' -> float (None si no es número)."""
+    token = token.rstrip(".,")
+    neg = token.startswith("-")
+    token = token.lstrip("-")
+    if not token:
+        return None
+    if "," in token and "." in token:
+        dec = "," if token.rfind(",") > token.rfind(".") else "."
+    elif "," in token:
+        dec = "," if token.count(",") == 1 else None
+    elif "." in token:
+        # "1.240" es mil doscientos cuarenta (miles con punto); "0.125" no
+        dec = "." if token.count(".") == 1 and (len(token) - token.rfind(".") - 1 != 3 or token.startswith("0.")) else None
+    else:
+        dec = None
+    if dec:
+        whole, _, frac = token.rpartition(dec)
+        token = whole.replace(".", "").replace(",", "") + "." + frac
+    else:
+        token = token.replace(".", "").replace(",", "")
+    try:
+        value = float(token)
+    except ValueError:
+        return None
+    return -value if neg else value
+
+
+def coerce_number(v):
+    """Importe del JSON del modelo (número o texto en cualquiera de los dos formatos) -> float o None."""
+    if v is None or isinstance(v, bool):
+        return None
+    if isinstance(v, (int, float)):
+        return float(v)
+    if isinstance(v, str):
+        s = v.strip().replace("$", "").replace(" ", "")
+        if s in ("", "null"):
+            return None
+        return parse_number(s)
+    return None
+
+
+def _coerce(spec, v, path: tuple = ()):
+    if spec == STR:
+        return "" if v is None else str(v)
+    if spec == NUM:
+        n = coerce_number(v)
+        return 0.0 if n is None and path in ZERO_IF_MISSING else n
+    if spec == INT:
+        n = coerce_number(v)
+        return None if n is None else int(n)
+    if isinstance(spec, list):
+        if not isinstance(v, list):
+            return []
+        return [_coerce(spec[0], x, path) for x in v if isinstance(x, dict)]
+    if not isinstance(v, dict):
+        v = {}
+    return {k: _coerce(sub, v.get(k), path + (k,)) for k, sub in spec.items()}
+
+
+def coerce_invoice(raw: dict) -> dict:
+    """
+    Normaliza un dict devuelto por la IA al esquema: están TODAS las claves,
+    los textos son str y los importes float o None (0.0 los de ZERO_IF_MISSING).
+    Claves desconocidas se descartan; las de LOCAL_FIELDS vacías se completan.
+    """
+    data = _coerce(INVOICE_SCHEMA, raw)
+    for (section, key), source in LOCAL_FIELDS.items():
+        if source and not data[section][key]:
+            data[section][key] = data[source[0]][source[1]]
+    return data
@@ -0,0 +1,202 @@
+"""
+Reparación local de respuestas JSON rotas del modelo.
+
+Casi todas las respuestas que json.loads rechaza son de tres tipos: cortadas
+por el tope de tokens de salida (items largos), con comas de más / de menos,
+o envueltas en texto ("```json ... ```", "Aquí está el JSON: ..."). En vez de
+perder el comprobante, repair_json() las lee con un parser tolerante:
+
+  - ignora lo que haya antes del primer { y después del valor completo;
+  - acepta comas finales, comas faltantes y claves sin comillas;
+  - si el texto se corta, cierra las estructuras abiertas descartando el
+    último valor a medias (un importe cortado "1234" de "12345.67" es peor
+    que ninguno) y el último elemento de una lista si quedó incompleto (un
+    ítem sin importes). Las claves que faltan las completa coerce_invoice con el
+    valor vacío del esquema.
+
+Si la respuesta vino cortada, quien llama puede pedirle al modelo que
+continúe desde donde quedó (main.parse_with_continuation) antes de
+conformarse con la versión cerrada localmente.
+"""
+import json
+
+
+_decoder = json.JSONDecoder(strict=False)  # acepta saltos de línea dentro de strings
+
+_PUNCT = "{}[]:,"
+
+# Valor que no se llegó a leer (texto cortado o basura): no se agrega
+_MISSING = object()
+
+
+def _tokens(text: str, start: int):
+    """(tipo, valor, completo) con tipo en {punct, str, word}; sigue hasta el final del texto."""
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        if ch.isspace():
+            i += 1
+        elif ch in _PUNCT:
+            yield "punct", ch, True
+            i += 1
+        elif ch == '"':
+            j = i + 1
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            if j >= n:
+                yield "str", text[i + 1:], False
+                return
+            try:
+                value = _decoder.decode(text[i:j + 1])
+            except json.JSONDecodeError:
+                value = text[i + 1:j]
+            yield "str", value, True
+            i = j + 1
+        else:
+            j = i
+            while j < n and not text[j].isspace() and text[j] not in _PUNCT and text[j] != '"':
+                j += 1
+            yield "word", text[i:j], j < n
+            i = j
+
+
+class _Reader:
+    def __init__(self, text: str, start: int):
+        self.toks = list(_tokens(text, start))
+        self.pos = 0
+        self.truncated = False
+        self.fixes = set()
+
+    def peek(self):
+        return self.toks[self.pos] if self.pos < len(self.toks) else None
+
+    def next(self):
+        tok = self.peek()
+        self.pos += 1
+        if tok is None:
+            self.truncated = True
+        return tok
+
+    def value(self):
+        tok = self.next()
+        if tok is None:
+            return _MISSING
+        kind, v, complete = tok
+        if kind == "punct":
+            if v == "{":
+                return self.obj()
+            if v == "[":
+                return self.array()
+            self.pos -= 1  # "}" / "]" / "," sin valor: lo resuelve el contenedor
+            return _MISSING
+        if not complete:
+            self.truncated = True
+            return _MISSING
+        if kind == "str":
+            return v
+        try:
+            return json.loads(v)
+        except json.JSONDecodeError:
+            self.fixes.add("literal_invalido")
+            return None
+
+    def _separator(self, close: str) -> bool:
+        """Consume las comas antes del próximo elemento; True si cerró el contenedor."""
+        commas = 0
+        while True:
+            tok = self.peek()
+            if tok is None:
+                self.truncated = True
+                return True
+            if tok[0] == "punct" and tok[1] == ",":
+                commas += 1
+                self.pos += 1
+                continue
+            if tok[0] == "punct" and tok[1] == close:
+                self.pos += 1
+                if commas:
+                    self.fixes.add("coma_final")
+                return True
+            if commas > 1:
+                self.fixes.add("coma_doble")
+            return False
+
+    def obj(self) -> dict:
+        out = {}
+        first = True
+        while not self.truncated:
+            before = self.pos
+            if self._separator("}"):
+                return out
+            if not first and self.pos == before:
+                self.fixes.add("coma_faltante")
+            first = False
+
+            kind, key, complete = self.next()
+            if kind == "punct":
+                self.fixes.add("sintaxis")
+                continue
+            if not complete:
+                self.truncated = True
+                return out
+            if kind == "word":
+                self.fixes.add("clave_sin_comillas")
+            tok = self.peek()
+            if tok is None:
+                self.truncated = True
+                return out
+            if tok[:2] == ("punct", ":"):
+                self.pos += 1
+            else:
+                self.fixes.add("sintaxis")
+            v = self.value()
+            if v is not _MISSING:
+                out[key] = v
+        return out
+
+    def array(self) -> list:
+        out = []
+        first = True
+        while not self.truncated:
+            before = self.pos
+            if self._separator("]"):
+                return out
+            if not first and self.pos == before:
+                self.fixes.add("coma_faltante")
+            first = False
+            v = self.value()
+            if self.truncated:
+                return out  # un elemento cortado (p. ej. un ítem a medias) no se agrega
+            if v is not _MISSING:
+                out.append(v)
+            else:
+                self.pos += 1  # token que no es un valor (p. ej. ":" suelto)
+                self.fixes.add("sintaxis")
+        return out
+
+
+def repair_json(text: str):
+    """
+    (objeto, arreglos, cortado). `objeto` es None si no hay ningún JSON
+    rescatable; `arreglos` es la lista de lo que hubo que corregir;
+    `cortado` indica que el texto terminó con estructuras abiertas.
+    """
+    if not isinstance(text, str):
+        return None, [], False
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return None, [], False
+
+    reader = _Reader(text, start)
+    result = reader.value()
+    if result is _MISSING:
+        return None, [], reader.truncated
+
+    fixes = reader.fixes
+    if text[:start].strip():
+        fixes.add("texto_antes")
+    if reader.pos < len(reader.toks):
+        fixes.add("texto_despues")
+    if reader.truncated:
+        fixes.add("cortado")
+    return result, sorted(fixes), reader.truncated
@@ -0,0 +1,130 @@
+"""
+Carriles de prioridad: interactivo (subidas chicas desde la página), bulk
+(lotes grandes, carpetas vigiladas) y background (reprocesos).
+
+Sin carriles, quien sube tres facturas espera detrás de un lote de 2.000 que
+ya ocupó todos los workers. Con carriles, cada recurso compartido se reparte
+por peso (LANE_WEIGHTS) entre los carriles que tienen trabajo esperando:
+
+  - tareas de la cola (store.claim_tasks): cada worker que queda libre toma
+    del carril con menos tareas corriendo por unidad de peso, entre procesos;
+  - pool de CPU (cpu_pool.run_cpu) y llamadas al modelo (main.post_chat):
+    cuando hay que esperar turno, lo da una PriorityGate por peso.
+
+Ningún carril se queda sin turno (un lote bulk sigue avanzando al ritmo de su
+peso). Además, los primeros LANE_RESERVED_WORKERS loops de cada worker sólo
+toman tareas interactivas: aunque los lotes grandes ocupen todo lo demás,
+una subida chica arranca enseguida.
+
+  LANE_WEIGHTS           "interactive=8,bulk=2,background=1"
+  INTERACTIVE_MAX_FILES  una subida con hasta estos archivos (sin ZIP) es interactiva
+  LANE_RESERVED_WORKERS  loops por proceso reservados al carril interactivo
+"""
+import asyncio
+import contextvars
+import os
+from collections import deque
+
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BULK, BACKGROUND)
+
+LANE_WEIGHTS = {
+    lane: float(weight)
+    for lane, _, weight in (
+        part.partition("=") for part in os.getenv("LANE_WEIGHTS", "interactive=8,bulk=2,background=1").split(",")
+    )
+    if lane in LANES
+}
+INTERACTIVE_MAX_FILES = int(os.getenv("INTERACTIVE_MAX_FILES", "20"))
+LANE_RESERVED_WORKERS = int(os.getenv("LANE_RESERVED_WORKERS", "1"))
+
+# Carril del trabajo en curso (lo fija el worker al tomar las tareas)
+current_lane = contextvars.ContextVar("current_lane", default=BULK)
+
+
+def weight(lane: str) -> float:
+    return LANE_WEIGHTS.get(lane) or 1.0
+
+
+def upload_lane(n_files: int, has_zip: bool, requested: str = None) -> str:
+    """Carril de una subida: el pedido explícitamente o, si no, según su tamaño."""
+    if requested in LANES:
+        return requested
+    return INTERACTIVE if n_files <= INTERACTIVE_MAX_FILES and not has_zip else BULK
+
+
+def pick_lane(waiting, running: dict) -> str:
+    """
+    De los carriles con trabajo esperando, el que menos recurso usa por
+    unidad de peso (empate: el de más peso).
+    """
+    return min(waiting, key=lambda lane: ((running.get(lane, 0) + 1) / weight(lane), -weight(lane)))
+
+
+class PriorityGate:
+    """
+    Semáforo de `limit` lugares que, cuando hay espera, da el próximo lugar
+    al carril que corresponde por peso (pick_lane) y dentro de cada carril
+    por orden de llegada.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = {}
+        self._busy = 0
+        self._waiting = {lane: deque() for lane in LANES}
+
+    def _wake(self):
+        while self._busy < self.limit:
+            lanes = [lane for lane, q in self._waiting.items() if q]
+            if not lanes:
+                return
+            lane = pick_lane(lanes, self.running)
+            fut = self._waiting[lane].popleft()
+            if fut.done():
+                continue  # se canceló mientras esperaba
+            self._grant(lane)
+            fut.set_result(None)
+
+    def _grant(self, lane: str):
+        self._busy += 1
+        self.running[lane] = self.running.get(lane, 0) + 1
+
+    async def acquire(self, lane: str):
+        lane = lane if lane in LANES else BULK
+        if self._busy < self.limit and not any(self._waiting.values()):
+            self._grant(lane)
+            return lane
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting[lane].append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(lane)  # se le dio el lugar justo al cancelarse
+            raise
+        return lane
+
+    def release(self, lane: str):
+        self._busy -= 1
+        self.running[lane] -= 1
+        self._wake()
+
+    def slot(self, lane: str = None):
+        """async with gate.slot(): ... (por defecto, el carril del contexto)."""
+        return _Slot(self, lane or current_lane.get())
+
+
+class _Slot:
+    def __init__(self, gate: PriorityGate, lane: str):
+        self.gate = gate
+        self.lane = lane
+
+    async def __aenter__(self):
+        self.lane = await self.gate.acquire(self.lane)
+
+    async def __aexit__(self, *exc):
+        self.gate.release(self.lane)
@@ -0,0 +1,280 @@
+"""
+Motor de layouts de exportación (ancho fijo y delimitados).
+
+Cada layout es DATA: una lista de campos con nombre, ancho, alineación,
+relleno, formateador y de dónde sale el valor. compile_layout() lo convierte
+una sola vez en una función `línea(registro) -> str` generada como código
+Python (sin bucles por campo ni llamadas genéricas en cada línea), así
+renderizar 100k líneas es un loop apretado.
+
+    CCABECER = compile_layout({
+        "name": "bejerman_ccabecer",
+        "kind": "fixed",
+        "fields": [
+            field("tipo_comprobante", 3, "tipo"),
+            field("punto_venta", 4, "dc.punto_venta", align="right", fill="0"),
+            field("fecha", 8, "dc.fecha_emision", fmt="date8"),
+            field("codigo_proveedor", 6, const="@@@#@@"),
+            ...
+        ],
+    })
+    CCABECER(registro)        # una línea
+    CCABECER.offsets          # [(nombre, desde, hasta), ...] (ancho fijo)
+    CCABECER.header           # encabezado (delimitados con "header": True)
+
+`source` es una ruta con puntos dentro del registro ("dc.punto_venta");
+el valor pasa por el formateador y, en ancho fijo, se trunca y rellena al
+ancho. En delimitados el separador dentro de un valor se reemplaza por
+`replace` (por defecto ",").
+
+Agregar un ERP nuevo = escribir su spec (más, si hace falta, la función que
+arma el registro con los valores calculados).
+"""
+import re
+from datetime import datetime
+from functools import lru_cache
+
+
+LEFT = "left"
+RIGHT = "right"
+
+
+def field(name: str, width: int = None, source: str = None, fmt: str = "str",
+          align: str = LEFT, fill: str = " ", const=None, label: str = None) -> dict:
+    """Un campo del layout (ver docstring del módulo)."""
+    return {
+        "name": name,
+        "width": width,
+        "source": source,
+        "fmt": fmt,
+        "align": align,
+        "fill": fill,
+        "const": const,
+        "label": label or name,
+    }
+
+
+# ---------- Formateadores ----------
+
+def fmt_str(v) -> str:
+    return "" if v is None else str(v)
+
+
+def fmt_digits(v) -> str:
+    if not v:
+        return ""
+    return "".join(ch for ch in str(v) if ch.isdigit())
+
+
+@lru_cache(maxsize=4096)
+def _date8(date_str: str) -> str:
+    date_str = date_str.strip()
+    try:
+        if "-" in date_str:
+            dt = datetime.strptime(date_str[:10], "%Y-%m-%d")
+        elif "/" in date_str:
+            parts = date_str.split("/")
+            if len(parts[0]) == 4:
+                dt = datetime.strptime(date_str[:10], "%Y/%m/%d")
+            else:
+                dt = datetime.strptime(date_str[:10], "%d/%m/%Y")
+        else:
+            if len(date_str) == 8:
+                dt = datetime.strptime(date_str, "%d%m%Y")
+            else:
+                return "00000000"
+        return dt.strftime("%Y%m%d")
+    except Exception:
+        return "00000000"
+
+
+def fmt_date8(date_str) -> str:
+    """Convierte '03/07/2025', '2025-07-03', etc. a '20250703'. Si falla, 00000000."""
+    if not date_str:
+        return "00000000"
+    # En un lote las fechas se repiten mucho y strptime es lo más caro de la línea
+    return _date8(date_str)
+
+
+def fmt_amount(v) -> str:
+    """Importe con 2 decimales y punto; sin dato (o inválido) => 0.00."""
+    if v in (None, "", "null"):
+        return "0.00"
+    try:
+        return f"{float(v):.2f}"
+    except Exception:
+        return "0.00"
+
+
+def fmt_num2(v) -> str:
+    """Importe con 2 decimales y punto; sin dato (o inválido) => vacío."""
+    if v in (None, "", "null"):
+        return ""
+    try:
+        return f"{float(v):.2f}"
+    except Exception:
+        return ""
+
+
+FORMATTERS = {
+    "str": fmt_str,
+    "digits": fmt_digits,
+    "date8": fmt_date8,
+    "amount": fmt_amount,
+    "num2": fmt_num2,
+}
+
+_NUMERIC_FORMATS = {"digits", "date8", "amount", "num2"}
+
+
+# ---------- Compilación ----------
+
+def _source_expr(path: str) -> str:
+    parts = path.split(".")
+    expr = f"r.get({parts[0]!r})"
+    for p in parts[1:]:
+        expr = f"({expr} or {{}}).get({p!r})"
+    return expr
+
+
+def _field_expr(f: dict, n: int, kind: str, sep: str, replace: str, ns: dict) -> str:
+    if f["const"] is not None:
+        expr = repr(fmt_str(f["const"]))
+    elif f["fmt"] == "str":
+        # Caso más común: si ya es str no se llama a nada. Un salto de línea
+        # (domicilios en dos renglones) partiría el registro en dos
+        ns["_fmt_str"] = fmt_str
+        expr = (f"(_v if (_v := {_source_expr(f['source'])}).__class__ is str else _fmt_str(_v))"
+                f".replace('\\n', ' ').replace('\\r', ' ')")
+    else:
+        fmt = f["fmt"]
+        fn = FORMATTERS[fmt] if isinstance(fmt, str) else fmt
+        ns[f"_f{n}"] = fn
+        expr = f"_f{n}({_source_expr(f['source'])})"
+
+    if kind == "fixed":
+        w = f["width"]
+        pad = "rjust" if f["align"] == RIGHT else "ljust"
+        if f["const"] is not None:
+            # Constante: se resuelve ya (mismo truncado/relleno que un valor)
+            value = fmt_str(f["const"])[:w]
+            return repr(value.rjust(w, f["fill"]) if f["align"] == RIGHT else value.ljust(w, f["fill"]))
+        return f"{expr}[:{w}].{pad}({w}, {f['fill']!r})"
+
+    if f["const"] is not None:
+        return repr(fmt_str(f["const"]).replace(sep, replace))
+    if f["fmt"] in _NUMERIC_FORMATS:
+        return expr  # sólo dígitos, punto y signo: no puede traer el separador
+    return f"{expr}.replace({sep!r}, {replace!r})"
+
+
+def compile_layout(layout: dict):
+    """
+    Compila un layout a una función `línea(registro) -> str`.
+
+    layout: {"name", "kind": "fixed" | "delimited", "fields": [field(...)],
+             "sep": ";", "replace": ",", "header": bool}
+    """
+    kind = layout.get("kind", "fixed")
+    sep = layout.get("sep", ";")
+    replace = layout.get("replace", ",")
+    fields = layout["fields"]
+
+    ns = {}
+    exprs = [_field_expr(f, n, kind, sep, replace, ns) for n, f in enumerate(fields)]
+    joiner = '""' if kind == "fixed" else repr(sep)
+    fn_name = "line_" + layout["name"]
+    src = (
+        f"def {fn_name}(r):\n"
+        f"    return {joiner}.join((\n"
+        + "".join(f"        {e},\n" for e in exprs)
+        + "    ))\n"
+    )
+    exec(compile(src, f"<layout {layout['name']}>", "exec"), ns)
+    fn = ns[fn_name]
+
+    fn.layout = layout
+    fn.source = src
+    if kind == "fixed":
+        fn.offsets = field_offsets(layout)
+        fn.width = fn.offsets[-1][2] if fn.offsets else 0
+    fn.header = sep.join(f["label"] for f in fields) if layout.get("header") else None
+    return fn
+
+
+def field_offsets(layout: dict) -> list:
+    """[(nombre, desde, hasta)] de cada campo de un layout de ancho fijo (0-based, hasta exclusivo)."""
+    out = []
+    pos = 0
+    for f in layout["fields"]:
+        out.append((f["name"], pos, pos + f["width"]))
+        pos += f["width"]
+    return out
+
+
+def split_line(layout: dict, line: str) -> dict:
+    """Inverso de la línea: {nombre: texto del campo} (para controles de offsets)."""
+    if layout.get("kind", "fixed") == "fixed":
+        return {name: line[a:b] for name, a, b in field_offsets(layout)}
+    values = line.split(layout.get("sep", ";"))
+    return {f["name"]: v for f, v in zip(layout["fields"], values)}
+
+
+# ---------- Conformidad ----------
+# Qué puede quedar en cada campo según su formateador (ya sin el relleno).
+# Un offset corrido o un valor truncado no pasa estos patrones.
+
+_PATTERNS = {
+    "digits": re.compile(r"\d*"),
+    "date8": re.compile(r"\d{8}"),
+    "amount": re.compile(r"-?\d*\.\d{2}"),
+    "num2": re.compile(r"(-?\d+\.\d{2})?"),
+}
+
+
+def _unpad(value: str, f: dict) -> str:
+    if f["align"] == RIGHT:
+        return value.lstrip(f["fill"]) if f["fill"] != " " else value.strip()
+    return value.rstrip(f["fill"]) if f["fill"] != " " else value.strip()
+
+
+def conformance_errors(layout: dict, line: str) -> list:
+    """
+    Problemas de una línea contra su layout: largo exacto (ancho fijo) o
+    cantidad de campos (delimitados), constantes en su lugar y cada valor
+    con la forma de su formateador. [] = la línea cumple.
+    """
+    kind = layout.get("kind", "fixed")
+    fields = layout["fields"]
+    if "\n" in line or "\r" in line:
+        return ["salto de línea dentro del registro"]
+
+    if kind == "fixed":
+        offsets = field_offsets(layout)
+        if len(line) != offsets[-1][2]:
+            return [f"largo {len(line)}, esperado {offsets[-1][2]}"]
+        values = [line[a:b] for _, a, b in offsets]
+    else:
+        values = line.split(layout.get("sep", ";"))
+        if len(values) != len(fields):
+            return [f"{len(values)} campos, esperados {len(fields)}"]
+
+    errors = []
+    for f, value in zip(fields, values):
+        if f["const"] is not None:
+            expected = fmt_str(f["const"])
+            if kind == "fixed":
+                expected = expected[:f["width"]]
+                expected = expected.rjust(f["width"], f["fill"]) if f["align"] == RIGHT else expected.ljust(f["width"], f["fill"])
+            else:
+                expected = expected.replace(layout.get("sep", ";"), layout.get("replace", ","))
+            if value != expected:
+                errors.append(f"{f['name']}: constante {value!r} != {expected!r}")
+            continue
+        pattern = _PATTERNS.get(f["fmt"]) if isinstance(f["fmt"], str) else None
+        if pattern is None:
+            continue
+        raw = _unpad(value, f) if kind == "fixed" else value
+        if not pattern.fullmatch(raw):
+            errors.append(f"{f['name']}: {value!r} no es {f['fmt']}")
+    return errors
@@ -0,0 +1,168 @@
+"""
+Libro IVA incremental: sumas por período y CUIT que se actualizan al guardar
+cada comprobante (store.complete_task), sin volver a recorrer los resultados.
+
+Por comprobante se calcula su aporte (invoice_contributions):
+  - clave: período (AAAA-MM de la fecha de emisión), CUIT del receptor (el
+    dueño del libro), CUIT del proveedor, letra y tipo;
+  - por alícuota (todas las de totales.ivAs): neto e IVA;
+  - totales: neto gravado, no gravado, exento, IVA, percepciones de IVA,
+    IIBB y otras, total.
+
+El store suma esos aportes en tablas indexadas por (período, CUIT), así que
+consultar un mes de un CUIT lee sólo sus filas. El mismo comprobante
+(CUIT proveedor + tipo + letra + punto de venta + número) no se cuenta dos
+veces: si se vuelve a extraer, su aporte anterior se reemplaza.
+
+Las notas de crédito se suman aparte (van por tipo) y restan en el resumen.
+"""
+from layouts import fmt_date8
+
+
+TOTAL_COLUMNS = (
+    "neto_gravado",
+    "no_gravado",
+    "exento",
+    "iva",
+    "percepciones_iva",
+    "percepciones_iibb",
+    "percepciones_otras",
+    "total",
+)
+
+
+def _num(v) -> float:
+    if v in (None, "", "null"):
+        return 0.0
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _digits(v) -> str:
+    return "".join(ch for ch in str(v or "") if ch.isdigit())
+
+
+def periodo(fecha) -> str:
+    """'15/03/2025' -> '2025-03' ('0000-00' si no hay fecha legible)."""
+    d8 = fmt_date8(fecha)
+    return f"{d8[:4]}-{d8[4:6]}"
+
+
+def es_credito(tipo: str) -> bool:
+    t = (tipo or "").upper()
+    return "CRÉDITO" in t or "CREDITO" in t or t.startswith("N/C") or t.startswith("NC")
+
+
+def invoice_key(data: dict) -> str:
+    """Identidad del comprobante (para no contarlo dos veces)."""
+    dc = data.get("datos_comprobante", {}) or {}
+    em = data.get("emisor", {}) or {}
+    return "|".join((
+        _digits(em.get("cuit")),
+        (dc.get("tipo") or "").upper(),
+        (dc.get("letra") or "").upper(),
+        _digits(dc.get("punto_venta")).lstrip("0"),
+        _digits(dc.get("numero_comprobante")).lstrip("0"),
+    ))
+
+
+def _por_alicuota(tot: dict) -> dict:
+    """{alícuota: [neto, iva]} con todas las alícuotas de ivAs."""
+    rates = {}
+    for iva in tot.get("ivAs") or []:
+        alic = round(_num(iva.get("alicuota")), 2)
+        importe = _num(iva.get("importe_iva"))
+        if not alic and not importe:
+            continue
+        entry = rates.setdefault(alic, [0.0, 0.0])
+        entry[1] += importe
+        entry[0] += round(importe * 100 / alic, 2) if alic else 0.0
+
+    # El neto por alícuota no viene en el JSON: se deduce del IVA y la
+    # diferencia contra el neto gravado informado va a la alícuota mayor
+    neto = _num(tot.get("importe_neto_gravado"))
+    if rates and neto:
+        top = max(rates, key=lambda a: rates[a][1])
+        rates[top][0] += neto - sum(r[0] for r in rates.values())
+    return {a: [round(n, 2), round(i, 2)] for a, (n, i) in rates.items()}
+
+
+def invoice_contributions(data: dict):
+    """Aporte de un comprobante al libro, o None si no corresponde (error / sin CUIT)."""
+    if not data or data.get("error"):
+        return None
+    dc = data.get("datos_comprobante", {}) or {}
+    em = data.get("emisor", {}) or {}
+    rec = data.get("receptor", {}) or {}
+    tot = data.get("totales", {}) or {}
+    emisor = _digits(em.get("cuit"))
+    if not emisor:
+        return None
+
+    rates = _por_alicuota(tot)
+    return {
+        "clave": invoice_key(data),
+        "periodo": periodo(dc.get("fecha_emision")),
+        "receptor": _digits(rec.get("cuit")) or _digits(rec.get("numero_documento")),
+        "emisor": emisor,
+        "razon_social": em.get("razon_social") or "",
+        "letra": (dc.get("letra") or "").upper(),
+        "tipo": dc.get("tipo") or "",
+        "alicuotas": rates,
+        "totales": {
+            "neto_gravado": _num(tot.get("importe_neto_gravado")),
+            "no_gravado": _num(tot.get("importe_neto_no_gravado")),
+            "exento": _num(tot.get("importe_exento")),
+            "iva": round(sum(i for _, i in rates.values()), 2),
+            "percepciones_iva": _num(tot.get("percepciones_iva")),
+            "percepciones_iibb": _num(tot.get("percepciones_ingresos_brutos")),
+            "percepciones_otras": _num(tot.get("percepciones_otras")),
+            "total": _num(tot.get("total_comprobante")),
+        },
+    }
+
+
+def summarize(por_alicuota: list, por_comprobante: list) -> dict:
+    """
+    Arma la respuesta de una consulta a partir de las filas ya sumadas del
+    store (store.libro_iva_rows): por alícuota, por letra y tipo, por
+    proveedor y el resumen neto (notas de crédito restan).
+    """
+    alicuotas = {}
+    for r in por_alicuota:
+        sign = -1 if es_credito(r["tipo"]) else 1
+        entry = alicuotas.setdefault(r["alicuota"], {"alicuota": r["alicuota"], "neto": 0.0, "iva": 0.0})
+        entry["neto"] += sign * r["neto"]
+        entry["iva"] += sign * r["iva"]
+
+    por_tipo, proveedores = {}, {}
+    resumen = dict.fromkeys(TOTAL_COLUMNS, 0.0)
+    resumen["comprobantes"] = 0
+    for r in por_comprobante:
+        sign = -1 if es_credito(r["tipo"]) else 1
+        t = por_tipo.setdefault((r["letra"], r["tipo"]), {
+            "letra": r["letra"], "tipo": r["tipo"], "comprobantes": 0, **dict.fromkeys(TOTAL_COLUMNS, 0.0),
+        })
+        p = proveedores.setdefault(r["emisor"], {
+            "cuit": r["emisor"], "razon_social": r["razon_social"], "comprobantes": 0,
+            **dict.fromkeys(TOTAL_COLUMNS, 0.0),
+        })
+        for target in (t, p):
+            target["comprobantes"] += r["comprobantes"]
+        resumen["comprobantes"] += r["comprobantes"]
+        for col in TOTAL_COLUMNS:
+            t[col] += r[col]
+            p[col] += sign * r[col]
+            resumen[col] += sign * r[col]
+
+    def rounded(d: dict) -> dict:
+        return {k: round(v, 2) if isinstance(v, float) else v for k, v in d.items()}
+
+    return {
+        "por_alicuota": [rounded(a) for _, a in sorted(alicuotas.items())],
+        "por_tipo": [rounded(t) for _, t in sorted(por_tipo.items())],
+        "por_proveedor": [rounded(p) for _, p in sorted(proveedores.items())],
+        "resumen": rounded(resumen),
+    }
@@ -1,208 +1,928 @@
 import os
+import asyncio
 import base64
+import contextvars
+import copy
 import json
+import math
+import time
+from contextlib import asynccontextmanager
 from typing import List
-from fastapi import FastAPI, File, UploadFile, Request, Form
-from fastapi.responses import HTMLResponse
+
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, File, UploadFile, Request, Form, HTTPException
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from openai import OpenAI
-from datetime import datetime
 import re
-import fitz  # PyMuPDF
 
+from cpu_pool import (
+    classify_pdf_job,
+    image_to_pdf_job,
+    page_layout_job,
+    prepare_image_job,
+    release_ref,
+    render_pdf_job,
+    run_cpu,
+    shutdown as shutdown_cpu_pool,
+    take_ref,
+    to_ref,
+)
+from store import (
+    RESULT_FILTERS,
+    batch_events,
+    batch_progress,
+    close_batch,
+    count_results,
+    find_templates,
+    get_batch,
+    get_result,
+    iter_batch_results,
+    lane_stats,
+    libro_iva_periodos,
+    libro_iva_rows,
+    open_batch,
+    page_results,
+    read_task_file,
+    record_stage,
+    reusable_results,
+    save_template,
+    task_results,
+    task_timings,
+    template_hit,
+    template_miss,
+)
+from hedging import hedged_call, latency_stats
+from ingest import ingest_uploads
+from json_repair import repair_json
+from lanes import PriorityGate, upload_lane
+from libro_iva import summarize
+from profiling import ProfilingMiddleware, list_profiles, profile_path
+from layouts import RIGHT, compile_layout, field
+from supplier_templates import (
+    TEMPLATE_MAX_MISSES,
+    TEMPLATES_ENABLED,
+    apply_rules,
+    fingerprint,
+    layout_cuits,
+    learn_template,
+    match_template,
+)
+from payload import acquire_buffer, release_buffer, write_chat_body
+from invoice_schema import (
+    CONTINUE_PROMPT,
+    INVOICE_SCHEMA,
+    PACKED_RESPONSE_FORMAT,
+    PACKED_USER_PROMPT,
+    RESPONSE_FORMAT,
+    SYSTEM_PROMPT,
+    TILED_USER_HINT,
+    USER_PROMPT,
+    coerce_invoice,
+)
+
+
+MODEL = "gpt-4.1-mini"
+
+# Cascada de modelos: cada comprobante arranca con el primero (el más rápido y
+# barato) y pasa al siguiente sólo si el resultado no valida
+# (validation_failures: campos obligatorios, dígito verificador del CUIT,
+# control matemático). El último es el que responde si nadie valida.
+def parse_cascade(value: str) -> list:
+    """'a, b' -> ['a', 'b']; vacía (o sólo comas) -> [MODEL], para que nunca quede sin escalones."""
+    return [m.strip() for m in value.split(",") if m.strip()] or [MODEL]
+
+
+MODEL_CASCADE = parse_cascade(os.getenv("MODEL_CASCADE", f"gpt-4.1-nano,{MODEL}"))
+
+
+# ---------- Cliente del modelo (uno por proceso, perezoso) ----------
+# openai (~0.8 s de import) y la conexión se crean recién en la primera
+# llamada o en el warm-up del arranque: un worker que sólo sirve "/" no los
+# paga y la app levanta aunque no haya OPENAI_API_KEY.
+#
+#   LLM_MAX_CONNECTIONS   conexiones simultáneas al API
+#   LLM_MAX_KEEPALIVE     conexiones ociosas que se mantienen abiertas
+#   LLM_KEEPALIVE_SECONDS cuánto vive una conexión ociosa
+#   LLM_HTTP2             1 = HTTP/2 (si está instalado h2; si no, HTTP/1.1)
+#   LLM_TIMEOUT_SECONDS   timeout de lectura de una llamada
+#   LLM_WARMUP            1 = al arrancar se crea el cliente y se abre la conexión
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "16"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "90"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "1") == "1"
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "120"))
+LLM_WARMUP = os.getenv("LLM_WARMUP", "1") == "1"
+# Llamadas al modelo en vuelo por proceso; con espera, el turno va por carril (lanes.py)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", str(LLM_MAX_CONNECTIONS)))
+
+_model_gate = PriorityGate(LLM_MAX_CONCURRENCY)
+
+_client = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_client():
+    """El AsyncOpenAI compartido del proceso, con un pool de conexiones keep-alive."""
+    global _client
+    if _client is None:
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        http_client = DefaultAsyncHttpxClient(
+            http2=LLM_HTTP2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=5.0),
+        )
+        _client = AsyncOpenAI(http_client=http_client)
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.close()
+
+
+async def warm_up_client():
+    """
+    Crea el cliente y abre una conexión (GET /models, barato). Si falla, sigue
+    igual: el motivo queda en _startup["warm_error"] (se ve en /health).
+    """
+    if not os.getenv("OPENAI_API_KEY"):
+        return
+    try:
+        # El import de openai bloquea: fuera del event loop
+        client = await asyncio.to_thread(get_client)
+        await client.get("/models", cast_to=object)
+        _startup["warm"] = True
+        _startup["warm_error"] = None
+    except Exception as e:
+        _startup["warm_error"] = repr(e)
+
+
+# ---------- Ciclo de vida de la app ----------
+
+# Tiempos y estado del arranque: los expone /health
+_startup = {"import_ms": None, "startup_ms": None, "ready": False, "warm": False, "warm_error": None}
 
-client = OpenAI()  # o client = OpenAI(api_key="...")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Arranque: workers embebidos y warm-up del cliente en segundo plano (la app
+    atiende sin esperarlo). Cierre: workers, conexiones y pool de CPU.
+    """
+    started = time.perf_counter()
+    ensure_embedded_workers()
+    warm = asyncio.create_task(warm_up_client()) if LLM_WARMUP else None
+    _startup["startup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    _startup["ready"] = True
+    try:
+        yield
+    finally:
+        _startup["ready"] = False
+        if warm is not None:
+            warm.cancel()
+        await stop_embedded_workers()
+        await close_client()
+        shutdown_cpu_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ProfilingMiddleware)
 templates = Jinja2Templates(directory="templates")
 
 
-async def extract_invoice_data(image_bytes: bytes) -> dict:
-    b64_image = base64.b64encode(image_bytes).decode("utf-8")
-    image_url = f"data:image/jpeg;base64,{b64_image}"
-
-    system_prompt = """
-Eres un asistente contable especializado en facturación argentina.
-Extraes datos de comprobantes (facturas, notas de crédito/débito, tickets, etc.) a partir de una imagen.
-
-Devuelve SIEMPRE un JSON válido con la siguiente estructura (si algún dato no se ve, deja null o "" pero no inventes):
-
-{
-  "datos_comprobante": {
-    "tipo": "",
-    "letra": "",
-    "punto_venta": "",
-    "numero_comprobante": "",
-    "fecha_emision": "",
-    "fecha_vencimiento": "",
-    "condicion_venta": "",
-    "moneda": "",
-    "cotizacion_moneda": null
-  },
-  "emisor": {
-    "razon_social": "",
-    "cuit": "",
-    "domicilio_comercial": "",
-    "condicion_iva": "",
-    "condicion_ingresos_brutos": "",
-    "localidad": "",
-    "provincia": "",
-    "pais": ""
-  },
-  "receptor": {
-    "razon_social": "",
-    "cuit": "",
-    "domicilio_comercial": "",
-    "condicion_iva": "",
-    "condicion_ingresos_brutos": "",
-    "tipo_documento": "",
-    "numero_documento": ""
-  },
-  "totales": {
-    "importe_neto_gravado": null,
-    "importe_neto_no_gravado": null,
-    "importe_exento": null,
-    "ivAs": [
-      {
-        "alicuota": 21.0,
-        "importe_iva": null
-      }
-    ],
-    "percepciones_iva": null,
-    "percepciones_ingresos_brutos": null,
-    "percepciones_otras": null,
-    "descuentos_generales": null,
-    "subtotal": null,
-    "total_comprobante": null
-  },
-  "items": [
-    {
-      "codigo": "",
-      "descripcion": "",
-      "unidad_medida": "",
-      "cantidad": null,
-      "precio_unitario": null,
-      "bonificacion": null,
-      "alicuota_iva": null,
-      "importe_total_renglon": null
-    }
-  ],
-  "datos_fiscales_afip": {
-    "cae": "",
-    "fecha_vencimiento_cae": "",
-    "codigo_barras_qr": "",
-    "tipo_documento_receptor": "",
-    "numero_documento_receptor": ""
-  },
-  "datos_compras_importaciones": {
-    "condicion_bienes": "",
-    "centro_costo": "",
-    "numero_remito": "",
-    "numero_despacho_importacion": "",
-    "gastos_relacionados": ""
-  }
-}
-    """.strip()
-
-    user_prompt = """
-Extrae los datos del comprobante de la imagen adjunta.
-No expliques nada, solo responde con el JSON pedido.
-    """.strip()
-
-    response = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_prompt},
-                    {"type": "image_url", "image_url": {"url": image_url}},
-                ],
-            },
-        ],
+# Tareas de la cola que se están procesando en este contexto: las funciones de
+# extracción reportan su etapa (rendering / extracting) sin recibir el id.
+_current_tasks = contextvars.ContextVar("current_tasks", default=None)
+
+
+async def report_stage(stage: str):
+    """Registra la etapa de las tareas en curso (una vez por cambio de etapa)."""
+    cur = _current_tasks.get()
+    if cur is None or cur["stage"] == stage:
+        return
+    cur["stage"] = stage
+    await asyncio.to_thread(record_stage, cur["ids"], stage)
+
+
+async def post_chat(response_format: dict, parts: list, model: str = MODEL, followup: list = None) -> str:
+    """
+    Llama a chat/completions con el body armado en un PayloadBuffer
+    (payload.write_chat_body): el base64 de cada imagen se copia una sola vez
+    y el body viaja como memoryviews del buffer. Devuelve el contenido del mensaje.
+    Con deadline y hedging (hedging.hedged_call): el duplicado reusa el mismo body.
+
+    parts: lista de ("text", str) / ("image", ref_base64).
+    followup: mensajes después del del usuario (ver payload.write_chat_body).
+    """
+    from openai.types.chat import ChatCompletion
+
+    buf = acquire_buffer()
+    try:
+        write_chat_body(buf, model, response_format, SYSTEM_PROMPT, parts, followup=followup)
+
+        def call():
+            return get_client().post(
+                "/chat/completions",
+                cast_to=ChatCompletion,
+                content=buf.async_chunks(),
+                options={
+                    "headers": {
+                        "Content-Type": "application/json",
+                        "Content-Length": str(len(buf)),
+                    },
+                },
+            )
+
+        # La latencia depende sobre todo de cuántas imágenes van en la llamada
+        n_images = sum(1 for kind, _ in parts if kind == "image")
+        started = time.perf_counter()
+        info = {}
+        async with _model_gate.slot():
+            response = await hedged_call(call, key=(model, min(n_images, 8)), info=info)
+        _record_model_call(model, time.perf_counter() - started, response.usage)
+        for _ in range(info.get("requests", 1) - 1):
+            _record_hedge_request(model, response.usage)
+    finally:
+        release_buffer(buf)
+    return response.choices[0].message.content
+
+
+# ---------- Cascada de modelos ----------
+
+# Por modelo (en este proceso): llamadas, tiempo y tokens; y, de las
+# extracciones que pasaron por ese escalón, cuántas validaron y cuántas subieron
+_model_stats = {}
+
+
+def _model_entry(model: str) -> dict:
+    return _model_stats.setdefault(model, {
+        "calls": 0, "hedge_calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0,
+        "extractions": 0, "ok": 0, "escalated": 0,
+    })
+
+
+def _record_model_call(model: str, seconds: float, usage):
+    st = _model_entry(model)
+    st["calls"] += 1
+    st["seconds"] += seconds
+    if usage is not None:
+        st["prompt_tokens"] += usage.prompt_tokens or 0
+        st["completion_tokens"] += usage.completion_tokens or 0
+
+
+def _record_hedge_request(model: str, usage):
+    """
+    El request duplicado por hedging (el que perdió y se canceló): mandó el
+    mismo body, así que su entrada se cobra igual que la del que ganó. Lo que
+    llegó a generar antes de cancelarse no se conoce y no se cuenta.
+    """
+    st = _model_entry(model)
+    st["hedge_calls"] += 1
+    if usage is not None:
+        st["prompt_tokens"] += usage.prompt_tokens or 0
+
+
+def _record_tier_result(model: str, failures: list, escalated: bool):
+    st = _model_entry(model)
+    st["extractions"] += 1
+    st["ok"] += not failures
+    st["escalated"] += escalated
+
+
+def cascade_stats() -> dict:
+    """Tasa de éxito, latencia media y tokens por escalón de la cascada (para /health)."""
+    out = {}
+    for model, st in _model_stats.items():
+        out[model] = {
+            **st,
+            "seconds": round(st["seconds"], 2),
+            "success_rate": round(st["ok"] / st["extractions"], 3) if st["extractions"] else None,
+            "avg_seconds": round(st["seconds"] / st["calls"], 2) if st["calls"] else None,
+        }
+    return {"cascada": MODEL_CASCADE, "modelos": out}
+
+
+async def extract_cascade(parts: list, start_tier: int = 0, meta: dict = None) -> dict:
+    """
+    Extrae un comprobante subiendo por MODEL_CASCADE desde `start_tier` hasta
+    que el resultado valide. Si se pasa `meta`, anota el modelo que respondió,
+    su escalón y los intentos con el motivo de cada escalada.
+    """
+    start_tier = min(start_tier, len(MODEL_CASCADE) - 1)
+    attempts = []
+    for tier in range(start_tier, len(MODEL_CASCADE)):
+        model = MODEL_CASCADE[tier]
+        content = await post_chat(RESPONSE_FORMAT, parts, model=model)
+        data, fixes = await parse_with_continuation(content, parts, model)
+        failures = validation_failures(data)
+        last = tier == len(MODEL_CASCADE) - 1
+        _record_tier_result(model, failures, escalated=bool(failures) and not last)
+        attempts.append({"model": model, "fallas": failures, **({"json": fixes} if fixes else {})})
+        if not failures:
+            break
+
+    if meta is not None:
+        meta.update({"model": model, "model_tier": tier, "model_attempts": attempts})
+    return data
+
+
+async def prepare_images(images: List[bytes]) -> List[dict]:
+    """
+    Pasa las imágenes por el pool de CPU: devuelve por cada una
+    {"b64": ref, "width": int, "height": int}, o con "error" (y b64 None) si
+    este proceso no la puede leer. Los refs los libera quien los usa
+    (release_images).
+    """
+    await report_stage("rendering")
+    refs = [to_ref(img) for img in images]
+    try:
+        preps = await asyncio.gather(*(run_cpu(prepare_image_job, ref) for ref in refs), return_exceptions=True)
+    finally:
+        for ref in refs:
+            release_ref(ref)
+    failed = [p for p in preps if isinstance(p, BaseException)]
+    if failed:
+        # Las que sí salieron ya dejaron su base64 en el spool: no lo usa nadie
+        release_images([p["b64"] for p in preps if not isinstance(p, BaseException)])
+        raise failed[0]
+    return list(preps)
+
+
+def release_images(refs: list):
+    for ref in refs:
+        release_ref(ref)
+
+
+async def extract_invoice_data(image_bytes: bytes, more_pages: List[bytes] = None, hint: str = None,
+                               meta: dict = None) -> dict:
+    """
+    Extrae UN comprobante. `more_pages` son hojas siguientes (o recortes) del
+    mismo comprobante; `hint` es un texto extra que las describe.
+    """
+    preps = await prepare_images([image_bytes] + list(more_pages or []))
+    refs = [p["b64"] for p in preps]
+    unreadable = [p["error"] for p in preps if p.get("error")]
+    if unreadable:
+        release_images(refs)
+        return {"error": f"No se pudo leer la imagen: {unreadable[0]}"}
+    try:
+        return await extract_invoice_b64(refs, hint=hint, meta=meta)
+    finally:
+        release_images(refs)
+
+
+async def extract_invoice_b64(images_b64: list, hint: str = None, start_tier: int = 0,
+                              meta: dict = None) -> dict:
+    """Igual que extract_invoice_data, con las imágenes ya en base64 (refs del pool)."""
+    parts = [("text", USER_PROMPT)]
+    if hint:
+        parts.append(("text", hint))
+    for ref in images_b64:
+        parts.append(("image", ref))
+
+    # Prompt y formato salen de invoice_schema (constantes => cache de prefijo)
+    await report_stage("extracting")
+    return await extract_cascade(parts, start_tier=start_tier, meta=meta)
+
+
+def load_response(content: str):
+    """(objeto | None, arreglos, cortado): json.loads y, si falla, reparación local (json_repair)."""
+    try:
+        return json.loads(content), [], False
+    except (json.JSONDecodeError, TypeError):
+        return repair_json(content)
+
+
+def parse_invoice_response(content: str) -> dict:
+    """Parsea la respuesta de la IA y la normaliza al esquema (todas las claves, tipos fijos)."""
+    raw, _, _ = load_response(content)
+    if not isinstance(raw, dict):
+        return {"error": "No se pudo parsear la respuesta de la IA", "raw": content}
+
+    return coerce_invoice(raw)
+
+
+# Pedidos de "continuá" por respuesta cortada (0 = sólo reparación local)
+JSON_MAX_CONTINUATIONS = int(os.getenv("JSON_MAX_CONTINUATIONS", "1"))
+
+# Respuestas que no parsearon tal cual y qué se hizo con ellas (para /health)
+_repair_stats = {"reparadas": 0, "cortadas": 0, "continuaciones": 0, "continuaciones_ok": 0, "perdidas": 0}
+
+
+def _strip_fence(text: str) -> str:
+    """Saca un ``` de apertura / cierre sin tocar el resto (el espacio inicial puede ser parte de un texto)."""
+    text = text or ""
+    if text.lstrip().startswith("```"):
+        text = text.lstrip().partition("\n")[2]
+    if text.rstrip().endswith("```"):
+        text = text.rstrip()[:-3]
+    return text
+
+
+_RESTART_RE = re.compile(r'\s*\{\s*"(\w+)"')
+
+
+async def parse_with_continuation(content: str, parts: list, model: str):
+    """
+    Como parse_invoice_response, pero si la respuesta vino cortada le pide al
+    mismo modelo que la continúe (no que empiece de nuevo: sólo se pagan los
+    tokens de salida que faltaban) hasta JSON_MAX_CONTINUATIONS veces. Si aun
+    así no cierra, se queda con la versión cerrada localmente.
+    Devuelve (datos, arreglos aplicados).
+    """
+    raw, fixes, truncated = load_response(content)
+    if fixes:
+        _repair_stats["reparadas"] += 1
+    if truncated:
+        _repair_stats["cortadas"] += 1
+        for _ in range(JSON_MAX_CONTINUATIONS):
+            _repair_stats["continuaciones"] += 1
+            more = _strip_fence(await post_chat(
+                None, parts, model=model,
+                followup=[("assistant", content), ("user", CONTINUE_PROMPT)],
+            ))
+            # Si en vez de continuarla la rehízo entera, se toma la nueva
+            restart = _RESTART_RE.match(more)
+            content = more if restart and restart.group(1) in INVOICE_SCHEMA else content + more
+            joined, joined_fixes, truncated = load_response(content)
+            if isinstance(joined, dict):
+                raw, fixes = joined, sorted(set(joined_fixes) | {"continuado"})
+            if not truncated:
+                _repair_stats["continuaciones_ok"] += 1
+                break
+
+    if not isinstance(raw, dict):
+        _repair_stats["perdidas"] += 1
+        return {"error": "No se pudo parsear la respuesta de la IA", "raw": content}, fixes
+    return coerce_invoice(raw), fixes
+
+
+# Tope de hojas que se mandan por comprobante (el resto suele ser más ítems)
+PDF_MAX_PAGES_PER_INVOICE = int(os.getenv("PDF_MAX_PAGES_PER_INVOICE", "3"))
+
+# ---------- Resolución adaptativa ----------
+# Se arranca con una resolución baja (lado largo ~PDF_START_LONG_EDGE px) y se
+# sube por la escalera de DPI sólo si el resultado no pasa el control
+# matemático o vuelve sin los campos clave.
+PDF_START_LONG_EDGE = int(os.getenv("PDF_START_LONG_EDGE", "1100"))
+PDF_DPI_LADDER = [int(x) for x in os.getenv("PDF_DPI_LADDER", "100,150,200,300").split(",")]
+
+
+def _start_dpi(long_edge_pt: float) -> int:
+    dpi = round(PDF_START_LONG_EDGE * 72 / (long_edge_pt or 842))
+    return max(PDF_DPI_LADDER[0], min(dpi, PDF_DPI_LADDER[-1]))
+
+
+# ---------- Recortes por región (facturas densas) ----------
+# "auto": recorta sólo páginas con tabla de ítems larga; "on": siempre que se
+# reconozcan las regiones; "off": página entera como antes.
+ROI_TILING = os.getenv("ROI_TILING", "auto").lower()
+
+# Resolución de cada recorte relativa al DPI del intento: el encabezado se lee
+# bien con menos, los números de la tabla piden más. Como además se recortan
+# los márgenes, el total de píxeles queda por debajo de la página entera.
+ROI_DPI_FACTORS = {"encabezado": 0.6, "items": 1.15, "totales": 0.85}
+
+
+async def _render_pages(pdf_ref, pages: List[int], dpi: int) -> dict:
+    """
+    Renderiza (en el pool de CPU) las hojas de un comprobante.
+    Devuelve {"images_b64": [refs], "tiled": bool, "payload_bytes": int}:
+    con ROI_TILING cada página densa va como 3 recortes en vez de entera.
+    """
+    await report_stage("rendering")
+    out = await run_cpu(
+        render_pdf_job,
+        pdf_ref,
+        pages,
+        dpi,
+        ROI_TILING,
+        ROI_DPI_FACTORS,
+        PDF_DPI_LADDER[-1],
+        PDF_MAX_PAGES_PER_INVOICE,
     )
+    return out
+
+
+def cuit_valido(cuit) -> bool:
+    """Dígito verificador del CUIT/CUIL (módulo 11)."""
+    digits = "".join(ch for ch in str(cuit or "") if ch.isdigit())
+    if len(digits) != 11:
+        return False
+    total = sum(int(d) * w for d, w in zip(digits, (5, 4, 3, 2, 7, 6, 5, 4, 3, 2)))
+    dv = 11 - total % 11
+    dv = {11: 0, 10: 9}.get(dv, dv)
+    return dv == int(digits[10])
+
+
+def validation_failures(data: dict) -> list:
+    """
+    Motivos por los que un resultado no es confiable ([] = valida): error,
+    campos obligatorios vacíos, CUIT del emisor con dígito verificador
+    inválido o matemática que no cierra (sin ítems sólo se controla que los
+    totales sumen el total).
+    """
+    if not data or data.get("error"):
+        return ["error"]
+
+    dc = data.get("datos_comprobante", {}) or {}
+    em = data.get("emisor", {}) or {}
+    tot = data.get("totales", {}) or {}
+    failures = []
+    if not em.get("cuit") or not dc.get("numero_comprobante") or tot.get("total_comprobante") in (None, ""):
+        failures.append("campos_obligatorios")
+    elif not cuit_valido(em["cuit"]):
+        failures.append("cuit")
+    if failures:
+        return failures
+
+    mc = check_math(data)
+    if data.get("items") and not mc["ok"]:
+        failures.append("matematica")
+    elif abs(mc["total_diff_teorico_vs_json"]) > 0.10:
+        failures.append("matematica")
+    return failures
+
+
+def needs_better_resolution(data: dict) -> bool:
+    """¿Vale la pena re-leer con más DPI? Sí si el resultado no valida."""
+    return bool(validation_failures(data))
+
+
+def is_unidentified(data: dict) -> bool:
+    """Lectura sin error pero sin CUIT del emisor ni número: no es el encabezado de un comprobante."""
+    if not data or data.get("error"):
+        return False
+    dc = data.get("datos_comprobante", {}) or {}
+    em = data.get("emisor", {}) or {}
+    return not str(em.get("cuit") or "").strip() and not str(dc.get("numero_comprobante") or "").strip()
+
+
+def merge_continuation(data: dict, cont: dict):
+    """
+    Suma a `data` la lectura de una hoja de continuación: sus ítems van al
+    final y de totales / datos fiscales se toma lo que falte (el pie con el
+    total y el CAE suele estar en la última hoja).
+    """
+    data.setdefault("items", []).extend(cont.get("items") or [])
+    for section in ("totales", "datos_fiscales_afip"):
+        dst = data.setdefault(section, {})
+        for k, v in (cont.get(section) or {}).items():
+            # 0 también cuenta como faltante: coerce_invoice completa con 0 los importes sin dato
+            if dst.get(k) in (None, "", [], 0) and v not in (None, "", [], 0):
+                dst[k] = v
+
 
-async def extract_invoice_data_from_pdf(pdf_bytes: bytes) -> dict:
+async def extract_invoice_data_from_pdf(pdf_bytes: bytes, pages: List[int] = None, dpi: int = 200) -> dict:
     """
-    Toma un PDF en bytes, renderiza la primera página a imagen
-    y reutiliza extract_invoice_data para que la IA lea la factura.
+    Toma un PDF en bytes, renderiza las páginas indicadas (por defecto la
+    primera) a `dpi` y reutiliza extract_invoice_data para que la IA lea la factura.
     """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    if doc.page_count == 0:
+    pdf_ref = to_ref(pdf_bytes)
+    try:
+        rendered = await _render_pages(pdf_ref, pages or [0], dpi)
+    finally:
+        release_ref(pdf_ref)
+    if not rendered["images_b64"]:
         return {"error": "PDF sin páginas"}
 
-    # Por ahora solo usamos la primera página (MVP)
-    page = doc.load_page(0)
-    pix = page.get_pixmap(dpi=200)  # resolución razonable para OCR
-    img_bytes = pix.tobytes("jpeg")
+    hint = TILED_USER_HINT if rendered["tiled"] else None
+    try:
+        return await extract_invoice_b64(rendered["images_b64"], hint=hint)
+    finally:
+        release_images(rendered["images_b64"])
+
 
-    data = await extract_invoice_data(img_bytes)
-    return data
+async def extract_invoice_adaptive(pdf_ref, pages: List[int], long_edge_pt: float, may_continue: bool = False):
+    """
+    Extrae un comprobante subiendo la resolución sólo cuando hace falta.
+    Devuelve (data, meta) con el DPI elegido y los bytes de imagen enviados.
+
+    may_continue: la hoja puede ser continuación del comprobante anterior
+    (escaneo sin texto). Si la primera lectura no trae CUIT ni número no se
+    sube el DPI: vuelve con meta["continuation"] para que se sume al anterior.
+    """
+    dpi = _start_dpi(long_edge_pt)
+    ladder = [dpi] + [d for d in PDF_DPI_LADDER if d > dpi]
+
+    attempts = []
+    data = None
+    tier = 0
+    for dpi in ladder:
+        rendered = await _render_pages(pdf_ref, pages, dpi)
+        hint = TILED_USER_HINT if rendered["tiled"] else None
+        cascade = {}
+        try:
+            # Con más DPI se sigue desde el modelo al que ya se había llegado
+            data = await extract_invoice_b64(rendered["images_b64"], hint=hint, start_tier=tier, meta=cascade)
+        finally:
+            release_images(rendered["images_b64"])
+        tier = cascade["model_tier"]
+        attempts.append({
+            "dpi": dpi,
+            "payload_bytes": rendered["payload_bytes"],
+            "tiled": rendered["tiled"],
+            "model_attempts": cascade["model_attempts"],
+        })
+        if not needs_better_resolution(data) or (may_continue and is_unidentified(data)):
+            break
+
+    meta = {
+        "dpi": attempts[-1]["dpi"],
+        "payload_bytes": attempts[-1]["payload_bytes"],
+        "tiled": attempts[-1]["tiled"],
+        "model": cascade["model"],
+        "dpi_attempts": attempts,
+    }
+    if may_continue and is_unidentified(data):
+        meta["continuation"] = True
+    return data, meta
+
+
+# ---------- Plantillas por proveedor (supplier_templates.py) ----------
+# Un PDF digital de un proveedor conocido, con el mismo diseño que uno ya
+# validado, se lee localmente; el modelo queda para cuando la plantilla falla.
+
+async def extract_invoice_templated(pdf_ref, inv: dict, may_continue: bool = False):
+    """extract_invoice_adaptive, probando antes una plantilla aprendida. Devuelve (data, meta)."""
+    layout = None
+    if TEMPLATES_ENABLED:
+        layout = await run_cpu(page_layout_job, pdf_ref, inv["pages"][0])
+
+    tpl = None
+    if layout:
+        t0 = time.perf_counter()
+        tpl = match_template(layout, await asyncio.to_thread(find_templates, layout_cuits(layout)))
+        if tpl:
+            raw = apply_rules(tpl["fields"], layout)
+            data = coerce_invoice(raw) if raw else None
+            if data and not validation_failures(data):
+                await asyncio.to_thread(template_hit, tpl["cuit"], tpl["fingerprint"])
+                return data, {
+                    "template": {"cuit": tpl["cuit"], "fingerprint": tpl["fingerprint"],
+                                 "similarity": tpl["similarity"]},
+                    "template_ms": round((time.perf_counter() - t0) * 1000, 1),
+                }
+            await asyncio.to_thread(template_miss, tpl["cuit"], tpl["fingerprint"], TEMPLATE_MAX_MISSES)
+
+    data, meta = await extract_invoice_adaptive(pdf_ref, inv["pages"], inv["long_edge_pt"], may_continue)
+    if tpl:
+        meta["template_miss"] = tpl["fingerprint"]
+
+    # Extracción validada de un PDF digital: se aprende (o re-aprende) la plantilla
+    if layout and not validation_failures(data):
+        cuit = "".join(ch for ch in data["emisor"]["cuit"] if ch.isdigit())
+        fields = learn_template(data, layout) if cuit in layout_cuits(layout) else None
+        if fields:
+            fp, tokens = fingerprint(layout, fields)
+            if tpl and tpl["cuit"] == cuit:
+                fp = tpl["fingerprint"]  # la plantilla que falló se corrige en su lugar
+            await asyncio.to_thread(save_template, cuit, fp, tokens, fields)
+            meta["template_learned"] = fp
+    return data, meta
+
+
+async def extract_invoices_from_pdf(pdf_bytes: bytes) -> List[dict]:
+    """
+    Clasifica las páginas localmente (pdf_pages.classify_pdf) y hace UNA
+    llamada por comprobante distinto: descarta hojas en blanco, no fiscales
+    (remitos, términos) y copias DUPLICADO/TRIPLICADO, y separa los lotes
+    escaneados con varios comprobantes. Cada comprobante se lee con
+    resolución adaptativa (extract_invoice_adaptive); una hoja escaneada que
+    no trae CUIT ni número se suma al comprobante anterior (merge_continuation).
+
+    Clasificación y render corren en el pool de CPU; el PDF viaja una sola
+    vez por archivo temporal si es grande.
 
-    content = response.choices[0].message.content
+    Devuelve una lista de {"data": ..., "meta": {"pages": [...], "dpi": ..., ...}}.
+    """
+    pdf_ref = to_ref(pdf_bytes)
     try:
-        data = json.loads(content)
-    except json.JSONDecodeError:
-        data = {"error": "No se pudo parsear la respuesta de la IA", "raw": content}
+        plan = await run_cpu(classify_pdf_job, pdf_ref)
+        if plan["page_count"] == 0:
+            return [{"data": {"error": "PDF sin páginas"}, "meta": {}}]
+
+        if not plan["invoices"]:
+            return [{
+                "data": {"error": "El PDF no tiene páginas de comprobantes"},
+                "meta": {"skipped_pages": plan["skipped"]},
+            }]
+
+        out = []
+        for inv in plan["invoices"]:
+            # Una hoja escaneada sin encabezado propio es continuación de la anterior
+            may_continue = bool(inv.get("scan") and out and not out[-1]["data"].get("error"))
+            data, meta = await extract_invoice_templated(pdf_ref, inv, may_continue)
+            if meta.get("continuation"):
+                prev = out[-1]
+                merge_continuation(prev["data"], data)
+                prev["meta"]["pages"] = prev["meta"]["pages"] + inv["pages"]
+                prev["meta"].setdefault("continuation_pages", []).extend(inv["pages"])
+                continue
+            meta.update({"pages": inv["pages"], "copy": inv["copy"]})
+            out.append({"data": data, "meta": meta})
+    finally:
+        release_ref(pdf_ref)
+
+    # Las páginas descartadas se informan una sola vez, en el primer comprobante
+    out[0]["meta"]["skipped_pages"] = plan["skipped"]
+    return out
+
+
+# ---------- Empaquetado de tickets chicos en un solo request ----------
+# Para tickets chicos (supermercado, peajes) pesa más el overhead del request
+# (prompt, ida y vuelta, TLS) que la imagen. Se agrupan N imágenes en una
+# sola llamada y se pide un array de comprobantes.
+
+PACK_MAX_BYTES = int(os.getenv("PACK_MAX_BYTES", "350000"))      # imagen "chica"
+PACK_MAX_IMAGES = int(os.getenv("PACK_MAX_IMAGES", "6"))         # tope por request
+PACK_TOKEN_BUDGET = int(os.getenv("PACK_TOKEN_BUDGET", "6000"))  # tokens de imagen por request
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """
+    Estimación de tokens de una imagen para gpt-4.1-mini:
+    parches de 32x32 (tope 1536) por el multiplicador del modelo (1.62).
+    """
+    patches = math.ceil(width / 32) * math.ceil(height / 32)
+    if patches > 1536:
+        # el proveedor achica la imagen hasta entrar en 1536 parches
+        scale = math.sqrt(1536 / patches)
+        patches = math.ceil(width * scale / 32) * math.ceil(height * scale / 32)
+        patches = min(patches, 1536)
+    return math.ceil(patches * 1.62)
 
-    return data
 
+def is_packable_image(image_bytes: bytes) -> bool:
+    return PACK_MAX_IMAGES > 1 and len(image_bytes) <= PACK_MAX_BYTES
 
-# ---------- NUEVO: construcción del .txt para importación ----------
 
-def build_txt_line(data: dict) -> str:
-    """Arma una línea de texto con campos separados por ';' para importación masiva."""
-    dc = data.get("datos_comprobante", {})
-    em = data.get("emisor", {})
-    rec = data.get("receptor", {})
-    tot = data.get("totales", {})
+def image_tokens(prep: dict) -> int:
+    """Tokens estimados de una imagen ya preparada (prepare_images)."""
+    if not prep.get("width") or not prep.get("height"):
+        # no se pudo leer el tamaño: asumimos el peor caso
+        return estimate_image_tokens(2048, 2048)
+    return estimate_image_tokens(prep["width"], prep["height"])
 
-    # Cuit o DNI del receptor (si es CF con DNI lo podés ajustar en el prompt)
-    cuit_o_doc_receptor = rec.get("cuit") or rec.get("numero_documento") or ""
+
+def plan_pack_groups(tokens: List[int]) -> List[List[int]]:
+    """
+    Agrupa índices de imágenes (según sus tokens estimados) en requests,
+    llenando cada grupo hasta el presupuesto de tokens o PACK_MAX_IMAGES (más
+    comprobantes por segundo sin pasarnos de contexto). Las más grandes van
+    primero para empaquetar mejor.
+    """
+    order = sorted(range(len(tokens)), key=lambda i: tokens[i], reverse=True)
+
+    groups = []
+    current, current_tokens = [], 0
+    for i in order:
+        if current and (
+            len(current) >= PACK_MAX_IMAGES
+            or current_tokens + tokens[i] > PACK_TOKEN_BUDGET
+        ):
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens[i]
+    if current:
+        groups.append(current)
+    return groups
+
+
+async def extract_invoices_packed(images: List[bytes], metas: List[dict] = None) -> List[dict]:
+    """
+    Extrae varios comprobantes con UNA llamada (una parte de imagen por archivo).
+    `images` van ya en base64 (prepare_images). Devuelve los datos en el mismo
+    orden. Si la respuesta no trae exactamente un comprobante por imagen, se
+    vuelve a llamadas individuales.
+
+    El paquete va al primer modelo de la cascada; cada comprobante que no
+    valida se re-lee solo, desde el escalón siguiente. `metas` (uno por
+    imagen) recibe el modelo que respondió cada uno.
+    """
+    metas = metas if metas is not None else [{} for _ in images]
+    if len(images) == 1:
+        return [await extract_invoice_b64(images, meta=metas[0])]
+
+    parts = [("text", PACKED_USER_PROMPT)]
+    for n, ref in enumerate(images, start=1):
+        parts.append(("text", f"Imagen {n}:"))
+        parts.append(("image", ref))
+
+    await report_stage("extracting")
+    model = MODEL_CASCADE[0]
+    content = await post_chat(PACKED_RESPONSE_FORMAT, parts, model=model)
+
+    by_image = {}
+    try:
+        # Reparación local sólo: si vino cortado falta algún comprobante y
+        # cada imagen se extrae sola (abajo)
+        comprobantes = load_response(content)[0].get("comprobantes") or []
+        for comp in comprobantes:
+            by_image[comp.get("imagen")] = comp
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        comprobantes = []
+
+    if len(comprobantes) != len(images) or set(by_image) != set(range(1, len(images) + 1)):
+        # No se puede asignar cada comprobante a su archivo con certeza
+        return [await extract_invoice_b64([img], meta=meta) for img, meta in zip(images, metas)]
+
+    out = []
+    for n, (img, meta) in enumerate(zip(images, metas), start=1):
+        data = coerce_invoice(by_image[n])
+        failures = validation_failures(data)
+        escalate = bool(failures) and len(MODEL_CASCADE) > 1
+        _record_tier_result(model, failures, escalated=escalate)
+        attempts = [{"model": model, "fallas": failures}]
+        if escalate:
+            data = await extract_invoice_b64([img], start_tier=1, meta=meta)
+            attempts += meta["model_attempts"]
+        else:
+            meta.update({"model": model, "model_tier": 0})
+        meta["model_attempts"] = attempts
+        out.append(data)
+    return out
+
+
+# ---------- Exportaciones: layouts declarativos (motor en layouts.py) ----------
+# Cada archivo de exportación es una spec (lista de campos) compilada una vez
+# a una función por línea. Lo que no sale directo del JSON (mapeos, netos
+# recalculados, etc.) lo calcula la función que arma el registro.
+
+# ---------- TXT genérico (CSV con ';') ----------
+
+GENERIC_LAYOUT = {
+    "name": "generico",
+    "kind": "delimited",
+    "sep": ";",
+    "header": True,
+    "fields": [
+        field("fecha_emision", source="dc.fecha_emision", label="FECHA_EMISION"),
+        field("tipo", source="dc.tipo", label="TIPO"),
+        field("letra", source="dc.letra", label="LETRA"),
+        field("punto_venta", source="dc.punto_venta", label="PTO_VTA"),
+        field("numero", source="dc.numero_comprobante", label="NRO"),
+        field("cuit_emisor", source="em.cuit", label="CUIT_EMISOR"),
+        field("razon_emisor", source="em.razon_social", label="RAZON_EMISOR"),
+        # Cuit o DNI del receptor (si es CF con DNI lo podés ajustar en el prompt)
+        field("doc_receptor", source="doc_receptor", label="CUIT_O_DNI_RECEPTOR"),
+        field("razon_receptor", source="rec.razon_social", label="RAZON_RECEPTOR"),
+        field("neto_gravado", source="tot.importe_neto_gravado", label="NETO_GRAVADO"),
+        field("iva_21", source="iva_21", label="IVA_21"),
+        field("total", source="tot.total_comprobante", label="TOTAL"),
+    ],
+}
+
+_generic_line = compile_layout(GENERIC_LAYOUT)
+
+# Encabezado (opcional, borralo si tu sistema no lo admite)
+TXT_HEADER = _generic_line.header
+
+
+def _generic_record(data: dict) -> dict:
+    tot = data.get("totales", {}) or {}
+    rec = data.get("receptor", {}) or {}
 
     # Toma el primer IVA como referencia (generalmente 21%)
     ivas = tot.get("ivAs") or []
-    iva_21 = ""
-    if ivas:
-        iva_21 = ivas[0].get("importe_iva") or ""
-    
-    def to_str(v):
-        return "" if v is None else str(v)
-
-    fields = [
-        dc.get("fecha_emision", ""),
-        dc.get("tipo", ""),
-        dc.get("letra", ""),
-        dc.get("punto_venta", ""),
-        dc.get("numero_comprobante", ""),
-        em.get("cuit", ""),
-        em.get("razon_social", ""),
-        cuit_o_doc_receptor,
-        rec.get("razon_social", ""),
-        to_str(tot.get("importe_neto_gravado")),
-        to_str(iva_21),
-        to_str(tot.get("total_comprobante")),
-    ]
+    iva_21 = (ivas[0].get("importe_iva") or "") if ivas else ""
 
-    # Reemplaza ';' dentro de textos por ',' para no romper el formato
-    safe_fields = [str(f).replace(";", ",") for f in fields]
+    return {
+        "dc": data.get("datos_comprobante", {}) or {},
+        "em": data.get("emisor", {}) or {},
+        "rec": rec,
+        "tot": tot,
+        "doc_receptor": rec.get("cuit") or rec.get("numero_documento") or "",
+        "iva_21": iva_21,
+    }
 
-    return ";".join(safe_fields)
+
+def build_txt_line(data: dict) -> str:
+    """Arma una línea de texto con campos separados por ';' para importación masiva."""
+    return _generic_line(_generic_record(data))
 
 
 def build_txt_content(results: List[dict]) -> str:
     """Arma todo el contenido del .txt a partir de la lista de resultados."""
-    lines = []
-
-    # Encabezado (opcional, borralo si tu sistema no lo admite)
-    header = (
-        "FECHA_EMISION;TIPO;LETRA;PTO_VTA;NRO;"
-        "CUIT_EMISOR;RAZON_EMISOR;CUIT_O_DNI_RECEPTOR;"
-        "RAZON_RECEPTOR;NETO_GRAVADO;IVA_21;TOTAL"
-    )
-    lines.append(header)
+    lines = [TXT_HEADER]
 
     for item in results:
         data = item.get("data", {})
@@ -211,6 +931,7 @@ def build_txt_content(results: List[dict]) -> str:
 
     return "\n".join(lines)
 
+
 def _to_float(v):
     if v in (None, "", "null"):
         return 0.0
@@ -300,161 +1021,56 @@ def check_math(data: dict, tol: float = 0.10) -> dict:
         "total_diff_teorico_vs_json": round(total_diff_teorico_vs_json, 2),
     }
 
-# ---------- Layouts por sistema contable ----------
-
-# ---------- Layout HOLISTOR ----------
-
-# ---------- Layout HOLISTOR (Libro IVA Compras, Anexo I) ----------
-
-def build_txt_line_holistor(data: dict) -> str:
-    dc = data.get("datos_comprobante", {})
-    em = data.get("emisor", {})
-    rec = data.get("receptor", {})
-    tot = data.get("totales", {})
-    afip = data.get("datos_fiscales_afip", {})
-
-    def s(v):
-        return "" if v is None else str(v)
-
-    # Datos básicos
-    fecha_emision = dc.get("fecha_emision", "")              # Fecha Emisión
-    fecha_recepcion = fecha_emision                          # por ahora usamos la misma
-
-    nombre_comprobante = dc.get("tipo", "")                  # "Factura", "Nota de crédito", etc.
-    tipo_comprobante = dc.get("letra", "")                   # A / B / C
-
-    sucursal = dc.get("punto_venta", "")                     # Número Sucursal
-    numero = dc.get("numero_comprobante", "")                # Número de Comprobante
-
-    # Totales
-    neto_gravado = tot.get("importe_neto_gravado")
-    no_gravado = tot.get("importe_neto_no_gravado")
-    exento = tot.get("importe_exento")
-    total = tot.get("total_comprobante")
-
-    # IVA (sumamos todos los IVA)
-    ivas = tot.get("ivAs") or []
-    tasa_iva = ""
-    iva_liquidado = 0.0
-    for iva in ivas:
-        if tasa_iva == "" and iva.get("alicuota") is not None:
-            tasa_iva = s(iva.get("alicuota"))
-        imp = iva.get("importe_iva")
-        if isinstance(imp, (int, float)):
-            iva_liquidado += imp or 0.0
-        elif isinstance(imp, str):
-            try:
-                iva_liquidado += float(imp.replace(",", "."))
-            except Exception:
-                pass
-
-    credito_fiscal = iva_liquidado  # en compras suele coincidir
-
-    # Percepciones (sumamos todas las que tengas)
-    percep_total = 0.0
-    for key in ("percepciones_iva", "percepciones_ingresos_brutos", "percepciones_otras"):
-        val = tot.get(key)
-        if isinstance(val, (int, float)):
-            percep_total += val or 0.0
-        elif isinstance(val, str):
-            try:
-                percep_total += float(val.replace(",", "."))
-            except Exception:
-                pass
-
-    # Proveedor
-    condicion_fiscal = em.get("condicion_iva", "")
-    cuit_proveedor = em.get("cuit", "")
-    nombre_proveedor = em.get("razon_social", "")
-    domicilio_proveedor = em.get("domicilio_comercial", "")
-    codigo_postal = ""                                        # no lo tenemos desglosado
-    provincia = em.get("provincia", "")
-
-    # Documento
-    tipo_doc_cliente = "80" if cuit_proveedor else ""
-
-    # Moneda
-    moneda = dc.get("moneda", "") or ""
-    tipo_cambio = dc.get("cotizacion_moneda", None)
-
-    # CAI / CAE (Holistor lo llama C.A.I., lo llenamos con el CAE si existe)
-    cai = afip.get("cae", "")
-
-    # Códigos (los dejamos vacíos; Holistor puede usar Códigos Auxiliares por Defecto)
-    cod_neto_gravado = ""
-    cod_conc_no_gravado = ""
-    cod_operacion_exenta = ""
-    cod_perc_ret_pc = ""
-
-    # Armamos los 28 campos EN ORDEN EXACTO DEL ANEXO I
-    fields = [
-        nombre_comprobante,         # 1  Nombre Comprobante
-        tipo_comprobante,           # 2  Tipo Comprobante
-        sucursal,                   # 3  Número Sucursal
-        numero,                     # 4  Número de Comprobante
-        fecha_emision,              # 5  Fecha Emisión
-        fecha_recepcion,            # 6  Fecha Recepción
-        cod_neto_gravado,           # 7  Código Neto Gravado
-        s(neto_gravado),            # 8  Neto Gravado
-        cod_conc_no_gravado,        # 9  Cód. Concepto no Gravado
-        s(no_gravado),              # 10 Conceptos no Gravados
-        cod_operacion_exenta,       # 11 Cód. Operación Exenta
-        s(exento),                  # 12 Operaciones Exentas
-        cod_perc_ret_pc,            # 13 Código Perc./Ret./P.Cta
-        s(percep_total),            # 14 Percepciones
-        s(tasa_iva),                # 15 Tasa I.V.A.
-        s(iva_liquidado),           # 16 I.V.A. Liquidado
-        s(credito_fiscal),          # 17 Crédito Fiscal
-        s(total),                   # 18 Total
-        condicion_fiscal,           # 19 Condición Fiscal Proveedor
-        cuit_proveedor,             # 20 C.U.I.T. Proveedor
-        nombre_proveedor,           # 21 Nombre Proveedor
-        domicilio_proveedor,        # 22 Domicilio Proveedor
-        codigo_postal,              # 23 Código Postal
-        provincia,                  # 24 Provincia
-        tipo_doc_cliente,           # 25 Tipo Documento Cliente
-        moneda,                     # 26 Moneda
-        s(tipo_cambio),             # 27 Tipo Cambio
-        cai,                        # 28 C.A.I.
-    ]
-
-    safe_fields = [str(f).replace(";", ",") for f in fields]
-    return ";".join(safe_fields)
-
-
-# =================== HOLISTOR ===================
 
-# =================== HOLISTOR ===================
+# =================== HOLISTOR (Libro IVA Compras, Anexo I) ===================
+
+HOLISTOR_LAYOUT = {
+    "name": "holistor",
+    "kind": "delimited",
+    "sep": ";",
+    "header": True,
+    "fields": [
+        field("nombre_comprobante", source="nombre_comprobante", label="Nombre Comprobante"),
+        field("tipo_comprobante", source="dc.letra", label="Tipo Comprobante"),
+        field("nro_sucursal", source="nro_sucursal", label="Numero Sucursal"),
+        field("nro_comprobante", source="dc.numero_comprobante", label="Numero de Comprobante"),
+        field("fecha_emision", source="dc.fecha_emision", label="Fecha Emision"),
+        # por ahora usamos la misma fecha
+        field("fecha_recepcion", source="dc.fecha_emision", label="Fecha Recepcion"),
+        field("codigo_neto_gravado", source="codigo_neto_gravado", label="Codigo Neto Gravado"),
+        field("neto_gravado", source="neto_gravado", fmt="num2", label="Neto Gravado"),  # RECALCULADO
+        field("cod_concepto_no_gravado", source="cod_concepto_no_gravado", label="Cod Concepto no Gravado"),
+        field("no_gravado", source="no_gravado", fmt="num2", label="Conceptos no Gravados"),
+        field("cod_operacion_exenta", source="cod_operacion_exenta", label="Cod Operacion Exenta"),
+        field("exento", source="exento", fmt="num2", label="Operaciones Exentas"),
+        field("codigo_perc_ret_pcta", source="codigo_perc_ret_pcta", label="Codigo Perc_Ret_PCta"),
+        field("percepciones", source="percepciones", fmt="num2", label="Percepciones"),
+        field("tasa_iva", source="tasa_iva", fmt="num2", label="Tasa IVA"),
+        field("iva_liquidado", source="iva_liquidado", fmt="num2", label="IVA Liquidado"),
+        field("credito_fiscal", source="iva_liquidado", fmt="num2", label="Credito Fiscal"),  # por ahora igual al IVA
+        field("total", source="total", fmt="num2", label="Total"),
+        field("condicion_fiscal_prov", source="em.condicion_iva", label="Condicion Fiscal Proveedor"),
+        field("cuit_prov", source="em.cuit", label="CUIT Proveedor"),
+        field("nombre_prov", source="em.razon_social", label="Nombre Proveedor"),
+        field("domicilio_prov", source="em.domicilio_comercial", label="Domicilio Proveedor"),
+        field("codigo_postal", const="", label="Codigo Postal"),  # No lo tenemos en el JSON todavía
+        field("provincia", source="em.provincia", label="Provincia"),
+        field("tipo_doc_cliente", source="tipo_doc_cliente", label="Tipo Documento Cliente"),
+        field("moneda", source="dc.moneda", label="Moneda"),
+        field("tipo_cambio", source="tipo_cambio", fmt="num2", label="Tipo Cambio"),
+        field("cai", source="fisc.cae", label="CAI"),  # CAI / CAE
+    ],
+}
 
-def _num(v):
-    """Convierte a string numérico con punto, vacío si no hay dato."""
-    if v in (None, "", "null"):
-        return ""
-    try:
-        return f"{float(v):.2f}"
-    except Exception:
-        return ""
+_holistor_line = compile_layout(HOLISTOR_LAYOUT)
 
+HOLISTOR_HEADER = _holistor_line.header
 
-def build_txt_line_holistor(data: dict) -> str:
-    """
-    Arma UNA línea del TXT de Holistor con este encabezado:
-
-    Nombre Comprobante;Tipo Comprobante;Numero Sucursal;Numero de Comprobante;
-    Fecha Emision;Fecha Recepcion;Codigo Neto Gravado;Neto Gravado;
-    Cod Concepto no Gravado;Conceptos no Gravados;
-    Cod Operacion Exenta;Operaciones Exentas;
-    Codigo Perc_Ret_PCta;Percepciones;
-    Tasa IVA;IVA Liquidado;Credito Fiscal;Total;
-    Condicion Fiscal Proveedor;CUIT Proveedor;Nombre Proveedor;Domicilio Proveedor;
-    Codigo Postal;Provincia;Tipo Documento Cliente;Moneda;Tipo Cambio;CAI
-    """
 
+def _holistor_record(data: dict) -> dict:
     dc = data.get("datos_comprobante", {}) or {}
-    em = data.get("emisor", {}) or {}
     rec = data.get("receptor", {}) or {}
     tot = data.get("totales", {}) or {}
-    fisc = data.get("datos_fiscales_afip", {}) or {}
 
     # -------- Totales crudos del JSON --------
     importe_neto_gravado_raw = tot.get("importe_neto_gravado") or 0.0
@@ -491,36 +1107,6 @@ def build_txt_line_holistor(data: dict) -> str:
         # Si algo falla, usamos lo que vino del JSON
         neto_calc = importe_neto_gravado_raw
 
-    importe_neto_gravado = neto_calc
-    credito_fiscal = iva_liquidado  # por ahora igual al IVA
-
-    # -------- Campos específicos Holistor --------
-
-    # Nombre / tipo comprobante
-    nombre_comprobante = (dc.get("tipo") or "Factura").capitalize()
-    tipo_comprobante = dc.get("letra") or ""
-
-    nro_sucursal = (dc.get("punto_venta") or "").zfill(4)
-    nro_comprobante = dc.get("numero_comprobante") or ""
-
-    fecha_emision = dc.get("fecha_emision") or ""
-    fecha_recepcion = fecha_emision  # por ahora uso misma fecha
-
-    # Códigos para neto / exento / no gravado
-    codigo_neto_gravado = "1" if importe_neto_gravado else ""
-    cod_concepto_no_gravado = "2" if importe_no_gravado else ""
-    cod_operacion_exenta = "3" if importe_exento else ""
-
-    # Código percepción / retención (si hay algo, pongo 1)
-    codigo_perc_ret_pcta = "1" if percepciones_total else ""
-
-    condicion_fiscal_prov = em.get("condicion_iva") or ""
-    cuit_prov = em.get("cuit") or ""
-    nombre_prov = em.get("razon_social") or ""
-    domicilio_prov = em.get("domicilio_comercial") or ""
-    cp = ""  # No lo tenemos en el JSON todavía
-    provincia = em.get("provincia") or ""
-
     # Tipo documento cliente (80 = CUIT, 96 = DNI, etc.)
     if rec.get("cuit"):
         tipo_doc_cliente = "80"
@@ -529,60 +1115,37 @@ def build_txt_line_holistor(data: dict) -> str:
     else:
         tipo_doc_cliente = ""
 
-    moneda = dc.get("moneda") or ""
-    tipo_cambio = dc.get("cotizacion_moneda") or ""
-    cai_cae = fisc.get("cae") or ""
-
-    campos = [
-        nombre_comprobante,                 # Nombre Comprobante
-        tipo_comprobante,                   # Tipo Comprobante (letra)
-        nro_sucursal,                       # Numero Sucursal
-        nro_comprobante,                    # Numero de Comprobante
-        fecha_emision,                      # Fecha Emision
-        fecha_recepcion,                    # Fecha Recepcion
-        codigo_neto_gravado,                # Codigo Neto Gravado
-        _num(importe_neto_gravado),         # Neto Gravado (RECALCULADO)
-        cod_concepto_no_gravado,           # Cod Concepto no Gravado
-        _num(importe_no_gravado),           # Conceptos no Gravados
-        cod_operacion_exenta,              # Cod Operacion Exenta
-        _num(importe_exento),              # Operaciones Exentas
-        codigo_perc_ret_pcta,              # Codigo Perc_Ret_PCta
-        _num(percepciones_total),          # Percepciones
-        _num(tasa_iva),                    # Tasa IVA
-        _num(iva_liquidado),               # IVA Liquidado
-        _num(credito_fiscal),              # Credito Fiscal
-        _num(total_comprobante),           # Total
-        condicion_fiscal_prov,             # Condicion Fiscal Proveedor
-        cuit_prov,                         # CUIT Proveedor
-        nombre_prov,                       # Nombre Proveedor
-        domicilio_prov,                    # Domicilio Proveedor
-        cp,                                # Codigo Postal
-        provincia,                         # Provincia
-        tipo_doc_cliente,                  # Tipo Documento Cliente
-        moneda,                            # Moneda
-        _num(tipo_cambio),                 # Tipo Cambio
-        cai_cae,                           # CAI / CAE
-    ]
+    return {
+        "dc": dc,
+        "em": data.get("emisor", {}) or {},
+        "fisc": data.get("datos_fiscales_afip", {}) or {},
+        "nombre_comprobante": (dc.get("tipo") or "Factura").capitalize(),
+        "nro_sucursal": (dc.get("punto_venta") or "").zfill(4),
+        # Códigos para neto / exento / no gravado / percepciones
+        "codigo_neto_gravado": "1" if neto_calc else "",
+        "cod_concepto_no_gravado": "2" if importe_no_gravado else "",
+        "cod_operacion_exenta": "3" if importe_exento else "",
+        "codigo_perc_ret_pcta": "1" if percepciones_total else "",
+        "neto_gravado": neto_calc,
+        "no_gravado": importe_no_gravado,
+        "exento": importe_exento,
+        "percepciones": percepciones_total,
+        "tasa_iva": tasa_iva,
+        "iva_liquidado": iva_liquidado,
+        "total": total_comprobante,
+        "tipo_doc_cliente": tipo_doc_cliente,
+        "tipo_cambio": dc.get("cotizacion_moneda") or "",
+    }
+
 
-    # reemplazo ';' internos por ',' para no romper el CSV
-    safe_campos = [str(c).replace(";", ",") for c in campos]
-    return ";".join(safe_campos)
+def build_txt_line_holistor(data: dict) -> str:
+    """UNA línea del TXT de Holistor (columnas de HOLISTOR_HEADER)."""
+    return _holistor_line(_holistor_record(data))
 
 
 def build_txt_content_holistor(results: List[dict]) -> str:
     """Arma TODO el TXT de Holistor (con encabezado + líneas)."""
-    header = (
-        "Nombre Comprobante;Tipo Comprobante;Numero Sucursal;Numero de Comprobante;"
-        "Fecha Emision;Fecha Recepcion;Codigo Neto Gravado;Neto Gravado;"
-        "Cod Concepto no Gravado;Conceptos no Gravados;"
-        "Cod Operacion Exenta;Operaciones Exentas;"
-        "Codigo Perc_Ret_PCta;Percepciones;"
-        "Tasa IVA;IVA Liquidado;Credito Fiscal;Total;"
-        "Condicion Fiscal Proveedor;CUIT Proveedor;Nombre Proveedor;Domicilio Proveedor;"
-        "Codigo Postal;Provincia;Tipo Documento Cliente;Moneda;Tipo Cambio;CAI"
-    )
-
-    lines = [header]
+    lines = [HOLISTOR_HEADER]
 
     for item in results:
         data = item.get("data", {}) or {}
@@ -595,156 +1158,8 @@ def build_txt_content_holistor(results: List[dict]) -> str:
 # =================== FIN HOLISTOR ===================
 
 
-# =================== BEJERMAN ===================
-def _to_float(v):
-    if v in (None, "", "null"):
-        return 0.0
-    try:
-        return float(v)
-    except Exception:
-        return 0.0
-
-
-def check_math(data: dict, tol: float = 0.10) -> dict:
-    """
-    Control matemático básico por comprobante.
-    Compara:
-      - Neto / IVA / Total calculados desde los ítems
-      - contra los totales del JSON devuelto por la IA.
-    tol = tolerancia en pesos (por defecto 0,10).
-    """
-    tot = data.get("totales", {}) or {}
-    items = data.get("items", []) or []
-
-    # Totales del JSON
-    neto_json = _to_float(tot.get("importe_neto_gravado"))
-    exento = _to_float(tot.get("importe_exento"))
-    no_grav = _to_float(tot.get("importe_neto_no_gravado"))
-    total_json = _to_float(tot.get("total_comprobante"))
-    percep_iva = _to_float(tot.get("percepciones_iva"))
-    percep_iibb = _to_float(tot.get("percepciones_ingresos_brutos"))
-    percep_otras = _to_float(tot.get("percepciones_otras"))
-
-    iva_list = tot.get("ivAs") or []
-    iva_json = 0.0
-    for iva in iva_list:
-        iva_json += _to_float(iva.get("importe_iva"))
-
-    # Recalcular desde ítems
-    neto_items = 0.0
-    iva_items = 0.0
-    total_items = 0.0
-
-    for it in items:
-        total_r = _to_float(it.get("importe_total_renglon"))
-        alic = it.get("alicuota_iva")
-        try:
-            alic_f = float(alic) if alic not in (None, "", "null") else 0.0
-        except Exception:
-            alic_f = 0.0
-
-        if alic_f > 0:
-            neto_i = round(total_r / (1 + alic_f / 100), 2)
-            iva_i = round(total_r - neto_i, 2)
-        else:
-            neto_i = total_r
-            iva_i = 0.0
-
-        neto_items += neto_i
-        iva_items += iva_i
-        total_items += total_r
-
-    total_teorico = (
-        neto_json + iva_json + exento + no_grav +
-        percep_iva + percep_iibb + percep_otras
-    )
-
-    neto_diff = neto_items - neto_json
-    iva_diff = iva_items - iva_json
-    total_diff_items_vs_json = total_items - total_json
-    total_diff_teorico_vs_json = total_teorico - total_json
-
-    ok = (
-        abs(neto_diff) <= tol
-        and abs(iva_diff) <= tol
-        and abs(total_diff_items_vs_json) <= tol
-        and abs(total_diff_teorico_vs_json) <= tol
-    )
-
-    return {
-        "ok": ok,
-        "neto_items": round(neto_items, 2),
-        "neto_json": round(neto_json, 2),
-        "neto_diff": round(neto_diff, 2),
-        "iva_items": round(iva_items, 2),
-        "iva_json": round(iva_json, 2),
-        "iva_diff": round(iva_diff, 2),
-        "total_items": round(total_items, 2),
-        "total_json": round(total_json, 2),
-        "total_teorico": round(total_teorico, 2),
-        "total_diff_items_vs_json": round(total_diff_items_vs_json, 2),
-        "total_diff_teorico_vs_json": round(total_diff_teorico_vs_json, 2),
-    }
-
 # =================== BEJERMAN: HELPERS GENERALES ===================
 
-def _pad_right(value: str, length: int, fill: str = " ") -> str:
-    """Rellena a la derecha con blancos."""
-    s = "" if value is None else str(value)
-    return s[:length].ljust(length, fill)
-
-
-def _pad_left(value: str, length: int, fill: str = "0") -> str:
-    """Rellena a la izquierda (típico para números)."""
-    s = "" if value is None else str(value)
-    return s[:length].rjust(length, fill)
-
-
-def _only_digits(value: str) -> str:
-    if not value:
-        return ""
-    return "".join(ch for ch in str(value) if ch.isdigit())
-
-
-def _format_date_yyyymmdd(date_str: str) -> str:
-    """Convierte '03/07/2025', '2025-07-03', etc. a '20250703'. Si falla, 00000000."""
-    if not date_str:
-        return "00000000"
-    date_str = date_str.strip()
-    try:
-        if "-" in date_str:
-            dt = datetime.strptime(date_str[:10], "%Y-%m-%d")
-        elif "/" in date_str:
-            parts = date_str.split("/")
-            if len(parts[0]) == 4:
-                dt = datetime.strptime(date_str[:10], "%Y/%m/%d")
-            else:
-                dt = datetime.strptime(date_str[:10], "%d/%m/%Y")
-        else:
-            if len(date_str) == 8:
-                dt = datetime.strptime(date_str, "%d%m%Y")
-            else:
-                return "00000000"
-        return dt.strftime("%Y%m%d")
-    except Exception:
-        return "00000000"
-
-
-def _format_amount_bejerman(value, length: int = 16) -> str:
-    """
-    Formato 999999999999.99 (16 caracteres).
-    Si no hay dato, devuelve todo ceros.
-    """
-    if value in (None, "", "null"):
-        s = "0.00"
-    else:
-        try:
-            num = float(value)
-            s = f"{num:.2f}"
-        except Exception:
-            s = "0.00"
-    return s.replace(",", ".")[:length].rjust(length, "0")
-
 def _get_item_aliquota(item: dict, tot: dict):
     """
     Devuelve la alícuota de IVA del ítem.
@@ -841,113 +1256,78 @@ def _map_tipo_comprobante_bejerman(tipo: str) -> str:
     return "FC"
 
 
-# =================== BEJERMAN: CCabecer.txt ===================
-
-def build_bejerman_ccabecer_line(data: dict) -> str:
-    """
-    Construye UNA línea de CCabecer.txt (cabecera de compras) en formato ancho fijo.
-    """
-    dc = data.get("datos_comprobante", {}) or {}
-    em = data.get("emisor", {}) or {}
-
-    tipo_comp = _map_tipo_comprobante_bejerman(dc.get("tipo", ""))
-    letra = (dc.get("letra") or " ").strip()[:1] or " "
-    pto_vta = _pad_left(dc.get("punto_venta", ""), 4, "0")
-    nro_comp = _pad_left(dc.get("numero_comprobante", ""), 8, "0")
-    nro_hasta = _pad_left("", 8, "0")
-
-    fecha_comp = _format_date_yyyymmdd(dc.get("fecha_emision", ""))
-
-    cod_proveedor = _pad_right("@@@#@@", 6)  # recodificación automática
-    razon_prov = _pad_right(em.get("razon_social", ""), 40)
-
-    tipo_doc = _pad_left("1", 2, "0")  # 1 = CUIT
+# Los 7 primeros campos (identificación del comprobante) son iguales en los
+# tres archivos de Bejerman.
+_BEJ_COMPROBANTE_FIELDS = [
+    field("tipo_comprobante", 3, "tipo"),
+    field("letra", 1, "letra"),
+    field("punto_venta", 4, "dc.punto_venta", align=RIGHT, fill="0"),
+    field("numero", 8, "dc.numero_comprobante", align=RIGHT, fill="0"),
+    field("numero_hasta", 8, const="", align=RIGHT, fill="0"),
+    field("fecha", 8, "dc.fecha_emision", fmt="date8"),
+    field("codigo_proveedor", 6, const="@@@#@@"),  # recodificación automática
+]
 
-    provincia_cod = _pad_left(
-        _map_provincia_bejerman(em.get("provincia", "")),
-        3,
-        "0",
-    )
-
-    situacion_iva = _map_iva_bejerman(em.get("condicion_iva", ""))
 
-    cuit_emisor = _only_digits(em.get("cuit", ""))
-    cuit_emisor = _pad_left(cuit_emisor, 11, "0")
+def _bejerman_record(data: dict) -> dict:
+    dc = data.get("datos_comprobante", {}) or {}
+    return {
+        "dc": dc,
+        "em": data.get("emisor", {}) or {},
+        "tot": data.get("totales", {}) or {},
+        "tipo": _map_tipo_comprobante_bejerman(dc.get("tipo", "")),
+        "letra": (dc.get("letra") or " ").strip()[:1] or " ",
+    }
 
-    nro_iibb = _pad_right(em.get("condicion_ingresos_brutos", ""), 15)
 
-    clasif1 = _pad_right("", 4)
-    clasif2 = _pad_right("", 4)
+# =================== BEJERMAN: CCabecer.txt ===================
 
-    condicion_pago = _pad_left("1", 3, "0")  # 1=contado (ajustable)
-    cod_causa_emision = _pad_right("", 4)
+CCABECER_LAYOUT = {
+    "name": "bejerman_ccabecer",
+    "kind": "fixed",
+    "fields": _BEJ_COMPROBANTE_FIELDS + [
+        field("razon_social", 40, "em.razon_social"),
+        field("tipo_documento", 2, const="1", align=RIGHT, fill="0"),  # 1 = CUIT
+        field("provincia", 3, "provincia", align=RIGHT, fill="0"),
+        field("situacion_iva", 1, "situacion_iva"),
+        field("cuit", 11, "em.cuit", fmt="digits", align=RIGHT, fill="0"),
+        field("nro_iibb", 15, "em.condicion_ingresos_brutos"),
+        field("clasificacion_1", 4, const=""),
+        field("clasificacion_2", 4, const=""),
+        field("condicion_pago", 3, const="1", align=RIGHT, fill="0"),  # 1=contado (ajustable)
+        field("causa_emision", 4, const=""),
+        field("fecha_vencimiento", 8, "dc.fecha_vencimiento", fmt="date8"),
+        field("importe_total", 16, "tot.total_comprobante", fmt="amount", align=RIGHT, fill="0"),
+        field("apertura_contable", 4, const=""),
+        field("direccion", 30, "em.domicilio_comercial"),
+        field("codigo_postal", 8, const=""),
+        field("localidad", 25, "em.localidad"),
+        field("actualiza_stock", 1, const="N"),
+        field("desc_clasificacion_1", 15, const=""),
+        field("desc_clasificacion_2", 15, const=""),
+        field("tasa_dto_comercial_1", 8, const="0", align=RIGHT, fill="0"),
+        field("tasa_dto_comercial_2", 8, const="0", align=RIGHT, fill="0"),
+        field("tasa_dto_comercial_3", 8, const="0", align=RIGHT, fill="0"),
+        field("tasa_dto_financiero", 8, const="0", align=RIGHT, fill="0"),
+        field("aduana", 8, const=""),
+        field("fecha_despacho_plaza", 8, const="00000000"),
+        field("anio_documento", 4, const="", align=RIGHT, fill="0"),
+        field("nro_despacho", 25, const=""),
+        field("tipo_declaracion_import", 1, const=" "),
+    ],
+}
 
-    fecha_vto = _format_date_yyyymmdd(dc.get("fecha_vencimiento", ""))
+_ccabecer_line = compile_layout(CCABECER_LAYOUT)
 
-    tot = data.get("totales", {}) or {}
-    importe_total = _format_amount_bejerman(tot.get("total_comprobante"))
-
-    apertura_contable = _pad_right("", 4)
-
-    direccion = _pad_right(em.get("domicilio_comercial", ""), 30)
-    cod_postal = _pad_right("", 8)
-    localidad = _pad_right(em.get("localidad", ""), 25)
-
-    actualiza_stock = "N"
-
-    desc_clasif1 = _pad_right("", 15)
-    desc_clasif2 = _pad_right("", 15)
-
-    tasa_dto_com_1 = _pad_left("0", 8, "0")
-    tasa_dto_com_2 = _pad_left("0", 8, "0")
-    tasa_dto_com_3 = _pad_left("0", 8, "0")
-    tasa_dto_fin = _pad_left("0", 8, "0")
-
-    aduana = _pad_right("", 8)
-    fecha_despa_plaza = "00000000"
-    anio_doc = _pad_left("", 4, "0")
-    nro_despacho = _pad_right("", 25)
-    tipo_declar_import = " "
-
-    campos = [
-        _pad_right(tipo_comp, 3),
-        _pad_right(letra, 1),
-        pto_vta,
-        nro_comp,
-        nro_hasta,
-        fecha_comp,
-        _pad_right(cod_proveedor, 6),
-        razon_prov,
-        tipo_doc,
-        provincia_cod,
-        situacion_iva,
-        cuit_emisor,
-        nro_iibb,
-        clasif1,
-        clasif2,
-        condicion_pago,
-        cod_causa_emision,
-        fecha_vto,
-        importe_total,
-        apertura_contable,
-        direccion,
-        cod_postal,
-        localidad,
-        actualiza_stock,
-        desc_clasif1,
-        desc_clasif2,
-        tasa_dto_com_1,
-        tasa_dto_com_2,
-        tasa_dto_com_3,
-        tasa_dto_fin,
-        aduana,
-        fecha_despa_plaza,
-        anio_doc,
-        nro_despacho,
-        tipo_declar_import,
-    ]
 
-    return "".join(campos)
+def build_bejerman_ccabecer_line(data: dict) -> str:
+    """
+    Construye UNA línea de CCabecer.txt (cabecera de compras) en formato ancho fijo.
+    """
+    r = _bejerman_record(data)
+    r["provincia"] = _map_provincia_bejerman(r["em"].get("provincia", ""))
+    r["situacion_iva"] = _map_iva_bejerman(r["em"].get("condicion_iva", ""))
+    return _ccabecer_line(r)
 
 
 def build_txt_content_bejerman(results: List[dict]) -> str:
@@ -965,49 +1345,55 @@ def build_txt_content_bejerman(results: List[dict]) -> str:
 
 # =================== BEJERMAN: CItems.txt (detalle de compras) ===================
 
+CITEMS_LAYOUT = {
+    "name": "bejerman_citems",
+    "kind": "fixed",
+    "fields": _BEJ_COMPROBANTE_FIELDS + [
+        field("tipo_item", 1, const="C"),  # "C" = concepto (no mueve stock)
+        field("codigo_item", 23, "it.codigo"),
+        field("cantidad", 16, "cantidad", fmt="amount", align=RIGHT, fill="0"),
+        field("cantidad_um2", 16, const="0.00", align=RIGHT, fill="0"),
+        field("descripcion", 50, "it.descripcion"),
+        field("precio_unitario", 16, "precio_unitario", fmt="amount", align=RIGHT, fill="0"),
+        field("tasa_iva_inscripto", 8, "alicuota", fmt="amount", align=RIGHT, fill="0"),
+        field("tasa_iva_no_inscripto", 8, const="0.00", align=RIGHT, fill="0"),
+        field("importe_iva_inscripto", 16, "iva", fmt="amount", align=RIGHT, fill="0"),
+        field("importe_iva_no_inscripto", 16, const="0.00", align=RIGHT, fill="0"),
+        field("importe_total_neto", 16, "neto", fmt="amount", align=RIGHT, fill="0"),
+        field("dto_comercial", 16, const="0.00", align=RIGHT, fill="0"),
+        field("dto_financiero", 16, const="0.00", align=RIGHT, fill="0"),
+        field("concepto_no_gravado", 4, const="", align=RIGHT, fill="0"),
+        field("importe_no_gravado", 16, const="0.00", align=RIGHT, fill="0"),
+        field("tipo_iva", 1, "tipo_iva"),
+        field("dto_por_linea", 16, const="0.00", align=RIGHT, fill="0"),
+        field("deposito", 3, const="", align=RIGHT, fill="0"),
+        field("partida", 26, const=""),
+        field("tasa_dto_item", 8, const="0.00", align=RIGHT, fill="0"),
+        field("importe_renglon", 16, "importe_renglon", fmt="amount", align=RIGHT, fill="0"),
+        # Imputación crédito fiscal y rubro: defaults razonables
+        field("imputacion_cf", 1, const="1"),  # 1 = Directo gravado
+        field("rubro_cf", 1, const="0"),       # 0 = Compra mercado local
+    ],
+}
+
+_citems_line = compile_layout(CITEMS_LAYOUT)
+
+
 def build_bejerman_citems_line(data: dict, item: dict) -> str:
     """
     Construye UNA línea de CItems.txt (detalle de comprobantes de compras).
     Un registro por renglón de ítem.
     """
-    dc = data.get("datos_comprobante", {}) or {}
-    em = data.get("emisor", {}) or {}
-    tot = data.get("totales", {}) or {}
-
-    tipo_comp = _map_tipo_comprobante_bejerman(dc.get("tipo", ""))
-    letra = (dc.get("letra") or " ").strip()[:1] or " "
-    pto_vta = _pad_left(dc.get("punto_venta", ""), 4, "0")
-    nro_comp = _pad_left(dc.get("numero_comprobante", ""), 8, "0")
-    nro_hasta = _pad_left("", 8, "0")
-    fecha_comp = _format_date_yyyymmdd(dc.get("fecha_emision", ""))
-
-    cod_proveedor = _pad_right("@@@#@@", 6)
-
-    # Tipo de ítem: "C" = concepto (no mueve stock)
-    tipo_item = "C"
-
-    codigo_item = _pad_right(item.get("codigo", "") or "", 23)
-
-    cantidad = item.get("cantidad") or 1
-    cantidad_str = _format_amount_bejerman(cantidad, length=16)
-
-    cant_um2 = _format_amount_bejerman(0, length=16)
+    r = _bejerman_record(data)
+    tot = r["tot"]
 
-    descripcion = _pad_right(item.get("descripcion", "") or "", 50)
-
-    precio_unit = item.get("precio_unitario") or item.get("importe_total_renglon") or 0
-    precio_unit_str = _format_amount_bejerman(precio_unit, length=16)
-
-    # ---------- NUEVO: decidir alícuota usando item + totales.ivAs ----------
+    # Decidir alícuota usando item + totales.ivAs
     alic = _get_item_aliquota(item, tot)
     try:
         alic_float = float(alic)
     except Exception:
         alic_float = 0.0
 
-    tasa_iva_insc = _format_amount_bejerman(alic_float, length=8)
-    tasa_iva_no_insc = _format_amount_bejerman(0, length=8)
-
     # Importe del renglón "final" (con IVA si proveedor inscripto)
     importe_renglon_final = item.get("importe_total_renglon")
     if importe_renglon_final is None:
@@ -1018,7 +1404,7 @@ def build_bejerman_citems_line(data: dict, item: dict) -> str:
     except Exception:
         importe_renglon_final = 0.0
 
-    # ---------- NUEVO: cálculo neto/IVA según tipo ----------
+    # Cálculo neto/IVA según tipo
     if alic_float > 0:
         # Gravado: neto = total / (1 + tasa), IVA = diferencia
         neto_item = round(importe_renglon_final / (1 + alic_float / 100), 2)
@@ -1028,33 +1414,15 @@ def build_bejerman_citems_line(data: dict, item: dict) -> str:
         neto_item = importe_renglon_final
         iva_item = 0.0
 
-    importe_iva_insc = _format_amount_bejerman(iva_item, length=16)
-    importe_iva_no_insc = _format_amount_bejerman(0, length=16)
-
-    importe_total_neto = _format_amount_bejerman(neto_item, length=16)
-
-    # Descuentos en cero por ahora
-    dto_com = _format_amount_bejerman(0, length=16)
-    dto_fin = _format_amount_bejerman(0, length=16)
-
-    # ---------- NUEVO: tipo_iva más expresivo ----------
-    # Regla simple:
+    # Tipo de IVA:
     #   >0     → 1 (gravado)
     #   ==0 y hay importe_exento en totales → 2 (exento)
     #   ==0 y hay neto_no_gravado           → 3 (no gravado)
     #   resto                               → 2 por defecto
     tipo_iva = "1"
     if alic_float == 0:
-        importe_exento = tot.get("importe_exento") or 0
-        importe_no_grav = tot.get("importe_neto_no_gravado") or 0
-        try:
-            importe_exento = float(importe_exento)
-        except Exception:
-            importe_exento = 0.0
-        try:
-            importe_no_grav = float(importe_no_grav)
-        except Exception:
-            importe_no_grav = 0.0
+        importe_exento = _to_float(tot.get("importe_exento") or 0)
+        importe_no_grav = _to_float(tot.get("importe_neto_no_gravado") or 0)
 
         if importe_exento > 0 and importe_no_grav == 0:
             tipo_iva = "2"   # exento
@@ -1063,57 +1431,15 @@ def build_bejerman_citems_line(data: dict, item: dict) -> str:
         else:
             tipo_iva = "2"   # default 0% = exento
 
-    cod_concepto_no_grav = _pad_left("", 4)
-    importe_no_grav = _format_amount_bejerman(0, length=16)
-
-    dto_por_linea = _format_amount_bejerman(0, length=16)
-
-    deposito = _pad_left("", 3)
-    partida = _pad_right("", 26)
-
-    tasa_dto_item = _format_amount_bejerman(0, length=8)
-
-    importe_renglon = _format_amount_bejerman(importe_renglon_final, length=16)
-
-    # Imputación crédito fiscal y rubro: defaults razonables
-    imputacion_cf = "1"  # 1 = Directo gravado
-    rubro_cf = "0"       # 0 = Compra mercado local
-
-    campos = [
-        _pad_right(tipo_comp, 3),      # 1 Tipo Comprobante
-        _pad_right(letra, 1),          # 2 Letra
-        pto_vta,                       # 3 Punto de venta (4)
-        nro_comp,                      # 4 Número comprobante (8)
-        nro_hasta,                     # 5 Nro hasta (8)
-        fecha_comp,                    # 6 Fecha comprobante (8)
-        _pad_right(cod_proveedor, 6),  # 7 Código proveedor (6)
-        tipo_item,                     # 8 Tipo de ítem (1)
-        codigo_item,                   # 9 Código concepto/artículo (23)
-        cantidad_str,                  # 10 Cantidad UM1 (16)
-        cant_um2,                      # 11 Cantidad UM2 (16)
-        descripcion,                   # 12 Descripción (50)
-        precio_unit_str,               # 13 Precio unitario (16)
-        tasa_iva_insc,                 # 14 Tasa IVA inscripto (8)
-        tasa_iva_no_insc,              # 15 Tasa IVA no inscripto (8)
-        importe_iva_insc,              # 16 Importe IVA inscripto (16)
-        importe_iva_no_insc,           # 17 Importe IVA no inscripto (16)
-        importe_total_neto,            # 18 Importe total neto (16)
-        dto_com,                       # 19 Importe dto comercial (16)
-        dto_fin,                       # 20 Importe dto financiero (16)
-        cod_concepto_no_grav,          # 21 Código concepto no gravado (4)
-        importe_no_grav,               # 22 Importe no gravado (16)
-        tipo_iva,                      # 23 Tipo de IVA (1)
-        dto_por_linea,                 # 24 Importe dto por línea (16)
-        deposito,                      # 25 Depósito (3)
-        partida,                       # 26 Partida (26)
-        tasa_dto_item,                 # 27 Tasa dto por ítem (8)
-        importe_renglon,               # 28 Importe del renglón (16)
-        imputacion_cf,                 # 29 Imputación crédito fiscal (1)
-        rubro_cf,                      # 30 Rubro crédito fiscal (1)
-    ]
-
-    return "".join(campos)
-
+    r["it"] = item
+    r["cantidad"] = item.get("cantidad") or 1
+    r["precio_unitario"] = item.get("precio_unitario") or item.get("importe_total_renglon") or 0
+    r["alicuota"] = alic_float
+    r["iva"] = iva_item
+    r["neto"] = neto_item
+    r["tipo_iva"] = tipo_iva
+    r["importe_renglon"] = importe_renglon_final
+    return _citems_line(r)
 
 
 def build_txt_citems_bejerman(results: List[dict]) -> str:
@@ -1123,56 +1449,46 @@ def build_txt_citems_bejerman(results: List[dict]) -> str:
     """
     lines = []
     for entry in results:
-        data = entry.get("data", {}) or {}
-        items = data.get("items") or []
-        if not items:
-            # Si no hay ítems, igual generamos un renglón "dummy" para no dejar el comprobante colgado
-            items = [{}]
-
-        for it in items:
-            line = build_bejerman_citems_line(data, it)
-            lines.append(line)
+        lines.extend(bejerman_citems_lines(entry.get("data", {}) or {}))
 
     return "\n".join(lines)
 
+
+def bejerman_citems_lines(data: dict):
+    """Los renglones de CItems.txt de UN comprobante."""
+    items = data.get("items") or []
+    if not items:
+        # Si no hay ítems, igual generamos un renglón "dummy" para no dejar el comprobante colgado
+        items = [{}]
+
+    for it in items:
+        yield build_bejerman_citems_line(data, it)
+
 # =================== BEJERMAN: CRegEsp.txt (regímenes especiales) ===================
 
+CREGESP_LAYOUT = {
+    "name": "bejerman_cregesp",
+    "kind": "fixed",
+    "fields": _BEJ_COMPROBANTE_FIELDS + [
+        field("codigo_regimen", 4, "codigo_regimen", align=RIGHT, fill="0"),
+        field("codigo_articulo", 4, "codigo_articulo", align=RIGHT, fill="0"),
+        field("importe", 16, "importe", fmt="amount", align=RIGHT, fill="0"),  # sin signo, según doc
+    ],
+}
+
+_cregesp_line = compile_layout(CREGESP_LAYOUT)
+
+
 def build_bejerman_cregesp_line(data: dict, codigo_regimen: str, codigo_articulo: str, importe) -> str:
     """
     UNA línea de CRegEsp.txt (retenciones / percepciones).
     Un registro por régimen especial.
     """
-    dc = data.get("datos_comprobante", {}) or {}
-
-    tipo_comp = _map_tipo_comprobante_bejerman(dc.get("tipo", ""))
-    letra = (dc.get("letra") or " ").strip()[:1] or " "
-    pto_vta = _pad_left(dc.get("punto_venta", ""), 4, "0")
-    nro_comp = _pad_left(dc.get("numero_comprobante", ""), 8, "0")
-    nro_hasta = _pad_left("", 8, "0")
-    fecha_comp = _format_date_yyyymmdd(dc.get("fecha_emision", ""))
-
-    # recodificación automática de proveedor
-    cod_proveedor = _pad_right("@@@#@@", 6)
-
-    cod_regimen = _pad_left(codigo_regimen, 4, "0")
-    cod_articulo = _pad_left(codigo_articulo, 4, "0")
-
-    importe_str = _format_amount_bejerman(importe, length=16)  # sin signo, según doc
-
-    campos = [
-        _pad_right(tipo_comp, 3),   # 1 Tipo de comprobante
-        _pad_right(letra, 1),       # 2 Letra
-        pto_vta,                    # 3 Punto de venta (4)
-        nro_comp,                   # 4 Nro comprobante (8)
-        nro_hasta,                  # 5 Nro hasta (8)
-        fecha_comp,                 # 6 Fecha comprobante (8)
-        _pad_right(cod_proveedor, 6),  # 7 Código proveedor (6)
-        cod_regimen,                # 8 Código régimen especial (4)
-        cod_articulo,               # 9 Código artículo (4)
-        importe_str,                # 10 Importe (16)
-    ]
-
-    return "".join(campos)
+    r = _bejerman_record(data)
+    r["codigo_regimen"] = codigo_regimen
+    r["codigo_articulo"] = codigo_articulo
+    r["importe"] = importe
+    return _cregesp_line(r)
 
 
 def build_txt_cregesp_bejerman(results: List[dict]) -> str:
@@ -1188,99 +1504,539 @@ def build_txt_cregesp_bejerman(results: List[dict]) -> str:
     lines = []
 
     for entry in results:
-        data = entry.get("data", {}) or {}
-        tot = data.get("totales", {}) or {}
-
-        # Ajustá estos códigos a como los cargues en Bejerman
-        mapping = [
-            ("percepciones_iva", "0001", "0001"),
-            ("percepciones_ingresos_brutos", "0002", "0002"),
-            ("percepciones_otras", "0003", "0003"),
-        ]
-
-        for key, cod_reg, cod_art in mapping:
-            importe = tot.get(key)
-            try:
-                importe = float(importe) if importe not in (None, "", "null") else 0.0
-            except Exception:
-                importe = 0.0
-
-            if importe != 0:
-                line = build_bejerman_cregesp_line(data, cod_reg, cod_art, importe)
-                lines.append(line)
+        lines.extend(bejerman_cregesp_lines(entry.get("data", {}) or {}))
 
     return "\n".join(lines)
 
 
-@app.post("/upload", response_class=HTMLResponse)
+def bejerman_cregesp_lines(data: dict):
+    """Los renglones de CRegEsp.txt de UN comprobante (uno por percepción != 0)."""
+    tot = data.get("totales", {}) or {}
+
+    # Ajustá estos códigos a como los cargues en Bejerman
+    mapping = [
+        ("percepciones_iva", "0001", "0001"),
+        ("percepciones_ingresos_brutos", "0002", "0002"),
+        ("percepciones_otras", "0003", "0003"),
+    ]
+
+    for key, cod_reg, cod_art in mapping:
+        importe = tot.get(key)
+        try:
+            importe = float(importe) if importe not in (None, "", "null") else 0.0
+        except Exception:
+            importe = 0.0
+
+        if importe != 0:
+            yield build_bejerman_cregesp_line(data, cod_reg, cod_art, importe)
+
+
+# =================== TANGO ===================
+
+def build_txt_content_tango(results: List[dict]) -> str:
+    """
+    Placeholder para Tango: sale el TXT genérico. Cuando haya una
+    especificación real del importador de Tango se arma su TANGO_LAYOUT
+    (con líneas de referencia en check_layouts.py).
+    """
+    return build_txt_content(results)
+
+
+# ---------- Procesamiento de tareas de la cola (lo llama worker.py) ----------
+
+# Un mismo archivo subido dos veces a la vez (dos personas con el mismo mail
+# del proveedor, un formulario reenviado) va una sola vez al modelo. Lo que
+# corre es la cola: claim_tasks no entrega un archivo que algún worker (de
+# cualquier proceso) ya está procesando, así que la copia espera en la cola
+# y, cuando aquella termina, el que la toma reusa sus resultados del store
+# (reusable_results) si son de los últimos DEDUP_REUSE_SECONDS. Si la
+# primera falló, o con 0, la copia se extrae de nuevo. Aparte, dentro de un
+# paquete de tickets las copias del mismo archivo comparten la extracción.
+# En /health: "reusados" (del store) y "en_paquete".
+DEDUP_REUSE_SECONDS = float(os.getenv("DEDUP_REUSE_SECONDS", "900"))
+
+_dedup_stats = {"reusados": 0, "en_paquete": 0}
+
+
+def _copy_rows(rows: list, task: dict, source_id: int) -> list:
+    """Filas de otra tarea con el mismo archivo, con el nombre de `task`."""
+    out = []
+    for n, row in enumerate(rows, start=1):
+        name = task["filename"] if len(rows) == 1 else f"{task['filename']} ({n}/{len(rows)})"
+        meta = copy.deepcopy(row["meta"])
+        meta["duplicado_de"] = source_id
+        out.append({"filename": name, "data": copy.deepcopy(row["data"]), "meta": meta})
+    return out
+
+
+async def _reused_rows(task: dict):
+    if DEDUP_REUSE_SECONDS <= 0:
+        return None
+    found = await asyncio.to_thread(
+        reusable_results, task["content_hash"], task["id"], time.time() - DEDUP_REUSE_SECONDS
+    )
+    if found is None:
+        return None
+    _dedup_stats["reusados"] += 1
+    return _copy_rows(found["rows"], task, found["task_id"])
+
+
+async def _process_single_task(task: dict) -> list:
+    """process_task, salvo que otra tarea con el mismo archivo ya haya terminado hace poco."""
+    rows = await _reused_rows(task)
+    if rows is None:
+        rows = await process_task(task)
+    return rows
+
+
+async def process_task(task: dict) -> list:
+    """Extrae un archivo de la cola. Devuelve sus filas [{"filename", "data", "meta"}]."""
+    file_bytes = await asyncio.to_thread(read_task_file, task)
+    filename = task["filename"]
+
+    # Imagen (jpg, png, webp, heic, etc.: prepare_images la normaliza)
+    if task["kind"] == "image":
+        meta = {}
+        data = await extract_invoice_data(file_bytes, meta=meta)
+        return [{"filename": filename, "data": data, "meta": meta}]
+
+    # PDF: puede traer varios comprobantes => una fila por comprobante. Un
+    # TIFF de escáner se convierte a PDF (una hoja por cuadro) y sigue igual
+    if task["kind"] in ("pdf", "tiff"):
+        if task["kind"] == "tiff":
+            await report_stage("rendering")
+            tiff_ref = to_ref(file_bytes)
+            try:
+                file_bytes = take_ref(await run_cpu(image_to_pdf_job, tiff_ref))
+            finally:
+                release_ref(tiff_ref)
+        extracted = await extract_invoices_from_pdf(file_bytes)
+        rows = []
+        for n, ex in enumerate(extracted, start=1):
+            name = filename
+            if len(extracted) > 1:
+                name = f"{filename} ({n}/{len(extracted)})"
+            rows.append({"filename": name, "data": ex["data"], "meta": ex["meta"]})
+        return rows
+
+    # Otro formato: lo marcamos como no soportado
+    data = {"error": f"Tipo de archivo no soportado: {task['content_type']}"}
+    return [{"filename": filename, "data": data, "meta": {}}]
+
+
+async def process_tasks(tasks: List[dict]) -> dict:
+    """
+    Procesa las tareas tomadas por un worker. Varias tareas juntas son tickets
+    chicos del mismo lote: van empaquetados (extract_invoices_packed).
+    Devuelve {task_id: filas}.
+    """
+    ids = [t["id"] for t in tasks]
+    token = _current_tasks.set({"ids": ids, "stage": "queued"})
+    try:
+        if len(tasks) == 1:
+            out = {tasks[0]["id"]: await _process_single_task(tasks[0])}
+        else:
+            out = await _process_packed_tasks(tasks)
+    finally:
+        _current_tasks.reset(token)
+
+    # Control matemático una sola vez, al guardar (el listado filtra por esto)
+    for rows in out.values():
+        for row in rows:
+            data = row["data"] or {}
+            if not data.get("error"):
+                row["meta"]["math_check"] = check_math(data)
+    await asyncio.to_thread(record_stage, ids, "validated")
+    return out
+
+
+async def _process_packed_tasks(tasks: List[dict]) -> dict:
+    out = {}
+    # Tickets repetidos en el paquete o ya extraídos hace poco: no van al modelo
+    first = {}
+    for t in tasks:
+        first.setdefault(t["content_hash"], t)
+    pending = []
+    for t in first.values():
+        rows = await _reused_rows(t)
+        if rows is None:
+            pending.append(t)
+        else:
+            out[t["id"]] = rows
+    if pending:
+        out.update(await _extract_packed(pending))
+    for t in tasks:
+        if t["id"] not in out:
+            leader = first[t["content_hash"]]
+            out[t["id"]] = _copy_rows(out[leader["id"]], t, leader["id"])
+            _dedup_stats["en_paquete"] += 1
+    return out
+
+
+async def _extract_packed(tasks: List[dict]) -> dict:
+    out = {}
+    file_bytes = [await asyncio.to_thread(read_task_file, t) for t in tasks]
+    preps = await prepare_images(file_bytes)
+    images = [p["b64"] for p in preps]
+    # Las que este worker no puede leer salen con su error; el resto se empaqueta
+    readable = []
+    for i, p in enumerate(preps):
+        if p.get("error"):
+            data = {"error": f"No se pudo leer la imagen: {p['error']}"}
+            out[tasks[i]["id"]] = [{"filename": tasks[i]["filename"], "data": data, "meta": {}}]
+        else:
+            readable.append(i)
+    try:
+        for sub in plan_pack_groups([image_tokens(preps[i]) for i in readable]):
+            group = [readable[j] for j in sub]
+            t0 = time.perf_counter()
+            token = _current_tasks.set({"ids": [tasks[i]["id"] for i in group], "stage": "rendering"})
+            metas = [{} for _ in group]
+            try:
+                datas = await extract_invoices_packed([images[i] for i in group], metas)
+            finally:
+                _current_tasks.reset(token)
+            elapsed = time.perf_counter() - t0
+            for i, data, meta in zip(group, datas, metas):
+                meta.update({
+                    "pack_size": len(group),
+                    "pack_invoices_per_sec": round(len(group) / elapsed, 2) if elapsed else None,
+                })
+                out[tasks[i]["id"]] = [{"filename": tasks[i]["filename"], "data": data, "meta": meta}]
+    finally:
+        release_images(images)  # también los de los grupos que no llegaron a salir
+    return out
+
+
+# Loops de worker dentro del proceso web (0 = sólo workers externos)
+EMBEDDED_WORKERS = int(os.getenv("EMBEDDED_WORKERS", "1"))
+
+_embedded_worker = None
+_embedded_stop = None
+
+
+def ensure_embedded_workers():
+    global _embedded_worker, _embedded_stop
+    if EMBEDDED_WORKERS > 0 and (_embedded_worker is None or _embedded_worker.done()):
+        from worker import run_worker
+
+        _embedded_stop = asyncio.Event()
+        _embedded_worker = asyncio.create_task(run_worker(EMBEDDED_WORKERS, _embedded_stop))
+
+
+async def stop_embedded_workers(timeout: float = 10.0):
+    """Pide a los loops embebidos que terminen lo que tienen en mano (o los corta)."""
+    global _embedded_worker
+    if _embedded_worker is None:
+        return
+    _embedded_stop.set()
+    try:
+        await asyncio.wait_for(_embedded_worker, timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        pass
+    _embedded_worker = None
+
+
+@app.post("/upload")
 async def upload_invoices(
     request: Request,
     sistema: str = Form(...),
-    files: List[UploadFile] = File(...)
+    files: List[UploadFile] = File(...),
+    prioridad: str = Form(None),
 ):
-    results = []
+    # Se encola una tarea por archivo (los ZIP se expanden entrada por
+    # entrada); los workers (embebidos o externos) arrancan con las primeras
+    # mientras se siguen guardando las demás. El usuario va directo a la
+    # vista del lote, que se va llenando sola. Una subida chica va por el
+    # carril interactivo: no espera detrás de los lotes grandes (lanes.py).
+    has_zip = any((f.filename or "").lower().endswith(".zip") or "zip" in (f.content_type or "") for f in files)
+    lane = upload_lane(len(files), has_zip, prioridad)
+    batch_id = await asyncio.to_thread(open_batch, sistema, lane)
+    ensure_embedded_workers()
+    try:
+        await asyncio.to_thread(ingest_uploads, batch_id, [(f.filename, f.file) for f in files])
+    finally:
+        await asyncio.to_thread(close_batch, batch_id)
 
-    for file in files:
-        content_type = file.content_type or ""
-        file_bytes = await file.read()
+    return RedirectResponse(f"/batches/{batch_id}", status_code=303)
 
-        # Imagen (jpg, png, etc.)
-        if content_type.startswith("image/"):
-            data = await extract_invoice_data(file_bytes)
 
-        # PDF
-        elif content_type == "application/pdf":
-            data = await extract_invoice_data_from_pdf(file_bytes)
+# ---------- Vista de resultados paginada + API JSON ----------
 
-        # Otro formato: lo marcamos como no soportado
-        else:
-            data = {"error": f"Tipo de archivo no soportado: {content_type}"}
+RESULTS_PER_PAGE = int(os.getenv("RESULTS_PER_PAGE", "50"))
+
+# Archivos de exportación por sistema: (clave, nombre de descarga)
+EXPORTS = {
+    "holistor": [("holistor", "Holistor.txt")],
+    "bejerman": [("ccabecer", "CCabecer.txt"), ("citems", "CItems.txt"), ("cregesp", "CRegEsp.txt")],
+    "tango": [("generico", "comprobantes.txt")],  # genérico hasta tener el layout real
+}
 
-        results.append(
-            {
-                "filename": file.filename,
-                "data": data,
-            }
-        )
 
-    # TXT principal (Holistor / Bejerman / Tango)
-    txt_content = ""
-    txt_citems_bejerman = ""
-    txt_cregesp_bejerman = ""
-
-    if sistema == "holistor":
-        txt_content = build_txt_content_holistor(results)
-
-    elif sistema == "bejerman":
-        txt_content = build_txt_content_bejerman(results)
-        txt_citems_bejerman = build_txt_citems_bejerman(results)
-        txt_cregesp_bejerman = build_txt_cregesp_bejerman(results)
-
-    elif sistema == "tango":
-        txt_content = build_txt_content_tango(results)
-
-    return templates.TemplateResponse(
-        "results.html",
-        {
-            "request": request,
-            "results": results,
-            "txt_content": txt_content,
-            "txt_citems_bejerman": txt_citems_bejerman,
-            "txt_cregesp_bejerman": txt_cregesp_bejerman,
-            "sistema": sistema,
-        },
+def result_summary(r: dict) -> dict:
+    """Lo mínimo para listar un resultado (el detalle se pide aparte)."""
+    data = r["data"] or {}
+    dc = data.get("datos_comprobante", {}) or {}
+    em = data.get("emisor", {}) or {}
+    tot = data.get("totales", {}) or {}
+    mc = (r["meta"] or {}).get("math_check")
+    return {
+        "task_id": r["task_id"],
+        "n": r["n"],
+        "filename": r["filename"],
+        "tipo": dc.get("tipo", ""),
+        "letra": dc.get("letra", ""),
+        "punto_venta": dc.get("punto_venta", ""),
+        "numero_comprobante": dc.get("numero_comprobante", ""),
+        "fecha_emision": dc.get("fecha_emision", ""),
+        "emisor": em.get("razon_social", ""),
+        "cuit": em.get("cuit", ""),
+        "total": tot.get("total_comprobante"),
+        "error": data.get("error", ""),
+        "math_ok": None if not mc else mc.get("ok"),
+    }
+
+
+def export_lines(archivo: str, results):
+    """
+    Genera las líneas de un archivo de exportación a partir de un iterable
+    de resultados (sin armar el archivo entero en memoria).
+    """
+    if archivo == "holistor":
+        yield HOLISTOR_HEADER
+        for item in results:
+            yield build_txt_line_holistor(item.get("data", {}) or {})
+    elif archivo == "ccabecer":
+        for item in results:
+            yield build_bejerman_ccabecer_line(item.get("data", {}) or {})
+    elif archivo == "citems":
+        for item in results:
+            yield from bejerman_citems_lines(item.get("data", {}) or {})
+    elif archivo == "cregesp":
+        for item in results:
+            yield from bejerman_cregesp_lines(item.get("data", {}) or {})
+    elif archivo == "generico":
+        yield TXT_HEADER
+        for item in results:
+            yield build_txt_line(item.get("data", {}) or {})
+
+
+def _joined(lines):
+    """Como "\n".join(lines), pero de a una línea (para StreamingResponse)."""
+    first = True
+    for line in lines:
+        yield line if first else "\n" + line
+        first = False
+
+
+async def _load_batch(batch_id: str) -> dict:
+    batch = await asyncio.to_thread(get_batch, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Lote inexistente")
+    return batch
+
+
+async def _batch_status(batch_id: str) -> dict:
+    batch = await _load_batch(batch_id)
+    progress = await asyncio.to_thread(batch_progress, batch_id)
+    counts = await asyncio.to_thread(count_results, batch_id)
+    pending = progress.get("queued", 0) + progress.get("running", 0)
+    return {
+        "id": batch_id,
+        "sistema": batch["sistema"],
+        "archivos": batch["total"],
+        "progreso": progress,
+        "terminado": pending == 0 and not batch["open"],
+        "conteos": counts,
+    }
+
+
+@app.get("/batches/{batch_id}", response_class=HTMLResponse)
+async def batch_view(batch_id: str, page: int = 1, filtro: str = "todos"):
+    status = await _batch_status(batch_id)
+    if filtro not in RESULT_FILTERS:
+        filtro = "todos"
+    page = max(page, 1)
+
+    rows = await asyncio.to_thread(
+        page_results, batch_id, filtro, (page - 1) * RESULTS_PER_PAGE, RESULTS_PER_PAGE
     )
+    total = status["conteos"][filtro]
+    pages = max(1, math.ceil(total / RESULTS_PER_PAGE))
+
+    # Render en streaming: el navegador pinta el encabezado antes que la tabla
+    template = templates.get_template("results.html")
+    context = {
+        "batch": status,
+        "sistema": status["sistema"],
+        "exports": EXPORTS.get(status["sistema"], []),
+        "rows": [result_summary(r) for r in rows],
+        "page": page,
+        "pages": pages,
+        "per_page": RESULTS_PER_PAGE,
+        "filtro": filtro,
+        "filtros": list(RESULT_FILTERS),
+    }
+    return StreamingResponse(template.generate(context), media_type="text/html; charset=utf-8")
 
 
-# =================== Aca termina BEJERMAN ===================
+@app.get("/api/batches/{batch_id}")
+async def batch_status_api(batch_id: str):
+    return await _batch_status(batch_id)
 
-def build_txt_content_tango(results: List[dict]) -> str:
+
+# Cada cuánto se miran los eventos nuevos, y cada cuánto se manda un
+# comentario para que proxies / navegador no corten la conexión
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", "0.5"))
+EVENTS_KEEPALIVE_SECONDS = 15.0
+
+
+def _sse(event: str, data: dict, event_id: int = None) -> str:
+    out = f"event: {event}\n"
+    if event_id is not None:
+        out += f"id: {event_id}\n"
+    return out + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stage_event(ev: dict) -> dict:
+    """Un evento de task_events listo para mandar (con tiempos y resumen al terminar)."""
+    out = {
+        "task_id": ev["task_id"],
+        "seq": ev["seq"],
+        "filename": ev["filename"],
+        "stage": ev["stage"],
+        "at": ev["at"],
+        "info": ev["info"],
+    }
+    if ev["stage"] in ("exported", "failed"):
+        out["timings"] = await asyncio.to_thread(task_timings, ev["task_id"])
+        rows = await asyncio.to_thread(task_results, ev["task_id"])
+        out["results"] = [result_summary(r) for r in rows]
+    return out
+
+
+async def _batch_event_stream(batch_id: str, after_id: int):
+    last_sent = time.monotonic()
+    while True:
+        events = await asyncio.to_thread(batch_events, batch_id, after_id)
+        for ev in events:
+            after_id = ev["id"]
+            yield _sse("etapa", await _stage_event(ev), ev["id"])
+            last_sent = time.monotonic()
+        if events:
+            continue
+
+        status = await _batch_status(batch_id)
+        if status["terminado"]:
+            yield _sse("fin", status)
+            return
+        if time.monotonic() - last_sent > EVENTS_KEEPALIVE_SECONDS:
+            yield ": ping\n\n"
+            last_sent = time.monotonic()
+        await asyncio.sleep(EVENTS_POLL_SECONDS)
+
+
+@app.get("/api/batches/{batch_id}/events")
+async def batch_events_api(request: Request, batch_id: str, desde: int = 0):
     """
-    Placeholder para Tango.
-    Igual: después se adapta al layout real que nos pases.
+    Server-Sent Events con el avance de cada archivo del lote: un evento
+    "etapa" por cambio (queued, rendering, extracting, validated, exported /
+    failed; los dos últimos con tiempos por etapa y el resumen extraído) y un
+    "fin" con los totales cuando no queda nada pendiente. Al reconectar, el
+    navegador manda Last-Event-ID y se sigue desde ahí.
     """
-    return build_txt_content(results)
-    
+    await _load_batch(batch_id)
+    after_id = int(request.headers.get("last-event-id") or desde)
+    return StreamingResponse(
+        _batch_event_stream(batch_id, after_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/batches/{batch_id}/results")
+async def batch_results_api(batch_id: str, page: int = 1, filtro: str = "todos", per_page: int = RESULTS_PER_PAGE):
+    await _load_batch(batch_id)
+    if filtro not in RESULT_FILTERS:
+        raise HTTPException(status_code=400, detail=f"Filtro inválido: {filtro}")
+    page = max(page, 1)
+    per_page = max(1, min(per_page, 500))
+
+    counts = await asyncio.to_thread(count_results, batch_id)
+    rows = await asyncio.to_thread(page_results, batch_id, filtro, (page - 1) * per_page, per_page)
+    return {
+        "page": page,
+        "per_page": per_page,
+        "total": counts[filtro],
+        "results": [result_summary(r) for r in rows],
+    }
+
+
+@app.get("/api/batches/{batch_id}/results/{task_id}/{n}")
+async def batch_result_detail_api(batch_id: str, task_id: int, n: int):
+    r = await asyncio.to_thread(get_result, batch_id, task_id, n)
+    if r is None:
+        raise HTTPException(status_code=404, detail="Resultado inexistente")
+    return r
+
+
+@app.get("/batches/{batch_id}/export/{archivo}")
+async def batch_export(batch_id: str, archivo: str):
+    batch = await _load_batch(batch_id)
+    names = dict(EXPORTS.get(batch["sistema"], []))
+    if archivo not in names:
+        raise HTTPException(status_code=404, detail="Exportación inexistente para este sistema")
+
+    lines = export_lines(archivo, iter_batch_results(batch_id))
+    return StreamingResponse(
+        _joined(lines),
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{names[archivo]}"'},
+    )
+
+
+# ---------- Libro IVA (sumas incrementales, libro_iva.py) ----------
+
+_PERIODO_RE = re.compile(r"^\d{4}-\d{2}$")
+
+
+@app.get("/api/libro-iva")
+async def libro_iva_index():
+    """Períodos y CUIT con comprobantes en el libro."""
+    return {"periodos": await asyncio.to_thread(libro_iva_periodos)}
+
+
+@app.get("/api/libro-iva/{periodo}")
+async def libro_iva_api(periodo: str, cuit: str = None, proveedor: str = None):
+    """
+    Totales de un período (AAAA-MM) por alícuota, letra y tipo, y proveedor;
+    `cuit` filtra por el CUIT receptor (el dueño del libro) y `proveedor` por
+    el emisor. Para cruzar contra lo importado en Holistor / Bejerman.
+    """
+    if not _PERIODO_RE.match(periodo):
+        raise HTTPException(status_code=400, detail="Período inválido (AAAA-MM)")
+    cuit = "".join(ch for ch in cuit or "" if ch.isdigit()) or None
+    proveedor = "".join(ch for ch in proveedor or "" if ch.isdigit()) or None
+    alicuotas, totales = await asyncio.to_thread(libro_iva_rows, periodo, cuit, proveedor)
+    return {"periodo": periodo, "cuit": cuit, "proveedor": proveedor, **summarize(alicuotas, totales)}
+
+
+# ---------- Perfiles (profiling.py: header X-Profile: 1 o ?profile=1) ----------
+
+@app.get("/api/profiles")
+async def profiles_index():
+    """Perfiles guardados, el más reciente primero."""
+    return {"perfiles": await asyncio.to_thread(list_profiles)}
+
+
+@app.get("/api/profiles/{nombre}")
+async def profile_download(nombre: str):
+    """Stacks colapsados de un perfil (para flamegraph.pl, speedscope o inferno)."""
+    path = profile_path(nombre)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Perfil inexistente")
+    return FileResponse(path, media_type="text/plain; charset=utf-8", filename=nombre)
+
 
 # ----------------- Rutas -----------------
 
@@ -1289,6 +2045,18 @@ async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
+@app.get("/health")
+async def health():
+    """Para el balanceador / autoscaler: listo, tiempos de import y arranque, cliente caliente."""
+    return {
+        **_startup,
+        "workers_embebidos": EMBEDDED_WORKERS,
+        "carriles": await asyncio.to_thread(lane_stats),
+        "modelo": {**latency_stats(), **cascade_stats(), "json": _repair_stats},
+        "duplicados": _dedup_stats,
+    }
+
+
 #@app.post("/upload", response_class=HTMLResponse)
 #async def upload_invoices(
 #    request: Request,
@@ -1321,3 +2089,5 @@ async def home(request: Request):
 
 # 🔴 ACÁ ES DONDE TENÉS QUE CAMBIAR LA FUNCIÓN
 
+
+_startup["import_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
@@ -0,0 +1,179 @@
+"""
+Armado del body de /chat/completions sin copias intermedias.
+
+Antes, cada imagen pasaba por: bytes crudos -> bytes base64 -> str -> f-string
+con el data URL -> JSON serializado por el SDK -> bytes del body. Eso son ~5
+copias completas por imagen en vuelo, y es lo que limita cuántas extracciones
+puede tener un worker a la vez.
+
+Acá el JSON se escribe directo en un buffer reutilizable (PayloadBuffer):
+  - las partes fijas (modelo, response_format, prompt de sistema) son bytes
+    precalculados;
+  - el base64 de cada imagen se copia UNA vez al buffer: con readinto() si el
+    pool de CPU lo dejó en un archivo temporal, o tal cual si vino en memoria;
+  - el body se manda como memoryviews del buffer (sin armar un bytes nuevo).
+"""
+import json
+import os
+
+
+_CHUNK = 64 * 1024
+
+# Buffers guardados para reutilizar (y tope de tamaño de lo que se guarda)
+PAYLOAD_POOL_SIZE = int(os.getenv("PAYLOAD_POOL_SIZE", "8"))
+PAYLOAD_MAX_KEEP = int(os.getenv("PAYLOAD_MAX_KEEP", str(16 * 1024 * 1024)))
+
+_free = []
+
+
+class PayloadBuffer:
+    """bytearray que crece por duplicación y se reutiliza entre requests."""
+
+    def __init__(self, capacity: int = 1024 * 1024):
+        self._buf = bytearray(capacity)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buf)
+
+    def reset(self):
+        self._len = 0
+
+    def _reserve(self, n: int) -> memoryview:
+        need = self._len + n
+        if need > len(self._buf):
+            new = bytearray(max(need, len(self._buf) * 2))
+            new[:self._len] = memoryview(self._buf)[:self._len]
+            self._buf = new
+        return memoryview(self._buf)[self._len:need]
+
+    def write(self, data):
+        n = len(data)
+        self._reserve(n)[:] = data
+        self._len += n
+
+    def write_file(self, path: str):
+        """Copia un archivo entero al buffer (readinto: sin bytes intermedios)."""
+        size = os.path.getsize(path)
+        target = self._reserve(size)
+        with open(path, "rb", buffering=0) as f:
+            read = 0
+            while read < size:
+                n = f.readinto(target[read:])
+                if not n:
+                    break
+                read += n
+        self._len += read
+
+    def write_ref(self, ref):
+        """`ref` de cpu_pool: bytes en memoria o ruta a un archivo del spool."""
+        if isinstance(ref, str):
+            self.write_file(ref)
+        else:
+            self.write(ref)
+
+    def chunks(self) -> list:
+        """El contenido como lista de memoryviews (re-iterable si el SDK reintenta)."""
+        view = memoryview(self._buf)[:self._len]
+        return [view[i:i + _CHUNK] for i in range(0, self._len, _CHUNK)]
+
+    def async_chunks(self) -> "_AsyncChunks":
+        """chunks() para el cliente async (también re-iterable)."""
+        return _AsyncChunks(self.chunks())
+
+    def getvalue(self) -> bytes:
+        return bytes(memoryview(self._buf)[:self._len])
+
+
+class _AsyncChunks:
+    def __init__(self, chunks: list):
+        self._chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+def acquire_buffer() -> PayloadBuffer:
+    if _free:
+        buf = _free.pop()
+        buf.reset()
+        return buf
+    return PayloadBuffer()
+
+
+def release_buffer(buf: PayloadBuffer):
+    buf.reset()
+    if len(_free) < PAYLOAD_POOL_SIZE and buf.capacity <= PAYLOAD_MAX_KEEP:
+        _free.append(buf)
+
+
+# ---------- Body de chat/completions ----------
+
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+_heads = {}
+
+# El tipo de la imagen se reconoce por el comienzo de su base64 (JPEG si no se sabe)
+_B64_MIMES = ((b"/9j/", "image/jpeg"), (b"iVBOR", "image/png"), (b"UklGR", "image/webp"), (b"R0lGOD", "image/gif"))
+_IMAGE_OPENS = {
+    mime: b'{"type":"image_url","image_url":{"url":"data:' + mime.encode() + b';base64,'
+    for mime in ("image/jpeg", "image/png", "image/webp", "image/gif")
+}
+_IMAGE_CLOSE = b'"}}'
+
+
+def _image_open(ref) -> bytes:
+    if isinstance(ref, str):
+        with open(ref, "rb") as f:
+            head = f.read(8)
+    else:
+        head = bytes(ref[:8])
+    return _IMAGE_OPENS[next((m for prefix, m in _B64_MIMES if head.startswith(prefix)), "image/jpeg")]
+
+
+def _head(model: str, response_format: dict, system_prompt: str) -> bytes:
+    """Parte fija del body (cacheada: mismos bytes en cada llamada)."""
+    key = (model, response_format["json_schema"]["name"] if response_format else None, system_prompt)
+    head = _heads.get(key)
+    if head is None:
+        head = (
+            b'{"model":' + _dumps(model)
+            + (b',"response_format":' + _dumps(response_format) if response_format else b"")
+            + b',"messages":[{"role":"system","content":' + _dumps(system_prompt)
+            + b'},{"role":"user","content":['
+        )
+        _heads[key] = head
+    return head
+
+
+def write_chat_body(buf: PayloadBuffer, model: str, response_format: dict,
+                    system_prompt: str, parts: list, followup: list = None):
+    """
+    Escribe el body JSON completo en `buf`.
+
+    parts: lista de ("text", str) o ("image", ref_base64), en orden.
+    followup: mensajes que siguen al del usuario, [(rol, texto)] (p. ej. la
+    respuesta cortada del asistente y el pedido de que continúe).
+    response_format None = respuesta de texto libre.
+    """
+    buf.write(_head(model, response_format, system_prompt))
+    for n, (kind, value) in enumerate(parts):
+        if n:
+            buf.write(b",")
+        if kind == "text":
+            buf.write(b'{"type":"text","text":' + _dumps(value) + b"}")
+        else:
+            buf.write(_image_open(value))
+            buf.write_ref(value)
+            buf.write(_IMAGE_CLOSE)
+    buf.write(b"]}")
+    for role, text in followup or []:
+        buf.write(b',{"role":' + _dumps(role) + b',"content":' + _dumps(text) + b"}")
+    buf.write(b"]}")
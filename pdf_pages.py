@@ -0,0 +1,341 @@
+"""
+Clasificación local y barata de páginas de un PDF, antes de llamar a la IA.
+
+Los PDFs argentinos suelen traer ORIGINAL / DUPLICADO / TRIPLICADO del mismo
+comprobante, hojas de términos, remitos o páginas en blanco del escáner, y los
+lotes escaneados meten muchos comprobantes en un solo PDF. Acá se decide, sólo
+con PyMuPDF (texto, QR y hash de imagen), qué páginas forman cada comprobante
+distinto, así se hace UNA llamada al modelo por comprobante.
+"""
+import re
+
+import fitz  # PyMuPDF
+
+
+_COPY_RE = re.compile(r"\b(ORIGINAL|DUPLICADO|TRIPLICADO|CUADRUPLICADO)\b", re.I)
+
+_FISCAL_RE = re.compile(
+    r"C\.?\s?A\.?\s?E\b|FACTURA|NOTA\s+DE\s+(CR[EÉ]DITO|D[EÉ]BITO)|TIQUE|TICKET|COMP\.?\s*NRO",
+    re.I,
+)
+_NON_FISCAL_RE = re.compile(
+    r"\bREMITO\b|T[EÉ]RMINOS\s+Y\s+CONDICIONES|CONDICIONES\s+GENERALES",
+    re.I,
+)
+
+# "Punto de Venta: 00003  Comp. Nro: 00001234" (comprobante en línea de AFIP)
+_PV_NRO_AFIP_RE = re.compile(
+    r"Punto\s+de\s+Venta:?\s*(\d{1,5}).{0,40}?Comp\.?\s*Nro:?\s*(\d{1,8})",
+    re.I | re.S,
+)
+# "N° 0003-00001234" / "0003 - 00001234"
+_PV_NRO_RE = re.compile(r"\b(\d{4,5})\s?-\s?(\d{8})\b")
+_CUIT_RE = re.compile(r"\b(\d{2})-?(\d{8})-?(\d)\b")
+_CAE_RE = re.compile(r"C\.?\s?A\.?\s?E\.?[^\d]{0,20}(\d{14})", re.I)
+
+_AFIP_QR_HOSTS = ("afip.gob.ar/fe/qr", "arca.gob.ar/fe/qr")
+
+# Umbral de "página en blanco": fracción de píxeles oscuros a 40 dpi
+_BLANK_DARK_RATIO = 0.004
+
+# Distancia de Hamming máxima (sobre 256 bits) para considerar dos
+# páginas escaneadas como copias de la misma hoja
+_HASH_MAX_DISTANCE = 12
+
+
+_DARK_BYTES = bytes(range(200))
+
+
+def _dark_ratio(page) -> float:
+    pix = page.get_pixmap(dpi=40, colorspace=fitz.csGRAY)
+    samples = pix.samples
+    if not samples:
+        return 0.0
+    # translate() borra los bytes oscuros en C; la diferencia de largo los cuenta
+    dark = len(samples) - len(samples.translate(None, _DARK_BYTES))
+    return dark / len(samples)
+
+
+def page_hash(page) -> int:
+    """dHash de 16x16 (256 bits) sobre una miniatura en grises de la página."""
+    w, h = 17, 16
+    rect = page.rect
+    matrix = fitz.Matrix(w / rect.width, h / rect.height)
+    pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY)
+    samples, stride = pix.samples, pix.stride
+
+    bits = 0
+    for y in range(min(h, pix.height)):
+        row = samples[y * stride:y * stride + pix.width]
+        for x in range(min(w, pix.width) - 1):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return bits
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _has_qr(page) -> bool:
+    """
+    QR fiscal: link a la URL de AFIP/ARCA, o imagen embebida cuadrada y chica
+    en el tercio inferior (donde va el QR; los logos suelen ir arriba).
+    """
+    for link in page.get_links():
+        uri = (link.get("uri") or "").lower()
+        if any(host in uri for host in _AFIP_QR_HOSTS):
+            return True
+    page_rect = page.rect
+    for img in page.get_images(full=True):
+        for r in page.get_image_rects(img[0]):
+            if (
+                20 < r.width < page_rect.width / 3
+                and abs(r.width - r.height) < 0.1 * r.width
+                and r.y0 > page_rect.height * 2 / 3
+            ):
+                return True
+    return False
+
+
+def _invoice_key(text: str) -> str:
+    """Identidad del comprobante: CUIT emisor + punto de venta + número (o CAE)."""
+    cuit = ""
+    m = _CUIT_RE.search(text)
+    if m:
+        cuit = "".join(m.groups())
+
+    m = _PV_NRO_AFIP_RE.search(text) or _PV_NRO_RE.search(text)
+    if m:
+        return f"{cuit}|{int(m.group(1)):05d}-{int(m.group(2)):08d}"
+
+    m = _CAE_RE.search(text)
+    if m:
+        return f"{cuit}|CAE{m.group(1)}"
+    return ""
+
+
+def describe_page(page) -> dict:
+    """Rasgos baratos de una página (sin llamar a la IA)."""
+    text = page.get_text("text") or ""
+    has_text = bool(text.strip())
+    copy_m = _COPY_RE.search(text)
+
+    info = {
+        "page": page.number,
+        "has_text": has_text,
+        "copy": copy_m.group(1).upper() if copy_m else "",
+        "fiscal": bool(_FISCAL_RE.search(text)),
+        "non_fiscal": bool(_NON_FISCAL_RE.search(text)) and not _CAE_RE.search(text),
+        "qr": _has_qr(page),
+        "key": _invoice_key(text) if has_text else "",
+        # texto sin la leyenda de copia: igual en ORIGINAL y DUPLICADO
+        "text_sig": hash(" ".join(_COPY_RE.sub("", text).split())) if has_text else None,
+        "blank": False,
+        "hash": None,
+    }
+
+    if not has_text:
+        # Escaneo: decidimos por la imagen
+        info["blank"] = _dark_ratio(page) < _BLANK_DARK_RATIO
+        if not info["blank"]:
+            info["hash"] = page_hash(page)
+    return info
+
+
+def classify_pdf(doc) -> dict:
+    """
+    Agrupa las páginas de un documento fitz en comprobantes distintos.
+
+    Devuelve:
+      {
+        "invoices": [{"pages": [0, 1], "key": "...", "copy": "ORIGINAL"}, ...],
+        "skipped":  [{"page": 2, "reason": "copia"}, ...],
+      }
+
+    Reglas:
+      - páginas en blanco y no fiscales (remitos, términos) se descartan;
+      - misma clave con otra leyenda de copia (DUPLICADO...) => copia, se descarta;
+      - misma clave y misma leyenda => hoja siguiente del mismo comprobante;
+      - mismo texto que una hoja ya tomada (salvo la leyenda) => copia;
+      - escaneos sin texto: casi idénticos (hash) a una hoja ya tomada => copia;
+        si no, comprobante tentativo ("scan": True). Sin texto no se sabe si
+        la hoja tiene encabezado propio: si al leerla no trae CUIT ni número,
+        main la suma al comprobante anterior como hoja de continuación;
+      - página fiscal sin clave detrás de un comprobante => hoja siguiente
+        (con la misma leyenda o sin leyenda) o copia (con otra leyenda);
+      - página fiscal con clave nueva => nuevo comprobante.
+    """
+    invoices = []
+    skipped = []
+    by_key = {}          # clave -> comprobante
+    kept_hashes = []     # hashes de páginas escaneadas ya tomadas
+    kept_texts = set()   # firmas de texto de páginas ya tomadas
+
+    for page in doc:
+        info = describe_page(page)
+        current = invoices[-1] if invoices else None
+
+        if info["blank"]:
+            skipped.append({"page": info["page"], "reason": "en_blanco"})
+            continue
+
+        # ----- Escaneo sin capa de texto -----
+        if not info["has_text"]:
+            h = info["hash"]
+            if any(_hamming(h, k) <= _HASH_MAX_DISTANCE for k in kept_hashes):
+                skipped.append({"page": info["page"], "reason": "copia"})
+                continue
+            kept_hashes.append(h)
+            invoices.append({"pages": [info["page"]], "key": "", "copy": "", "scan": True})
+            continue
+
+        # ----- Página con texto -----
+        if info["non_fiscal"] and not info["qr"]:
+            skipped.append({"page": info["page"], "reason": "no_fiscal"})
+            continue
+
+        if info["text_sig"] in kept_texts:
+            skipped.append({"page": info["page"], "reason": "copia"})
+            continue
+        kept_texts.add(info["text_sig"])
+
+        key = info["key"]
+        if key and key in by_key:
+            inv = by_key[key]
+            if info["copy"] and inv["copy"] and info["copy"] != inv["copy"]:
+                skipped.append({"page": info["page"], "reason": "copia"})
+            elif inv is current:
+                inv["pages"].append(info["page"])
+            else:
+                # misma clave, no consecutiva y sin leyenda distinta: re-impresión
+                skipped.append({"page": info["page"], "reason": "copia"})
+            continue
+
+        if key or info["fiscal"] or info["qr"]:
+            if not key and current is not None and not info["qr"]:
+                if info["copy"] and current["copy"] and info["copy"] != current["copy"]:
+                    # hoja siguiente de otra copia (DUPLICADO...) del comprobante
+                    skipped.append({"page": info["page"], "reason": "copia"})
+                else:
+                    # hoja de continuación sin encabezado propio (p.ej. más
+                    # ítems), aunque repita la leyenda ORIGINAL
+                    current["pages"].append(info["page"])
+                continue
+            inv = {"pages": [info["page"]], "key": key, "copy": info["copy"]}
+            invoices.append(inv)
+            if key:
+                by_key[key] = inv
+            continue
+
+        # Texto sin marcas fiscales: continuación del comprobante en curso
+        if current is not None:
+            current["pages"].append(info["page"])
+        else:
+            skipped.append({"page": info["page"], "reason": "no_fiscal"})
+
+    return {"invoices": invoices, "skipped": skipped}
+
+
+# ---------- Regiones de interés (encabezado / ítems / totales) ----------
+
+_ITEMS_HEADER_RE = re.compile(
+    r"\b(DESCRIPCI[OÓ]N|DETALLE|PRODUCTO|ART[IÍ]CULO|CANTIDAD|CANT\.|P\.?\s?UNIT|PRECIO)\b",
+    re.I,
+)
+_TOTALS_RE = re.compile(
+    r"\b(SUBTOTAL|SUB\s?TOTAL|IMPORTE\s+NETO|IMPORTE\s+TOTAL|TOTAL|C\.?\s?A\.?\s?E)\b",
+    re.I,
+)
+
+# Desde cuántas líneas de texto en la zona de ítems se considera "denso"
+ROI_MIN_ITEM_LINES = 12
+
+
+def find_regions(page, min_item_lines: int = ROI_MIN_ITEM_LINES):
+    """
+    Ubica encabezado, tabla de ítems y pie (totales / CAE) con los bloques de
+    texto de PyMuPDF. Devuelve {"encabezado": Rect, "items": Rect, "totales": Rect}
+    o None si no se reconoce la estructura o la tabla tiene menos de
+    `min_item_lines` líneas.
+    """
+    rect = page.rect
+    blocks = page.get_text("blocks")
+    if not blocks:
+        return None
+
+    items_y = None
+    for x0, y0, x1, y1, text, *_ in sorted(blocks, key=lambda b: b[1]):
+        if _ITEMS_HEADER_RE.search(text):
+            items_y = y0
+            break
+    if items_y is None:
+        return None
+
+    # El pie arranca en el primer bloque de totales debajo de la tabla
+    footer_y = None
+    for x0, y0, x1, y1, text, *_ in sorted(blocks, key=lambda b: b[1]):
+        if y0 > items_y + 10 and y0 > rect.height / 2 and _TOTALS_RE.search(text):
+            footer_y = y0
+            break
+    if footer_y is None:
+        return None
+
+    lines = page.get_text("dict")["blocks"]
+    item_lines = sum(
+        1
+        for b in lines
+        for ln in b.get("lines", [])
+        if items_y <= ln["bbox"][1] < footer_y
+    )
+    if item_lines < min_item_lines:
+        return None
+
+    # Sólo la zona con contenido: sin márgenes en blanco alrededor
+    margin = 6
+    x0 = max(0, min(b[0] for b in blocks) - margin)
+    x1 = min(rect.width, max(b[2] for b in blocks) + margin)
+    top = max(0, min(b[1] for b in blocks) - margin)
+    bottom = min(rect.height, max(b[3] for b in blocks) + margin)
+    if page.get_images():
+        # el QR / código de barras del pie puede no tener texto: dejamos el pie completo
+        bottom = rect.height
+
+    return {
+        "encabezado": fitz.Rect(x0, top, x1, items_y),
+        "items": fitz.Rect(x0, max(0, items_y - margin), x1, footer_y),
+        "totales": fitz.Rect(x0, max(0, footer_y - margin), x1, bottom),
+    }
+
+
+# ---------- Render ----------
+
+def render_pages(doc, pages, dpi: int, tiling: str = "auto", dpi_factors: dict = None,
+                 max_dpi: int = 300, max_pages: int = 3):
+    """
+    Renderiza a JPEG las páginas de un comprobante. Devuelve (imágenes, recortado).
+
+    tiling: "auto" recorta sólo páginas con tabla de ítems densa, "on" siempre
+    que se reconozcan las regiones, "off" página entera. Cada recorte va a
+    dpi * dpi_factors[región] (tope max_dpi).
+    """
+    images = []
+    tiled = False
+    for page_no in list(pages)[:max_pages]:
+        page = doc.load_page(page_no)
+
+        regions = None
+        if tiling == "auto":
+            regions = find_regions(page)
+        elif tiling == "on":
+            regions = find_regions(page, min_item_lines=0)
+
+        if regions:
+            tiled = True
+            for name, clip in regions.items():
+                region_dpi = min(round(dpi * dpi_factors[name]), max_dpi)
+                pix = page.get_pixmap(dpi=region_dpi, clip=clip)
+                images.append(pix.tobytes("jpeg"))
+        else:
+            pix = page.get_pixmap(dpi=dpi)
+            images.append(pix.tobytes("jpeg"))
+    return images, tiled
@@ -0,0 +1,216 @@
+"""
+Profiling opcional por request: un muestreador estadístico que guarda stacks
+"colapsados" (el formato de flamegraph.pl / speedscope / inferno) para ver
+dónde se va el tiempo de Python de un request lento sin redeployar.
+
+Se activa para un request con el header `X-Profile: 1` o `?profile=1`, o al
+azar con PROFILE_SAMPLE_RATE. Mientras dura el request (incluido el cuerpo
+de un StreamingResponse, p. ej. una exportación) un thread toma cada
+PROFILE_INTERVAL_MS el stack de todos los threads del proceso: el loop, los
+de asyncio.to_thread y los workers embebidos. Los threads parados esperando
+(select, colas, locks) no se cuentan, así que el gráfico muestra CPU de
+Python, no esperas al modelo. Lo que corre en el pool de procesos
+(cpu_pool: rasterizado de PDF) aparece como el thread que espera el
+resultado, no por dentro.
+
+  PROFILE_DIR           carpeta de los perfiles (por defecto data/profiles)
+  PROFILE_ON_DEMAND     1 = se acepta el header / query flag
+  PROFILE_SAMPLE_RATE   fracción de requests que se perfilan solos (0 = ninguno)
+  PROFILE_INTERVAL_MS   intervalo de muestreo
+  PROFILE_MAX_SECONDS   tope de muestreo por request (SSE y descargas largas)
+  PROFILE_MAX_ACTIVE    perfiles simultáneos (acota el costo)
+  PROFILE_KEEP          perfiles que se guardan (los más viejos se borran)
+
+Cada perfil es un archivo `.folded`: una línea por stack distinto,
+"thread;módulo:función;...;módulo:función cantidad".
+"""
+import asyncio
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from store import DATA_DIR
+
+
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(DATA_DIR, "profiles")
+PROFILE_ON_DEMAND = os.getenv("PROFILE_ON_DEMAND", "1") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_MAX_ACTIVE = int(os.getenv("PROFILE_MAX_ACTIVE", "2"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+
+PROFILE_HEADER = b"x-profile"
+
+# Archivo de la hoja del stack => el thread está esperando, no ejecutando
+_IDLE_FILES = {"threading.py", "selectors.py", "queue.py"}
+
+# 20261018-142233-512-GET-batches_abc_export_citems-1a2b.folded (hora de inicio con ms);
+# la duración sale de la fecha de modificación (el archivo se escribe al terminar)
+_NAME_RE = re.compile(r"^(\d{8}-\d{6}-\d{3})-([A-Z]+)-([\w.-]*)-[0-9a-f]{4}\.folded$")
+
+_active = []
+_active_lock = threading.Lock()
+_frame_names = {}
+
+
+def _frame_name(code) -> str:
+    name = _frame_names.get(code)
+    if name is None:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        name = _frame_names[code] = f"{module}:{code.co_name}"
+    return name
+
+
+class Profile:
+    """Un muestreo en curso (ver start_profile)."""
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._started = time.perf_counter()
+        slug = re.sub(r"[^\w.-]+", "_", path.strip("/"))[:80]
+        self.name = (f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')[:-3]}-{method}-{slug}-"
+                     f"{random.getrandbits(16):04x}.folded")
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _sample(self, names: dict, own: int):
+        for ident, frame in sys._current_frames().items():
+            if ident == own or os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        own = threading.get_ident()
+        interval = PROFILE_INTERVAL_MS / 1000
+        deadline = self._started + PROFILE_MAX_SECONDS
+        while not self._stop.wait(interval) and time.perf_counter() < deadline:
+            names = {t.ident: t.name.split(" ")[0] for t in threading.enumerate()}
+            self._sample(names, own)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Corta el muestreo y guarda el perfil en PROFILE_DIR/self.name."""
+        self._stop.set()
+        self._thread.join()
+        with _active_lock:
+            if self in _active:
+                _active.remove(self)
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        tmp = os.path.join(PROFILE_DIR, self.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+        os.replace(tmp, os.path.join(PROFILE_DIR, self.name))
+        _prune()
+
+
+def wants_profile(header: str = None, flag: str = None) -> bool:
+    """¿Se perfila este request? (pedido explícito o sorteo por PROFILE_SAMPLE_RATE)."""
+    if PROFILE_ON_DEMAND and ((header or "") == "1" or (flag or "") == "1"):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_profile(method: str, path: str):
+    """Arranca un muestreo, o None si ya hay PROFILE_MAX_ACTIVE en curso."""
+    with _active_lock:
+        if len(_active) >= PROFILE_MAX_ACTIVE:
+            return None
+        profile = Profile(method, path)
+        _active.append(profile)
+    profile.start()
+    return profile
+
+
+def _prune():
+    names = sorted(n for n in os.listdir(PROFILE_DIR) if _NAME_RE.match(n))
+    for name in names[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles() -> list:
+    """Perfiles guardados, el más reciente primero."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    out = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        m = _NAME_RE.match(name)
+        if not m:
+            continue
+        started = datetime.strptime(m.group(1), "%Y%m%d-%H%M%S-%f")
+        st = os.stat(os.path.join(PROFILE_DIR, name))
+        out.append({
+            "nombre": name,
+            "fecha": started.isoformat(timespec="seconds"),
+            "ms": max(round((st.st_mtime - started.timestamp()) * 1000), 0),
+            "metodo": m.group(2),
+            "ruta": m.group(3),
+            "bytes": st.st_size,
+        })
+    return out
+
+
+def profile_path(name: str):
+    """Ruta de un perfil guardado (None si el nombre no es de un perfil o no existe)."""
+    if not _NAME_RE.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+class ProfilingMiddleware:
+    """
+    Middleware ASGI: perfila los requests elegidos por wants_profile() hasta
+    que se manda el último pedazo del cuerpo, y devuelve el nombre del
+    archivo en el header X-Profile-Id.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/api/profiles"):
+            return await self.app(scope, receive, send)
+        header = dict(scope["headers"]).get(PROFILE_HEADER, b"").decode("latin-1")
+        flag = "1" if re.search(rb"(^|&)profile=1(&|$)", scope.get("query_string", b"")) else None
+        profile = start_profile(scope["method"], scope["path"]) if wants_profile(header, flag) else None
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        stopped = False
+
+        async def send_profiled(message):
+            nonlocal stopped
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile.name.encode())]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                stopped = True
+                await asyncio.to_thread(profile.stop)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            if not stopped:
+                await asyncio.to_thread(profile.stop)
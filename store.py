@@ -0,0 +1,958 @@
+"""
+Cola durable y almacén de resultados compartido (SQLite + archivos).
+
+El proceso web sólo guarda los archivos subidos y encola una tarea por
+archivo; los workers (worker.py, en otros procesos u otros hosts que vean el
+mismo filesystem) toman tareas con un lease, mandan heartbeats mientras
+trabajan y guardan los resultados acá. Si un worker muere, su lease vence y
+la tarea vuelve a estar disponible para otro (hasta TASK_MAX_ATTEMPTS).
+
+  - FACTURAS_DATA_DIR   carpeta compartida (base SQLite + archivos subidos)
+  - TASK_LEASE_SECONDS  duración del lease (se renueva con cada heartbeat)
+  - TASK_MAX_ATTEMPTS   intentos antes de marcar la tarea como fallida
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+from cpu_pool import heic_available
+from lanes import BULK, LANES, pick_lane
+from libro_iva import TOTAL_COLUMNS, invoice_contributions
+
+
+DATA_DIR = os.getenv("FACTURAS_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+DB_PATH = os.path.join(DATA_DIR, "facturas.db")
+UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+
+TASK_LEASE_SECONDS = float(os.getenv("TASK_LEASE_SECONDS", "60"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id          TEXT PRIMARY KEY,
+    sistema     TEXT NOT NULL,
+    total       INTEGER NOT NULL,
+    created     REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tasks (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id      TEXT NOT NULL REFERENCES batches(id),
+    seq           INTEGER NOT NULL,
+    filename      TEXT NOT NULL,
+    content_type  TEXT NOT NULL,
+    kind          TEXT NOT NULL,
+    path          TEXT NOT NULL,
+    size          INTEGER NOT NULL,
+    content_hash  TEXT NOT NULL,
+    status        TEXT NOT NULL DEFAULT 'queued',
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    lease_owner   TEXT,
+    lease_until   REAL,
+    error         TEXT,
+    created       REAL NOT NULL,
+    updated       REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_claim ON tasks(status, lease_until);
+CREATE INDEX IF NOT EXISTS tasks_batch ON tasks(batch_id, seq);
+CREATE INDEX IF NOT EXISTS tasks_hash ON tasks(content_hash, status);
+
+CREATE TABLE IF NOT EXISTS results (
+    task_id   INTEGER NOT NULL REFERENCES tasks(id),
+    batch_id  TEXT NOT NULL,
+    seq       INTEGER NOT NULL,
+    n         INTEGER NOT NULL,
+    filename  TEXT NOT NULL,
+    data      TEXT NOT NULL,
+    meta      TEXT NOT NULL,
+    math_ok   INTEGER,
+    has_error INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (task_id, n)
+);
+CREATE INDEX IF NOT EXISTS results_batch ON results(batch_id, seq, n);
+
+CREATE TABLE IF NOT EXISTS task_events (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id  TEXT NOT NULL,
+    task_id   INTEGER NOT NULL,
+    stage     TEXT NOT NULL,
+    at        REAL NOT NULL,
+    info      TEXT
+);
+CREATE INDEX IF NOT EXISTS task_events_batch ON task_events(batch_id, id);
+
+CREATE TABLE IF NOT EXISTS iva_comprobantes (
+    clave     TEXT PRIMARY KEY,
+    task_id   INTEGER NOT NULL,
+    aporte    TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS iva_totales (
+    periodo             TEXT NOT NULL,
+    receptor            TEXT NOT NULL,
+    emisor              TEXT NOT NULL,
+    letra               TEXT NOT NULL,
+    tipo                TEXT NOT NULL,
+    razon_social        TEXT NOT NULL,
+    comprobantes        INTEGER NOT NULL,
+    neto_gravado        REAL NOT NULL,
+    no_gravado          REAL NOT NULL,
+    exento              REAL NOT NULL,
+    iva                 REAL NOT NULL,
+    percepciones_iva    REAL NOT NULL,
+    percepciones_iibb   REAL NOT NULL,
+    percepciones_otras  REAL NOT NULL,
+    total               REAL NOT NULL,
+    PRIMARY KEY (periodo, receptor, emisor, letra, tipo)
+);
+CREATE INDEX IF NOT EXISTS iva_totales_emisor ON iva_totales(periodo, emisor);
+
+CREATE TABLE IF NOT EXISTS iva_alicuotas (
+    periodo       TEXT NOT NULL,
+    receptor      TEXT NOT NULL,
+    emisor        TEXT NOT NULL,
+    letra         TEXT NOT NULL,
+    tipo          TEXT NOT NULL,
+    alicuota      REAL NOT NULL,
+    comprobantes  INTEGER NOT NULL,
+    neto          REAL NOT NULL,
+    iva           REAL NOT NULL,
+    PRIMARY KEY (periodo, receptor, emisor, letra, tipo, alicuota)
+);
+CREATE INDEX IF NOT EXISTS iva_alicuotas_emisor ON iva_alicuotas(periodo, emisor);
+
+CREATE TABLE IF NOT EXISTS supplier_templates (
+    cuit         TEXT NOT NULL,
+    fingerprint  TEXT NOT NULL,
+    tokens       TEXT NOT NULL,
+    fields       TEXT NOT NULL,
+    hits         INTEGER NOT NULL DEFAULT 0,
+    misses       INTEGER NOT NULL DEFAULT 0,
+    created      REAL NOT NULL,
+    updated      REAL NOT NULL,
+    PRIMARY KEY (cuit, fingerprint)
+);
+
+CREATE TABLE IF NOT EXISTS watch_batches (
+    carpeta   TEXT NOT NULL,
+    periodo   TEXT NOT NULL,
+    batch_id  TEXT NOT NULL,
+    PRIMARY KEY (carpeta, periodo)
+);
+"""
+
+# Etapas por archivo (task_events), en el orden en que se recorren. Un
+# reintento vuelve a "queued"; "failed" es final.
+STAGES = ("queued", "rendering", "extracting", "validated", "exported", "failed")
+
+# Columnas agregadas después de crear la tabla: (tabla, columna, definición)
+_MIGRATIONS = [
+    ("results", "math_ok", "INTEGER"),
+    ("results", "has_error", "INTEGER NOT NULL DEFAULT 0"),
+    ("batches", "open", "INTEGER NOT NULL DEFAULT 0"),
+    ("batches", "lane", "TEXT NOT NULL DEFAULT 'bulk'"),
+    ("tasks", "lane", "TEXT NOT NULL DEFAULT 'bulk'"),
+]
+
+_initialized = False
+
+
+def connect() -> sqlite3.Connection:
+    """Conexión nueva (una por llamada: sirve igual desde hilos, procesos y hosts)."""
+    global _initialized
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout = 30000")
+    if not _initialized:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(_SCHEMA)
+        for table, column, definition in _MIGRATIONS:
+            cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+            if column not in cols:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        _initialized = True
+    return conn
+
+
+def _task_kind(content_type: str) -> str:
+    if content_type == "application/pdf":
+        return "pdf"
+    if content_type == "image/tiff":
+        return "tiff"  # puede tener varias hojas: no se empaqueta, va como PDF
+    if content_type == "image/heic" and not heic_available():
+        return "unsupported"
+    if content_type.startswith("image/"):
+        return "image"
+    return "unsupported"
+
+
+# ---------- Lado web ----------
+
+def open_batch(sistema: str, lane: str = BULK) -> str:
+    """
+    Crea un lote vacío y abierto: los archivos se agregan de a uno (add_file)
+    y los workers pueden ir tomándolos mientras sigue la subida. El lote no
+    cuenta como terminado hasta close_batch. `lane`: carril de prioridad
+    de sus tareas (lanes.py).
+    """
+    batch_id = uuid.uuid4().hex
+    os.makedirs(os.path.join(UPLOADS_DIR, batch_id), exist_ok=True)
+    conn = connect()
+    try:
+        conn.execute(
+            "INSERT INTO batches (id, sistema, total, created, open, lane) VALUES (?, ?, 0, ?, 1, ?)",
+            (batch_id, sistema, time.time(), lane if lane in LANES else BULK),
+        )
+    finally:
+        conn.close()
+    return batch_id
+
+
+def close_batch(batch_id: str):
+    conn = connect()
+    try:
+        conn.execute("UPDATE batches SET open = 0 WHERE id = ?", (batch_id,))
+    finally:
+        conn.close()
+
+
+def _insert_task(conn, batch_id: str, seq: int, filename: str, content_type: str, kind: str,
+                 path: str, size: int, content_hash: str, status: str, error: str, now: float) -> int:
+    cur = conn.execute(
+        "INSERT INTO tasks (batch_id, seq, filename, content_type, kind, path, size,"
+        " content_hash, status, error, created, updated, lane) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,"
+        " (SELECT lane FROM batches WHERE id = ?))",
+        (batch_id, seq, filename, content_type, kind, path, size, content_hash, status, error, now, now, batch_id),
+    )
+    conn.execute("UPDATE batches SET total = total + 1 WHERE id = ?", (batch_id,))
+    return cur.lastrowid
+
+
+def add_file(batch_id: str, seq: int, filename: str, content_type: str, chunks) -> int:
+    """
+    Guarda un archivo del lote en UPLOADS_DIR y lo encola.
+    `chunks` es un iterable de bytes (el archivo nunca está entero en memoria).
+    Si el iterable corta con una excepción, se borra lo escrito y se propaga.
+    """
+    path = os.path.join(UPLOADS_DIR, batch_id, f"{seq:05d}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        task_id = _insert_task(
+            conn, batch_id, seq, filename or f"archivo_{seq + 1}", content_type,
+            _task_kind(content_type), path, size, digest.hexdigest(), "queued", None, now,
+        )
+        _add_event(conn, task_id, "queued", now)
+        conn.execute("COMMIT")
+        return task_id
+    finally:
+        conn.close()
+
+
+def add_rejected(batch_id: str, seq: int, filename: str, error: str) -> int:
+    """Un archivo que no se encola (p.ej. excede los límites del ZIP): queda fallido con su error."""
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        task_id = _insert_task(
+            conn, batch_id, seq, filename, "", "unsupported", "", 0, "", "failed", error, now,
+        )
+        conn.execute(
+            "INSERT INTO results (task_id, batch_id, seq, n, filename, data, meta, has_error)"
+            " VALUES (?, ?, ?, 0, ?, ?, '{}', 1)",
+            (task_id, batch_id, seq, filename, json.dumps({"error": error}, ensure_ascii=False)),
+        )
+        _add_event(conn, task_id, "failed", now, {"error": error})
+        conn.execute("COMMIT")
+        return task_id
+    finally:
+        conn.close()
+
+
+def get_batch(batch_id: str):
+    conn = connect()
+    try:
+        row = conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def batch_progress(batch_id: str) -> dict:
+    """Cantidad de tareas por estado, p.ej. {"queued": 3, "running": 1, "done": 6}."""
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT status, COUNT(*) AS n FROM tasks WHERE batch_id = ? GROUP BY status",
+            (batch_id,),
+        ).fetchall()
+        return {r["status"]: r["n"] for r in rows}
+    finally:
+        conn.close()
+
+
+def batch_finished(batch_id: str) -> bool:
+    batch = get_batch(batch_id)
+    if batch is None or batch["open"]:
+        return False
+    progress = batch_progress(batch_id)
+    return not progress.get("queued") and not progress.get("running")
+
+
+def batch_events(batch_id: str, after_id: int = 0, limit: int = 500) -> list:
+    """Eventos de etapa del lote posteriores a `after_id` (cursor para SSE)."""
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT e.id, e.task_id, e.stage, e.at, e.info, t.filename, t.seq"
+            " FROM task_events e JOIN tasks t ON t.id = e.task_id"
+            " WHERE e.batch_id = ? AND e.id > ? ORDER BY e.id LIMIT ?",
+            (batch_id, after_id, limit),
+        ).fetchall()
+        return [
+            dict(r, info=json.loads(r["info"]) if r["info"] else None)
+            for r in rows
+        ]
+    finally:
+        conn.close()
+
+
+def task_timings(task_id: int) -> dict:
+    """
+    Segundos en cada etapa del último intento de la tarea, p.ej.
+    {"queued": 0.4, "rendering": 1.2, "extracting": 3.1, "validated": 0.0, "total": 4.7}.
+    """
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT stage, at FROM task_events WHERE task_id = ? ORDER BY id", (task_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    # Sólo cuenta desde el último "queued" (los intentos anteriores fallaron)
+    start = max((i for i, r in enumerate(rows) if r["stage"] == "queued"), default=0)
+    rows = rows[start:]
+    timings = {}
+    for cur, nxt in zip(rows, rows[1:]):
+        timings[cur["stage"]] = round(timings.get(cur["stage"], 0.0) + nxt["at"] - cur["at"], 3)
+    if rows:
+        timings["total"] = round(rows[-1]["at"] - rows[0]["at"], 3)
+    return timings
+
+
+def task_results(task_id: int) -> list:
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT task_id, n, filename, data, meta FROM results WHERE task_id = ? ORDER BY n",
+            (task_id,),
+        ).fetchall()
+        return [_row_to_result(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def _row_to_result(r) -> dict:
+    return {
+        "task_id": r["task_id"],
+        "n": r["n"],
+        "filename": r["filename"],
+        "data": json.loads(r["data"]),
+        "meta": json.loads(r["meta"]),
+    }
+
+
+def batch_results(batch_id: str) -> list:
+    """Resultados del lote en el orden de subida: [{"filename", "data", "meta"}, ...]."""
+    return list(iter_batch_results(batch_id))
+
+
+def iter_batch_results(batch_id: str, chunk: int = 200):
+    """Como batch_results pero de a `chunk` filas (para exportar lotes grandes)."""
+    conn = connect()
+    try:
+        cur = conn.execute(
+            "SELECT task_id, n, filename, data, meta FROM results WHERE batch_id = ? ORDER BY seq, n",
+            (batch_id,),
+        )
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            for r in rows:
+                yield _row_to_result(r)
+    finally:
+        conn.close()
+
+
+# Filtros del listado de resultados
+RESULT_FILTERS = {
+    "todos": "",
+    "errores_matematicos": " AND math_ok = 0",
+    "errores_extraccion": " AND has_error = 1",
+}
+
+
+def count_results(batch_id: str) -> dict:
+    """Totales del lote para cada filtro: {"todos": n, "errores_matematicos": n, ...}."""
+    conn = connect()
+    try:
+        r = conn.execute(
+            "SELECT COUNT(*) AS todos,"
+            " COALESCE(SUM(math_ok = 0), 0) AS errores_matematicos,"
+            " COALESCE(SUM(has_error = 1), 0) AS errores_extraccion"
+            " FROM results WHERE batch_id = ?",
+            (batch_id,),
+        ).fetchone()
+        return dict(r)
+    finally:
+        conn.close()
+
+
+def page_results(batch_id: str, filtro: str = "todos", offset: int = 0, limit: int = 50) -> list:
+    """Una página de resultados (orden de subida), filtrada en SQL."""
+    cond = RESULT_FILTERS.get(filtro, "")
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT task_id, n, filename, data, meta, math_ok, has_error FROM results"
+            f" WHERE batch_id = ?{cond} ORDER BY seq, n LIMIT ? OFFSET ?",
+            (batch_id, limit, offset),
+        ).fetchall()
+        return [_row_to_result(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def get_result(batch_id: str, task_id: int, n: int):
+    conn = connect()
+    try:
+        r = conn.execute(
+            "SELECT task_id, n, filename, data, meta FROM results WHERE batch_id = ? AND task_id = ? AND n = ?",
+            (batch_id, task_id, n),
+        ).fetchone()
+        return _row_to_result(r) if r else None
+    finally:
+        conn.close()
+
+
+# ---------- Lado worker ----------
+
+def claim_tasks(worker_id: str, limit: int = 1, kind: str = None, batch_id: str = None,
+                max_size: int = None, lanes: tuple = LANES) -> list:
+    """
+    Toma hasta `limit` tareas pendientes (o con lease vencido) con un lease a
+    nombre de `worker_id`. Atómico entre procesos (BEGIN IMMEDIATE).
+    kind / batch_id / max_size filtran (p.ej. juntar tickets chicos del mismo lote).
+
+    Sin batch_id, el carril sale de lanes.pick_lane: entre los de `lanes`
+    con tareas esperando, el que tiene menos corriendo (en todos los
+    workers) por unidad de peso. Dentro del carril, por orden de llegada.
+
+    No se toma un archivo que otro worker (de cualquier proceso) ya está
+    procesando con lease vigente: espera en la cola y, cuando aquel
+    termina, el que lo tome reusa sus resultados (reusable_results).
+    """
+    now = time.time()
+    where = (
+        "(status = 'queued' OR (status = 'running' AND lease_until < ?)) AND attempts < ?"
+        " AND NOT EXISTS (SELECT 1 FROM tasks AS o WHERE o.content_hash = tasks.content_hash"
+        " AND o.status = 'running' AND o.lease_until >= ? AND o.id != tasks.id)"
+    )
+    params = [now, TASK_MAX_ATTEMPTS, now]
+    if kind:
+        where += " AND kind = ?"
+        params.append(kind)
+    if batch_id:
+        where += " AND batch_id = ?"
+        params.append(batch_id)
+    if max_size is not None:
+        where += " AND size <= ?"
+        params.append(max_size)
+
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if batch_id is None:
+            waiting = [
+                lane for lane in lanes
+                if conn.execute(f"SELECT 1 FROM tasks WHERE {where} AND lane = ? LIMIT 1", params + [lane]).fetchone()
+            ]
+            if not waiting:
+                conn.execute("COMMIT")
+                return []
+            running = {
+                r["lane"]: r["n"]
+                for r in conn.execute(
+                    "SELECT lane, COUNT(*) AS n FROM tasks WHERE status = 'running' AND lease_until >= ?"
+                    " GROUP BY lane",
+                    (now,),
+                )
+            }
+            where += " AND lane = ?"
+            params.append(pick_lane(waiting, running))
+        ids = [
+            r["id"]
+            for r in conn.execute(
+                f"SELECT id FROM tasks WHERE {where} ORDER BY id LIMIT ?",
+                params + [limit],
+            ).fetchall()
+        ]
+        tasks = []
+        for task_id in ids:
+            conn.execute(
+                "UPDATE tasks SET status = 'running', lease_owner = ?, lease_until = ?,"
+                " attempts = attempts + 1, updated = ? WHERE id = ?",
+                (worker_id, now + TASK_LEASE_SECONDS, now, task_id),
+            )
+            tasks.append(dict(conn.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()))
+        conn.execute("COMMIT")
+        return tasks
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def reusable_results(content_hash: str, task_id: int, since: float):
+    """
+    Resultados de otra tarea con el mismo archivo, terminada bien después de
+    `since`: {"task_id", "rows": [{"filename", "data", "meta"}]}, o None.
+    """
+    conn = connect()
+    try:
+        source = conn.execute(
+            "SELECT id FROM tasks WHERE content_hash = ? AND status = 'done' AND id != ? AND updated >= ?"
+            " ORDER BY updated DESC LIMIT 1",
+            (content_hash, task_id, since),
+        ).fetchone()
+        if source is None:
+            return None
+        rows = conn.execute(
+            "SELECT filename, data, meta, has_error FROM results WHERE task_id = ? ORDER BY n",
+            (source["id"],),
+        ).fetchall()
+    finally:
+        conn.close()
+    if not rows or any(r["has_error"] for r in rows):
+        return None
+    return {
+        "task_id": source["id"],
+        "rows": [{"filename": r["filename"], "data": json.loads(r["data"]), "meta": json.loads(r["meta"])}
+                 for r in rows],
+    }
+
+
+def lane_stats() -> dict:
+    """Tareas en cola y corriendo por carril (para /health)."""
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT lane, status, COUNT(*) AS n FROM tasks WHERE status IN ('queued', 'running')"
+            " GROUP BY lane, status"
+        ).fetchall()
+    finally:
+        conn.close()
+    out = {lane: {"queued": 0, "running": 0} for lane in LANES}
+    for r in rows:
+        out.setdefault(r["lane"], {"queued": 0, "running": 0})[r["status"]] = r["n"]
+    return out
+
+
+def _add_event(conn, task_id: int, stage: str, now: float, info: dict = None):
+    conn.execute(
+        "INSERT INTO task_events (batch_id, task_id, stage, at, info)"
+        " SELECT batch_id, id, ?, ?, ? FROM tasks WHERE id = ?",
+        (stage, now, json.dumps(info, ensure_ascii=False) if info else None, task_id),
+    )
+
+
+def record_stage(task_ids: list, stage: str, info: dict = None):
+    """Registra que las tareas pasaron a `stage` (ver STAGES)."""
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for task_id in task_ids:
+            _add_event(conn, task_id, stage, now, info)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def heartbeat(task_ids: list, worker_id: str) -> int:
+    """Renueva el lease de tareas propias. Devuelve cuántas siguen siendo nuestras."""
+    now = time.time()
+    conn = connect()
+    try:
+        n = 0
+        for task_id in task_ids:
+            cur = conn.execute(
+                "UPDATE tasks SET lease_until = ?, updated = ?"
+                " WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (now + TASK_LEASE_SECONDS, now, task_id, worker_id),
+            )
+            n += cur.rowcount
+        return n
+    finally:
+        conn.close()
+
+
+def complete_task(task_id: int, worker_id: str, rows: list) -> bool:
+    """
+    Guarda los resultados de una tarea (rows: [{"filename", "data", "meta"}])
+    y la marca como hecha. Si el lease ya no es nuestro, no toca nada.
+    """
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        task = conn.execute(
+            "SELECT batch_id, seq FROM tasks WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (task_id, worker_id),
+        ).fetchone()
+        if task is None:
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute("DELETE FROM results WHERE task_id = ?", (task_id,))
+        conn.executemany(
+            "INSERT INTO results (task_id, batch_id, seq, n, filename, data, meta, math_ok, has_error)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    task_id, task["batch_id"], task["seq"], n, row["filename"],
+                    json.dumps(row["data"], ensure_ascii=False),
+                    json.dumps(row.get("meta") or {}, ensure_ascii=False),
+                    _math_ok(row),
+                    1 if (row["data"] or {}).get("error") else 0,
+                )
+                for n, row in enumerate(rows)
+            ],
+        )
+        for row in rows:
+            _add_to_libro_iva(conn, task_id, row["data"])
+        conn.execute(
+            "UPDATE tasks SET status = 'done', lease_owner = NULL, lease_until = NULL, updated = ?"
+            " WHERE id = ?",
+            (now, task_id),
+        )
+        _add_event(conn, task_id, "exported", now, {"resultados": len(rows)})
+        conn.execute("COMMIT")
+        return True
+    finally:
+        conn.close()
+
+
+def _math_ok(row: dict):
+    mc = (row.get("meta") or {}).get("math_check")
+    if not mc:
+        return None
+    return 1 if mc.get("ok") else 0
+
+
+def fail_task(task_id: int, worker_id: str, error: str):
+    """
+    Falla de un intento: vuelve a la cola si quedan intentos; si no, queda
+    'failed' con una fila de error como resultado.
+    """
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        task = conn.execute(
+            "SELECT * FROM tasks WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (task_id, worker_id),
+        ).fetchone()
+        if task is None:
+            conn.execute("ROLLBACK")
+            return
+        if task["attempts"] < TASK_MAX_ATTEMPTS:
+            conn.execute(
+                "UPDATE tasks SET status = 'queued', lease_owner = NULL, lease_until = NULL,"
+                " error = ?, updated = ? WHERE id = ?",
+                (error, now, task_id),
+            )
+            _add_event(conn, task_id, "queued", now, {"reintento": task["attempts"], "error": error})
+        else:
+            _mark_failed(conn, task, error, now)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def _mark_failed(conn, task, error: str, now: float):
+    conn.execute(
+        "UPDATE tasks SET status = 'failed', lease_owner = NULL, lease_until = NULL,"
+        " error = ?, updated = ? WHERE id = ?",
+        (error, now, task["id"]),
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO results (task_id, batch_id, seq, n, filename, data, meta, has_error)"
+        " VALUES (?, ?, ?, 0, ?, ?, '{}', 1)",
+        (
+            task["id"], task["batch_id"], task["seq"], task["filename"],
+            json.dumps({"error": f"No se pudo procesar el archivo: {error}"}, ensure_ascii=False),
+        ),
+    )
+    _add_event(conn, task["id"], "failed", now, {"error": error})
+
+
+def reap_abandoned() -> int:
+    """
+    Tareas con lease vencido que ya agotaron los intentos (el worker murió en
+    el último): se marcan como fallidas para que el lote pueda terminar.
+    """
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT * FROM tasks WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            (now, TASK_MAX_ATTEMPTS),
+        ).fetchall()
+        for task in rows:
+            _mark_failed(conn, task, "worker abandonado (lease vencido)", now)
+        conn.execute("COMMIT")
+        return len(rows)
+    finally:
+        conn.close()
+
+
+# ---------- Libro IVA incremental (libro_iva.py) ----------
+
+_IVA_KEY = ("periodo", "receptor", "emisor", "letra", "tipo")
+
+
+def _apply_libro_iva(conn, aporte: dict, sign: int):
+    """Suma (sign=1) o resta (sign=-1) el aporte de un comprobante a las tablas del libro."""
+    key = tuple(aporte[k] for k in _IVA_KEY)
+    values = [sign * aporte["totales"][c] for c in TOTAL_COLUMNS]
+    conn.execute(
+        f"INSERT INTO iva_totales ({', '.join(_IVA_KEY)}, razon_social, comprobantes, {', '.join(TOTAL_COLUMNS)})"
+        f" VALUES ({', '.join('?' * (len(_IVA_KEY) + 2 + len(TOTAL_COLUMNS)))})"
+        f" ON CONFLICT ({', '.join(_IVA_KEY)}) DO UPDATE SET"
+        " razon_social = excluded.razon_social, comprobantes = comprobantes + excluded.comprobantes, "
+        + ", ".join(f"{c} = {c} + excluded.{c}" for c in TOTAL_COLUMNS),
+        (*key, aporte["razon_social"], sign, *values),
+    )
+    for alicuota, (neto, iva) in aporte["alicuotas"].items():
+        conn.execute(
+            f"INSERT INTO iva_alicuotas ({', '.join(_IVA_KEY)}, alicuota, comprobantes, neto, iva)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            f" ON CONFLICT ({', '.join(_IVA_KEY)}, alicuota) DO UPDATE SET"
+            " comprobantes = comprobantes + excluded.comprobantes,"
+            " neto = neto + excluded.neto, iva = iva + excluded.iva",
+            (*key, float(alicuota), sign, sign * neto, sign * iva),
+        )
+    if sign < 0:
+        where = " AND ".join(f"{k} = ?" for k in _IVA_KEY)
+        conn.execute(f"DELETE FROM iva_totales WHERE {where} AND comprobantes <= 0", key)
+        conn.execute(f"DELETE FROM iva_alicuotas WHERE {where} AND comprobantes <= 0", key)
+
+
+def _add_to_libro_iva(conn, task_id: int, data: dict):
+    """Suma un comprobante al libro; si ya estaba (re-extracción), reemplaza su aporte."""
+    aporte = invoice_contributions(data)
+    if aporte is None:
+        return
+    old = conn.execute("SELECT aporte FROM iva_comprobantes WHERE clave = ?", (aporte["clave"],)).fetchone()
+    if old is not None:
+        _apply_libro_iva(conn, json.loads(old["aporte"]), -1)
+    _apply_libro_iva(conn, aporte, 1)
+    conn.execute(
+        "INSERT OR REPLACE INTO iva_comprobantes (clave, task_id, aporte) VALUES (?, ?, ?)",
+        (aporte["clave"], task_id, json.dumps(aporte, ensure_ascii=False)),
+    )
+
+
+def libro_iva_rows(periodo: str, cuit: str = None, proveedor: str = None):
+    """
+    Filas ya sumadas de un período: (por alícuota, por comprobante), de un
+    CUIT receptor (`cuit`) y/o de un proveedor. Lee sólo las filas de ese
+    período y CUIT (índices de las tablas del libro), no los comprobantes.
+    """
+    where, args = ["periodo = ?"], [periodo]
+    if cuit:
+        where.append("receptor = ?")
+        args.append(cuit)
+    if proveedor:
+        where.append("emisor = ?")
+        args.append(proveedor)
+    sql_where = " AND ".join(where)
+    conn = connect()
+    try:
+        alicuotas = conn.execute(f"SELECT * FROM iva_alicuotas WHERE {sql_where}", args).fetchall()
+        totales = conn.execute(f"SELECT * FROM iva_totales WHERE {sql_where}", args).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in alicuotas], [dict(r) for r in totales]
+
+
+def libro_iva_periodos() -> list:
+    """Períodos y CUIT receptores con comprobantes en el libro."""
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT periodo, receptor, SUM(comprobantes) AS comprobantes FROM iva_totales"
+            " GROUP BY periodo, receptor ORDER BY periodo DESC, receptor"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
+
+
+def rebuild_libro_iva() -> int:
+    """Vuelve a armar el libro desde los resultados guardados (una vez, para datos previos)."""
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for table in ("iva_comprobantes", "iva_totales", "iva_alicuotas"):
+            conn.execute(f"DELETE FROM {table}")
+        n = 0
+        for r in conn.execute(
+            "SELECT r.task_id, r.data FROM results r JOIN tasks t ON t.id = r.task_id"
+            " WHERE t.status = 'done' AND r.has_error = 0 ORDER BY r.task_id, r.n"
+        ).fetchall():
+            _add_to_libro_iva(conn, r["task_id"], json.loads(r["data"]))
+            n += 1
+        conn.execute("COMMIT")
+        return n
+    finally:
+        conn.close()
+
+
+# ---------- Plantillas por proveedor (supplier_templates.py) ----------
+
+def find_templates(cuits: list) -> list:
+    """Plantillas aprendidas de esos CUIT (sólo dígitos)."""
+    if not cuits:
+        return []
+    conn = connect()
+    try:
+        rows = conn.execute(
+            f"SELECT * FROM supplier_templates WHERE cuit IN ({','.join('?' * len(cuits))})",
+            list(cuits),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        {**dict(r), "tokens": json.loads(r["tokens"]), "fields": json.loads(r["fields"])}
+        for r in rows
+    ]
+
+
+def save_template(cuit: str, fingerprint: str, tokens: list, fields: dict):
+    """Alta o reemplazo (re-aprendizaje) de una plantilla; los fallos vuelven a cero."""
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute(
+            "INSERT INTO supplier_templates (cuit, fingerprint, tokens, fields, created, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (cuit, fingerprint) DO UPDATE SET"
+            " tokens = excluded.tokens, fields = excluded.fields, misses = 0, updated = excluded.updated",
+            (cuit, fingerprint, json.dumps(tokens), json.dumps(fields, ensure_ascii=False), now, now),
+        )
+    finally:
+        conn.close()
+
+
+def template_hit(cuit: str, fingerprint: str):
+    conn = connect()
+    try:
+        conn.execute(
+            "UPDATE supplier_templates SET hits = hits + 1, misses = 0, updated = ?"
+            " WHERE cuit = ? AND fingerprint = ?",
+            (time.time(), cuit, fingerprint),
+        )
+    finally:
+        conn.close()
+
+
+def template_miss(cuit: str, fingerprint: str, max_misses: int):
+    """Un fallo más; con `max_misses` seguidos la plantilla se descarta."""
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "UPDATE supplier_templates SET misses = misses + 1, updated = ? WHERE cuit = ? AND fingerprint = ?",
+            (time.time(), cuit, fingerprint),
+        )
+        conn.execute(
+            "DELETE FROM supplier_templates WHERE cuit = ? AND fingerprint = ? AND misses >= ?",
+            (cuit, fingerprint, max_misses),
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+# ---------- Carpetas vigiladas (watcher.py) ----------
+
+def watch_batch(carpeta: str, periodo: str, sistema: str) -> str:
+    """
+    Lote (abierto) de una carpeta vigilada para un período AAAA-MM; se crea
+    la primera vez. Los lotes de períodos anteriores de la carpeta se cierran.
+    """
+    conn = connect()
+    try:
+        row = conn.execute(
+            "SELECT batch_id FROM watch_batches WHERE carpeta = ? AND periodo = ?", (carpeta, periodo),
+        ).fetchone()
+        old = [r["batch_id"] for r in conn.execute(
+            "SELECT batch_id FROM watch_batches WHERE carpeta = ? AND periodo < ?", (carpeta, periodo),
+        )]
+    finally:
+        conn.close()
+    for batch_id in old:
+        close_batch(batch_id)
+    if row is not None:
+        return row["batch_id"]
+
+    batch_id = open_batch(sistema)
+    conn = connect()
+    try:
+        conn.execute(
+            "INSERT INTO watch_batches (carpeta, periodo, batch_id) VALUES (?, ?, ?)",
+            (carpeta, periodo, batch_id),
+        )
+    finally:
+        conn.close()
+    return batch_id
+
+
+def watch_batches(carpeta: str) -> dict:
+    """{período: lote} de una carpeta vigilada."""
+    conn = connect()
+    try:
+        rows = conn.execute("SELECT periodo, batch_id FROM watch_batches WHERE carpeta = ?", (carpeta,))
+        return {r["periodo"]: r["batch_id"] for r in rows}
+    finally:
+        conn.close()
+
+
+def read_task_file(task: dict) -> bytes:
+    with open(task["path"], "rb") as f:
+        return f.read()
@@ -0,0 +1,343 @@
+"""
+Plantillas aprendidas por proveedor: extracción local (sin llamar al modelo)
+de PDFs digitales que se repiten todos los meses con el mismo diseño.
+
+  - Después de una extracción del modelo que VALIDA (main.validation_failures),
+    se busca en qué span de texto de la página (PyMuPDF) quedó cada campo del
+    esquema y se guarda su posición y cómo sacarlo del texto del span.
+  - La plantilla se guarda con clave CUIT del emisor + huella del diseño: los
+    textos fijos de la página (los spans sin dígitos que no son valores) y su
+    posición en una grilla. Lo que cambia mes a mes (montos, fechas, números,
+    el cliente) no entra en la huella.
+  - Un PDF nuevo que trae ese CUIT y al menos TEMPLATE_MIN_SIMILARITY de los
+    textos fijos de la plantilla se lee con ella en milisegundos; si el
+    resultado no valida, se usa el modelo como siempre y, con
+    TEMPLATE_MAX_MISSES fallos seguidos, la plantilla se descarta.
+
+Los ítems NO van en la plantilla (la cantidad de renglones cambia): un
+comprobante leído por plantilla sale con encabezado, totales y alícuotas.
+
+page_layout() recibe una página de PyMuPDF (corre en el pool de CPU); el
+resto es Python puro sobre el dict que devuelve.
+"""
+import hashlib
+import os
+import re
+import zlib
+
+from invoice_schema import INVOICE_SCHEMA, NUM, parse_number
+
+
+TEMPLATES_ENABLED = os.getenv("TEMPLATES", "1") == "1"
+TEMPLATE_MIN_SIMILARITY = float(os.getenv("TEMPLATE_MIN_SIMILARITY", "0.85"))
+TEMPLATE_MAX_MISSES = int(os.getenv("TEMPLATE_MAX_MISSES", "3"))
+
+# Grilla (pt) de la huella y margen (pt) al buscar un campo en su posición
+_GRID = 8
+_BOX_MARGIN = 4
+
+# Sin estos no hay plantilla
+REQUIRED = (
+    "emisor.cuit",
+    "datos_comprobante.numero_comprobante",
+    "datos_comprobante.fecha_emision",
+    "totales.total_comprobante",
+)
+
+# Campos que, si no aparecen escritos en la página, se toman como fijos del proveedor
+_CONSTANT_OK = re.compile(
+    r"^emisor\.|^datos_comprobante\.(tipo|letra|moneda|condicion_venta)$|^receptor\.condicion_iva$"
+)
+
+# Secciones que se aprenden (items y datos_compras_importaciones quedan afuera)
+_SECTIONS = ("datos_comprobante", "emisor", "receptor", "totales", "datos_fiscales_afip")
+
+_CUIT_RE = re.compile(r"\b(\d{2})-?(\d{8})-?(\d)\b")
+_NUM_RE = re.compile(r"-?\d[\d.,]*")
+_SHAPE_CHARS = re.compile(r"^[\d\s\-/.]+$")
+
+
+# ---------- Layout de la página (corre en el pool) ----------
+
+def page_layout(page) -> dict:
+    """Spans de texto de la página: {"width", "height", "spans": [[texto, x0, y0, x1, y1], ...]}."""
+    spans = []
+    for block in page.get_text("dict")["blocks"]:
+        for line in block.get("lines", []):
+            for span in line["spans"]:
+                text = " ".join(span["text"].split())
+                if text:
+                    spans.append([text] + [round(c, 1) for c in span["bbox"]])
+    return {"width": page.rect.width, "height": page.rect.height, "spans": spans}
+
+
+# ---------- Huella ----------
+
+def _norm(text: str) -> str:
+    return " ".join(str(text).casefold().split())
+
+
+def fingerprint(layout: dict, fields: dict = None):
+    """
+    (id de la huella, tokens): textos fijos de la página con su celda de la
+    grilla. Con `fields` (reglas aprendidas) quedan afuera los spans de donde
+    salen valores, p. ej. la razón social del cliente.
+    """
+    variable = {tuple(r["box"]) for r in (fields or {}).values() if "box" in r}
+    tokens = sorted({
+        zlib.crc32(f"{_norm(t)}@{int(x0 // _GRID)},{int(y0 // _GRID)}".encode())
+        for t, x0, y0, x1, y1 in layout["spans"]
+        if not any(ch.isdigit() for ch in t) and (x0, y0, x1, y1) not in variable
+    })
+    digest = hashlib.sha1(",".join(map(str, tokens)).encode()).hexdigest()[:16]
+    return digest, tokens
+
+
+def similarity(template_tokens: list, page_tokens: list) -> float:
+    """Fracción de los textos fijos de la plantilla que están en la página."""
+    if not template_tokens:
+        return 0.0
+    return len(set(template_tokens) & set(page_tokens)) / len(template_tokens)
+
+
+def layout_cuits(layout: dict) -> list:
+    """CUIT (sólo dígitos) que aparecen escritos en la página."""
+    return sorted({"".join(m.groups()) for t, *_ in layout["spans"] for m in _CUIT_RE.finditer(t)})
+
+
+def match_template(layout: dict, templates: list):
+    """La plantilla más parecida al diseño de la página, si alcanza TEMPLATE_MIN_SIMILARITY."""
+    if not templates:
+        return None
+    _, tokens = fingerprint(layout)
+    best, best_sim = None, 0.0
+    for tpl in templates:
+        sim = similarity(tpl["tokens"], tokens)
+        if sim > best_sim:
+            best, best_sim = tpl, sim
+    if best_sim < TEMPLATE_MIN_SIMILARITY:
+        return None
+    return {**best, "similarity": round(best_sim, 3)}
+
+
+# ---------- Valores dentro del texto de un span ----------
+
+def _numbers(text: str) -> list:
+    return [parse_number(m) for m in _NUM_RE.findall(text)]
+
+
+def _shape(value: str) -> str:
+    """Patrón de un valor tipo número/fecha: cada tramo de dígitos -> \\d+."""
+    return "".join(r"\d+" if part.isdigit() else re.escape(part) for part in re.split(r"(\d+)", value) if part)
+
+
+def _same_digits(a: str, b: str) -> bool:
+    if a.isdigit() and b.isdigit():
+        return a.lstrip("0") == b.lstrip("0")
+    return a == b
+
+
+def _extract(rule: dict, text: str):
+    """Saca el valor de un campo del texto de un span según la regla aprendida (None si no está)."""
+    mode = rule["mode"]
+    if mode == "num":
+        nums = _numbers(text)
+        return nums[rule["index"]] if rule["index"] < len(nums) else None
+    if mode == "cuit":
+        found = [m.groups() for m in _CUIT_RE.finditer(text)]
+        if rule["index"] >= len(found):
+            return None
+        g = found[rule["index"]]
+        return "-".join(g) if rule.get("dashes") else "".join(g)
+    if mode == "shape":
+        found = re.findall(rule["pattern"], text)
+        if rule["index"] >= len(found):
+            return None
+        value = found[rule["index"]]
+        if value.isdigit() and rule.get("zfill"):
+            value = value.lstrip("0").zfill(rule["zfill"])
+        return value
+    # texto: lo que queda entre el prefijo y el sufijo fijos
+    low = text.casefold()
+    prefix, suffix = rule["prefix"], rule["suffix"]
+    if not low.startswith(prefix) or not low.endswith(suffix):
+        return None
+    value = text[len(prefix):len(text) - len(suffix)].strip()
+    if _norm(value) == _norm(rule["value"]):
+        return rule["value"]  # texto fijo: con la grafía que eligió el modelo
+    return value or None
+
+
+def _find_rule(value, kind: str, spans: list):
+    """
+    (regla, caja) del span donde mejor aparece `value`: coincidencia exacta
+    antes que con ceros a la izquierda, span entero antes que parte de un
+    texto más largo; en importes repetidos (ítem y total), el más abajo.
+    """
+    if kind != NUM:
+        value = str(value).strip()
+        digits = "".join(ch for ch in value if ch.isdigit())
+        v = _norm(value)
+        word = re.compile(r"(?<!\w)" + re.escape(v) + r"(?!\w)")
+    hits = []
+    for order, (text, *box) in enumerate(spans):
+        if kind == NUM:
+            for i, n in enumerate(_numbers(text)):
+                if n is not None and abs(n - value) < 0.005:
+                    hits.append(((-box[1], order), {"mode": "num", "index": i}, box))
+                    break
+            continue
+
+        if len(digits) == 11 and _CUIT_RE.fullmatch(value):
+            found = ["".join(m.groups()) for m in _CUIT_RE.finditer(text)]
+            if digits in found:
+                rule = {"mode": "cuit", "index": found.index(digits), "dashes": "-" in value}
+                hits.append(((order,), rule, box))
+            continue
+        if digits and _SHAPE_CHARS.match(value):
+            pattern = _shape(value)
+            for i, f in enumerate(re.findall(pattern, text)):
+                if _same_digits(f, value):
+                    rule = {"mode": "shape", "pattern": pattern, "index": i}
+                    if value.isdigit() and value.startswith("0"):
+                        rule["zfill"] = len(value)
+                    hits.append(((f != value, order), rule, box))
+                    break
+            continue
+
+        low = text.casefold()
+        m = word.search(low) if v else None
+        if m:
+            rule = {"mode": "text", "prefix": low[:m.start()], "suffix": low[m.end():], "value": value}
+            hits.append(((low != v, len(low), order), rule, box))
+
+    if not hits:
+        return None
+    _, rule, box = min(hits, key=lambda h: h[0])
+    return rule, box
+
+
+# ---------- Aprender / aplicar ----------
+
+def _leaf_paths(data: dict):
+    """(ruta, tipo, valor) de cada campo escalar de las secciones que se aprenden."""
+    for section in _SECTIONS:
+        spec = INVOICE_SCHEMA[section]
+        values = data.get(section) or {}
+        for name, kind in spec.items():
+            if isinstance(kind, list):
+                for i, entry in enumerate(values.get(name) or []):
+                    for sub, sub_kind in kind[0].items():
+                        yield f"{section}.{name}.{i}.{sub}", sub_kind, (entry or {}).get(sub)
+            else:
+                yield f"{section}.{name}", kind, values.get(name)
+
+
+def _empty(value) -> bool:
+    return value is None or value == "" or value == 0
+
+
+def learn_template(data: dict, layout: dict):
+    """
+    Reglas por campo a partir de una extracción validada: {ruta: regla}.
+    None si la página no alcanza para una plantilla confiable.
+    """
+    spans = layout["spans"]
+    fields = {}
+    for path, kind, value in _leaf_paths(data):
+        if _empty(value):
+            continue
+        found = _find_rule(value, kind, spans)
+        if found:
+            rule, box = found
+            fields[path] = {**rule, "box": box, "kind": kind}
+        elif _CONSTANT_OK.match(path):
+            fields[path] = {"mode": "const", "value": value}
+
+    # Control: la plantilla tiene que reproducir la misma extracción en la misma página
+    replay = apply_rules(fields, layout)
+    if replay is None:
+        return None
+    for path, kind, value in _leaf_paths(data):
+        if path in fields and not _same_value(_get(replay, path), value, kind):
+            del fields[path]
+    if any(path not in fields or fields[path]["mode"] == "const" for path in REQUIRED):
+        return None
+    return fields
+
+
+def _same_value(a, b, kind) -> bool:
+    if kind == NUM:
+        try:
+            return abs(float(a) - float(b)) < 0.005
+        except (TypeError, ValueError):
+            return False
+    return _norm(a or "") == _norm(b or "")
+
+
+def _overlap(box, span_box) -> float:
+    x0, y0, x1, y1 = box[0] - _BOX_MARGIN, box[1] - _BOX_MARGIN, box[2] + _BOX_MARGIN, box[3] + _BOX_MARGIN
+    sx0, sy0, sx1, sy1 = span_box
+    w = min(x1, sx1) - max(x0, sx0)
+    h = min(y1, sy1) - max(y0, sy0)
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / ((x1 - x0) * (y1 - y0) + (sx1 - sx0) * (sy1 - sy0) - inter)
+
+
+def _get(data: dict, path: str):
+    cur = data
+    for part in path.split("."):
+        if isinstance(cur, list):
+            i = int(part)
+            cur = cur[i] if i < len(cur) else None
+        elif isinstance(cur, dict):
+            cur = cur.get(part)
+        if cur is None:
+            return None
+    return cur
+
+
+def _set(data: dict, path: str, value):
+    parts = path.split(".")
+    cur = data
+    for part, nxt in zip(parts, parts[1:]):
+        if isinstance(cur, list):
+            i = int(part)
+            while len(cur) <= i:
+                cur.append({})
+            cur = cur[i]
+        else:
+            cur = cur.setdefault(part, [] if nxt.isdigit() else {})
+    cur[parts[-1]] = value
+
+
+def apply_rules(fields: dict, layout: dict):
+    """
+    Lee la página con las reglas de una plantilla: JSON crudo del esquema
+    (pasa por coerce_invoice como la respuesta del modelo). None si falta
+    algún campo obligatorio.
+    """
+    spans = layout["spans"]
+    raw = {}
+    for path, rule in fields.items():
+        if rule["mode"] == "const":
+            _set(raw, path, rule["value"])
+            continue
+        candidates = sorted(
+            ((_overlap(rule["box"], box), text) for text, *box in spans),
+            key=lambda c: c[0],
+            reverse=True,
+        )
+        value = None
+        for score, text in candidates:
+            if score <= 0:
+                break
+            value = _extract(rule, text)
+            if value is not None:
+                _set(raw, path, value)
+                break
+        if value is None and path in REQUIRED:
+            return None
+    return raw
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import store  # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """store apuntando a una base SQLite nueva en tmp_path."""
+    monkeypatch.setattr(store, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(store, "DB_PATH", str(tmp_path / "facturas.db"))
+    monkeypatch.setattr(store, "UPLOADS_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(store, "_initialized", False)
+    return tmp_path
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def _invoice(cuit="30-71234567-1", total=121.0, iva=21.0, items=None):
+    return {
+        "datos_comprobante": {"numero_comprobante": "00000001"},
+        "emisor": {"cuit": cuit},
+        "totales": {
+            "importe_neto_gravado": 100.0,
+            "ivAs": [{"alicuota": 21.0, "importe_iva": iva}],
+            "total_comprobante": total,
+        },
+        "items": items or [],
+    }
+
+
+@pytest.mark.parametrize("cuit", ["30-71234567-1", "20123456786", 20123456786])
+def test_cuit_valido(cuit):
+    assert main.cuit_valido(cuit)
+
+
+@pytest.mark.parametrize("cuit", ["30-71234567-2", "2012345678", "201234567860", "", None])
+def test_cuit_invalido(cuit):
+    assert not main.cuit_valido(cuit)
+
+
+def test_validation_failures_valido():
+    assert main.validation_failures(_invoice()) == []
+    item = {"alicuota_iva": 21, "importe_total_renglon": 121.0}
+    assert main.validation_failures(_invoice(items=[item])) == []
+
+
+@pytest.mark.parametrize("data, expected", [
+    ({}, ["error"]),
+    ({"error": "timeout"}, ["error"]),
+    (_invoice(cuit=""), ["campos_obligatorios"]),
+    (_invoice(total=None), ["campos_obligatorios"]),
+    (_invoice(cuit="30-71234567-2"), ["cuit"]),
+    (_invoice(iva=10.5), ["matematica"]),
+    (_invoice(items=[{"alicuota_iva": 21, "importe_total_renglon": 60.5}]), ["matematica"]),
+])
+def test_validation_failures(data, expected):
+    assert main.validation_failures(data) == expected
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("gpt-4.1-nano, gpt-4.1-mini", ["gpt-4.1-nano", "gpt-4.1-mini"]),
+    ("", [main.MODEL]),
+    (" , ,", [main.MODEL]),
+])
+def test_parse_cascade(value, expected):
+    assert main.parse_cascade(value) == expected
+
+
+def _fake_models(monkeypatch, results: dict):
+    """post_chat devuelve, por modelo, el comprobante de `results`."""
+    calls = []
+
+    async def post_chat(response_format, parts, model):
+        calls.append(model)
+        return model
+
+    async def parse_with_continuation(content, parts, model):
+        return results[content], []
+
+    monkeypatch.setattr(main, "post_chat", post_chat)
+    monkeypatch.setattr(main, "parse_with_continuation", parse_with_continuation)
+    monkeypatch.setattr(main, "_model_stats", {})
+    return calls
+
+
+def test_extract_cascade_escala_hasta_que_valida(monkeypatch):
+    monkeypatch.setattr(main, "MODEL_CASCADE", ["chico", "grande"])
+    calls = _fake_models(monkeypatch, {"chico": _invoice(cuit="30-71234567-2"), "grande": _invoice()})
+    meta = {}
+    data = asyncio.run(main.extract_cascade([], meta=meta))
+    assert calls == ["chico", "grande"]
+    assert data == _invoice()
+    assert meta["model"] == "grande" and meta["model_tier"] == 1
+    assert [a["fallas"] for a in meta["model_attempts"]] == [["cuit"], []]
+
+
+def test_extract_cascade_start_tier_fuera_de_rango(monkeypatch):
+    monkeypatch.setattr(main, "MODEL_CASCADE", ["chico", "grande"])
+    calls = _fake_models(monkeypatch, {"grande": _invoice()})
+    asyncio.run(main.extract_cascade([], start_tier=5))
+    assert calls == ["grande"]
@@ -0,0 +1,83 @@
+import struct
+
+import pytest
+
+import cpu_pool
+
+fitz = pytest.importorskip("fitz")
+
+HEIC = b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00" + b"\x00" * 64
+
+
+def _pixmap(width, height):
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, width, height), False)
+    pix.clear_with(200)
+    return pix
+
+
+def _bmp(width, height):
+    """BMP de 24 bits gris (MuPDF lo lee; el modelo no)."""
+    row = b"\x80" * (width * 3)
+    row += b"\x00" * (-len(row) % 4)
+    pixels = row * height
+    header = struct.pack("<2sIHHI", b"BM", 54 + len(pixels), 0, 0, 54)
+    info = struct.pack("<IiiHHIIiiII", 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+    return header + info + pixels
+
+
+def _size(image_bytes):
+    pix = fitz.Pixmap(image_bytes)
+    return pix.width, pix.height
+
+
+@pytest.mark.parametrize("fmt", ["jpg", "png"])
+def test_nativa_chica_va_tal_cual(fmt):
+    raw = _pixmap(40, 30).tobytes(fmt)
+    assert cpu_pool.normalize_image(raw) == (raw, 40, 30)
+
+
+def test_lado_largo_se_achica_a_jpeg(monkeypatch):
+    monkeypatch.setattr(cpu_pool, "IMAGE_MAX_LONG_EDGE", 50)
+    out, width, height = cpu_pool.normalize_image(_pixmap(200, 100).tobytes("png"))
+    assert out.startswith(b"\xff\xd8\xff")
+    assert (width, height) == (50, 25) == _size(out)
+
+
+def test_png_pesado_pasa_a_jpeg(monkeypatch):
+    raw = _pixmap(40, 30).tobytes("png")
+    monkeypatch.setattr(cpu_pool, "IMAGE_REENCODE_BYTES", len(raw) - 1)
+    out, width, height = cpu_pool.normalize_image(raw)
+    assert out.startswith(b"\xff\xd8\xff") and (width, height) == (40, 30)
+
+
+def test_png_con_transparencia_sale_sobre_blanco(monkeypatch):
+    monkeypatch.setattr(cpu_pool, "IMAGE_REENCODE_BYTES", 0)
+    transparente = fitz.Pixmap(fitz.csRGB, 20, 20, b"\x00\x00\x00\x00" * 400, True)
+    out, _, _ = cpu_pool.normalize_image(transparente.tobytes("png"))
+    assert fitz.Pixmap(out).pixel(10, 10) == (255, 255, 255)
+
+
+def test_bmp_pasa_a_jpeg():
+    out, width, height = cpu_pool.normalize_image(_bmp(8, 6))
+    assert out.startswith(b"\xff\xd8\xff") and (width, height) == (8, 6)
+
+
+def test_ilegible_va_tal_cual():
+    raw = b"no es una imagen" * 4
+    assert cpu_pool.normalize_image(raw) == (raw, 0, 0)
+
+
+def test_heic_sin_pillow_heif(monkeypatch):
+    monkeypatch.setattr(cpu_pool, "_pillow_png", lambda image_bytes: None)
+    with pytest.raises(cpu_pool.UnreadableImage):
+        cpu_pool.normalize_image(HEIC)
+    out = cpu_pool.prepare_image_job(HEIC)
+    assert out["b64"] is None and out["width"] == out["height"] == 0
+    assert "pillow-heif" in out["error"]
+
+
+def test_prepare_image_job_base64():
+    raw = _pixmap(40, 30).tobytes("jpg")
+    out = cpu_pool.prepare_image_job(raw)
+    assert out["width"] == 40 and out["height"] == 30 and "error" not in out
+    assert cpu_pool.take_ref(out["b64"]) == cpu_pool.base64.b64encode(raw)
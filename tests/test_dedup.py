@@ -0,0 +1,52 @@
+import asyncio
+
+import main
+import store
+
+ROW = {"filename": "a.pdf", "data": {"emisor": {"cuit": "30-71234567-8"}}, "meta": {}}
+
+
+def _enqueue_twice(content=b"mismo"):
+    batch_id = store.open_batch("generico")
+    first = store.add_file(batch_id, 0, "a.pdf", "application/pdf", [content])
+    second = store.add_file(batch_id, 1, "b.pdf", "application/pdf", [content])
+    return first, second
+
+
+def test_same_file_waits_while_running(data_dir):
+    first, second = _enqueue_twice()
+    assert [t["id"] for t in store.claim_tasks("w1")] == [first]
+    assert store.claim_tasks("w2") == []
+    assert store.complete_task(first, "w1", [ROW])
+    assert [t["id"] for t in store.claim_tasks("w2")] == [second]
+
+
+def test_duplicate_reuses_results_without_extracting(data_dir, monkeypatch):
+    first, _ = _enqueue_twice()
+    store.claim_tasks("w1")
+    store.complete_task(first, "w1", [ROW])
+    (task,) = store.claim_tasks("w2")
+
+    async def no_model(task):
+        raise AssertionError("no debería extraer de nuevo")
+
+    monkeypatch.setattr(main, "process_task", no_model)
+    monkeypatch.setitem(main._dedup_stats, "reusados", 0)
+    (row,) = asyncio.run(main._process_single_task(task))
+    assert row["filename"] == "b.pdf"
+    assert row["data"] == ROW["data"]
+    assert row["meta"]["duplicado_de"] == first
+    assert main._dedup_stats["reusados"] == 1
+
+
+def test_duplicate_of_a_failed_extraction_is_extracted_again(data_dir, monkeypatch):
+    first, _ = _enqueue_twice()
+    store.claim_tasks("w1")
+    store.complete_task(first, "w1", [{"filename": "a.pdf", "data": {"error": "x"}, "meta": {}}])
+    (task,) = store.claim_tasks("w2")
+
+    async def extract(task):
+        return [ROW]
+
+    monkeypatch.setattr(main, "process_task", extract)
+    assert asyncio.run(main._process_single_task(task)) == [ROW]
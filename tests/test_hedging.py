@@ -0,0 +1,117 @@
+import asyncio
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+import hedging
+import main
+
+KEY = ("modelo", 1)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(hedging, "_latencies", {})
+    monkeypatch.setattr(hedging, "_hedged", deque(maxlen=hedging.LATENCY_WINDOW))
+    monkeypatch.setattr(hedging, "_in_flight", {"calls": 0, "hedges": 0})
+    monkeypatch.setattr(hedging, "_stats", dict.fromkeys(hedging._stats, 0))
+    monkeypatch.setattr(hedging, "LLM_HEDGE", True)
+    monkeypatch.setattr(hedging, "LLM_HEDGE_MIN_SAMPLES", 20)
+
+
+def _learn(seconds: float):
+    for _ in range(20):
+        hedging.record_latency(KEY, seconds)
+
+
+def _calls(*delays):
+    """call() cuyo n-ésimo intento tarda delays[n] y devuelve n (una excepción se lanza)."""
+    attempts = []
+
+    async def attempt(n):
+        if isinstance(delays[n], Exception):
+            raise delays[n]
+        await asyncio.sleep(delays[n])
+        return n
+
+    def call():
+        attempts.append(len(attempts))
+        return attempt(attempts[-1])
+
+    return call, attempts
+
+
+def test_fast_call_is_not_hedged():
+    _learn(0.5)
+    call, attempts = _calls(0.0)
+    info = {}
+    assert asyncio.run(hedging.hedged_call(call, KEY, deadline=1, info=info)) == 0
+    assert attempts == [0] and info == {"requests": 1}
+    assert hedging._stats["hedged"] == 0
+    assert list(hedging._hedged) == [False]
+
+
+def test_no_hedge_without_enough_samples():
+    call, attempts = _calls(0.05)
+    assert asyncio.run(hedging.hedged_call(call, KEY, deadline=1)) == 0
+    assert attempts == [0]
+
+
+def test_hedge_wins_and_the_slow_attempt_is_recorded():
+    _learn(0.01)
+    call, attempts = _calls(1.0, 0.0)
+    info = {}
+    assert asyncio.run(hedging.hedged_call(call, KEY, deadline=2, info=info)) == 1
+    assert info == {"requests": 2}
+    assert hedging._stats["hedged"] == 1 and hedging._stats["hedge_wins"] == 1
+    # la del duplicado (~0) y, como cota, lo que llevaba la primera (>= el delay)
+    samples = list(hedging._latencies[KEY])[20:]
+    assert len(samples) == 2 and max(samples) >= 0.01
+    assert hedging._in_flight == {"calls": 0, "hedges": 0}
+
+
+def test_deadline_records_the_cut_attempt():
+    call, _ = _calls(1.0)
+    with pytest.raises(hedging.DeadlineExceeded):
+        asyncio.run(hedging.hedged_call(call, KEY, deadline=0.05))
+    (sample,) = hedging._latencies[KEY]
+    assert sample >= 0.05
+    assert hedging._stats["deadline_exceeded"] == 1
+
+
+def test_error_is_raised_when_every_attempt_fails():
+    call, _ = _calls(ValueError("500"))
+    with pytest.raises(ValueError):
+        asyncio.run(hedging.hedged_call(call, KEY, deadline=1))
+    assert hedging._in_flight == {"calls": 0, "hedges": 0}
+
+
+def test_rate_cap_counts_hedges_in_flight(monkeypatch):
+    monkeypatch.setattr(hedging, "LLM_HEDGE_MAX_RATE", 0.5)
+    _learn(0.01)
+
+    async def burst():
+        calls = [_calls(0.1, 0.1)[0] for _ in range(4)]
+        return await asyncio.gather(*(hedging.hedged_call(c, KEY, deadline=1) for c in calls))
+
+    asyncio.run(burst())
+    # 4 llamadas lentas a la vez con tope 50%: se duplican 2, no las 4
+    assert hedging._stats["hedged"] == 2
+    assert sum(hedging._hedged) == 2 and len(hedging._hedged) == 4
+
+
+def test_post_chat_counts_the_hedged_request(monkeypatch):
+    usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=50)
+    response = SimpleNamespace(usage=usage, choices=[SimpleNamespace(message=SimpleNamespace(content="{}"))])
+
+    async def hedged(call, key, deadline=None, info=None):
+        info["requests"] = 2
+        return response
+
+    monkeypatch.setattr(main, "hedged_call", hedged)
+    monkeypatch.setattr(main, "_model_stats", {})
+    assert asyncio.run(main.post_chat(main.RESPONSE_FORMAT, [("text", "hola")], model="m")) == "{}"
+    st = main._model_stats["m"]
+    assert st["calls"] == 1 and st["hedge_calls"] == 1
+    assert st["prompt_tokens"] == 2000 and st["completion_tokens"] == 50
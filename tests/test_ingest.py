@@ -0,0 +1,110 @@
+import io
+import zipfile
+
+import pytest
+
+import ingest
+import store
+
+PDF = b"%PDF-1.4\n" + b"0" * 100
+JPEG = b"\xff\xd8\xff\xe0" + b"1" * 100
+
+
+@pytest.mark.parametrize("head, expected", [
+    (PDF, "application/pdf"),
+    (JPEG, "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n....", "image/png"),
+    (b"GIF89a....", "image/gif"),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"II*\x00....", "image/tiff"),
+    (b"MM\x00*....", "image/tiff"),
+    (b"\x00\x00\x00\x18ftypheic", "image/heic"),
+    (b"BM......", "image/bmp"),
+    (b"PK\x03\x04....", "application/zip"),
+    (b"hola", "application/octet-stream"),
+])
+def test_sniff_content_type(head, expected):
+    assert ingest.sniff_content_type(head) == expected
+
+
+def _zip(entries: dict) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries.items():
+            zf.writestr(name, data)
+    buf.seek(0)
+    return buf
+
+
+def _tasks(batch_id):
+    conn = store.connect()
+    try:
+        return [dict(r) for r in conn.execute(
+            "SELECT filename, content_type, status, error FROM tasks WHERE batch_id = ? ORDER BY seq",
+            (batch_id,),
+        )]
+    finally:
+        conn.close()
+
+
+def test_zip_entries_are_enqueued_by_content(data_dir):
+    batch_id = store.open_batch("generico")
+    uploads = [
+        ("lote.zip", _zip({
+            "a/factura.bin": PDF, "foto.jpg": JPEG, "__MACOSX/._foto.jpg": b"x", "a/.DS_Store": b"x",
+            "vacio.pdf": b"",
+        })),
+        ("suelta.pdf", io.BytesIO(PDF)),
+    ]
+    assert ingest.ingest_uploads(batch_id, uploads) == 4
+    tasks = _tasks(batch_id)
+    assert [(t["filename"], t["content_type"], t["status"]) for t in tasks[:2]] == [
+        ("lote.zip/a/factura.bin", "application/pdf", "queued"),
+        ("lote.zip/foto.jpg", "image/jpeg", "queued"),
+    ]
+    assert tasks[2]["status"] == "failed" and "vacío" in tasks[2]["error"]
+    assert tasks[3]["filename"] == "suelta.pdf" and tasks[3]["status"] == "queued"
+
+
+def test_too_many_entries(data_dir, monkeypatch):
+    monkeypatch.setattr(ingest, "ZIP_MAX_ENTRIES", 2)
+    batch_id = store.open_batch("generico")
+    assert ingest.ingest_uploads(batch_id, [("lote.zip", _zip({f"{n}.pdf": PDF for n in range(3)}))]) == 1
+    (task,) = _tasks(batch_id)
+    assert task["status"] == "failed" and "máximo 2" in task["error"]
+
+
+def test_entry_size_limit(data_dir, monkeypatch):
+    monkeypatch.setattr(ingest, "ZIP_MAX_ENTRY_BYTES", 150)
+    batch_id = store.open_batch("generico")
+    ingest.ingest_uploads(batch_id, [("lote.zip", _zip({"chico.pdf": PDF, "grande.pdf": PDF + b"0" * 200}))])
+    chico, grande = _tasks(batch_id)
+    assert chico["status"] == "queued"
+    assert grande["status"] == "failed" and "tamaño permitido" in grande["error"]
+
+
+def test_compression_ratio_limit(data_dir, monkeypatch):
+    monkeypatch.setattr(ingest, "ZIP_MAX_RATIO", 2)
+    monkeypatch.setattr(ingest, "_RATIO_MIN_BYTES", 0)
+    batch_id = store.open_batch("generico")
+    # 200 KB de ceros comprimen a casi nada: relación muy por encima de 2
+    ingest.ingest_uploads(batch_id, [("lote.zip", _zip({"bomba.pdf": PDF + b"\x00" * 200_000}))])
+    (task,) = _tasks(batch_id)
+    assert task["status"] == "failed" and "tamaño permitido" in task["error"]
+
+
+def test_total_size_limit_discards_the_rest(data_dir, monkeypatch):
+    monkeypatch.setattr(ingest, "ZIP_MAX_TOTAL_BYTES", 250)
+    batch_id = store.open_batch("generico")
+    entries = {f"{n}.pdf": PDF for n in range(4)}  # 109 bytes cada uno
+    ingest.ingest_uploads(batch_id, [("lote.zip", _zip(entries))])
+    statuses = [t["status"] for t in _tasks(batch_id)]
+    assert statuses == ["queued", "queued", "failed", "failed"]
+    assert "total" in _tasks(batch_id)[3]["error"]
+
+
+def test_damaged_zip(data_dir):
+    batch_id = store.open_batch("generico")
+    ingest.ingest_uploads(batch_id, [("roto.zip", io.BytesIO(b"PK\x03\x04basura"))])
+    (task,) = _tasks(batch_id)
+    assert task["status"] == "failed" and "ZIP" in task["error"]
@@ -0,0 +1,88 @@
+import pytest
+
+from invoice_schema import (
+    INVOICE_JSON_SCHEMA,
+    INVOICE_SCHEMA,
+    coerce_invoice,
+    coerce_number,
+    parse_number,
+    prompt_token_report,
+)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1.234,56", 1234.56),
+    ("1,234.56", 1234.56),
+    ("1234.5", 1234.5),
+    ("0.500", 0.5),
+    ("0.125", 0.125),
+    ("1.240", 1240.0),       # x.ddd: miles con punto
+    ("12.345", 12345.0),
+    ("1.234.567", 1234567.0),
+    ("1,5", 1.5),
+    ("1,234,567", 1234567.0),
+    ("-3,5", -3.5),
+    ("-1.234,56", -1234.56),
+    ("-1,234.56", -1234.56),
+    ("1.240,", 1240.0),
+    ("abc", None),
+    ("-", None),
+])
+def test_parse_number(text, expected):
+    assert parse_number(text) == expected
+
+
+def test_coerce_number():
+    assert coerce_number(12) == 12.0
+    assert coerce_number("$ 1.234,56") == 1234.56
+    assert coerce_number("") is None
+    assert coerce_number("null") is None
+    assert coerce_number(None) is None
+    assert coerce_number(True) is None
+
+
+def test_coerce_invoice_fills_every_key():
+    data = coerce_invoice({"emisor": {"cuit": 30712345678, "extra": "x"}, "desconocida": 1})
+    assert set(data) == set(INVOICE_SCHEMA)
+    assert data["emisor"]["cuit"] == "30712345678"
+    assert "extra" not in data["emisor"] and "desconocida" not in data
+    assert data["datos_comprobante"]["numero_comprobante"] == ""
+    assert data["items"] == [] and data["totales"]["ivAs"] == []
+
+
+def test_coerce_invoice_numbers_and_zero_defaults():
+    data = coerce_invoice({
+        "totales": {"total_comprobante": "1.234,56", "importe_neto_gravado": None,
+                    "percepciones_iva": None, "importe_exento": "-10,5",
+                    "ivAs": [{"alicuota": "21", "importe_iva": "1,234.56"}, "basura"]},
+        "items": [{"cantidad": "2", "bonificacion": None}],
+    })
+    tot = data["totales"]
+    assert tot["total_comprobante"] == 1234.56
+    assert tot["importe_neto_gravado"] is None          # sin dato: null
+    assert tot["percepciones_iva"] == 0.0               # sin dato: 0
+    assert tot["percepciones_otras"] == 0.0
+    assert tot["importe_exento"] == -10.5
+    assert tot["ivAs"] == [{"alicuota": 21.0, "importe_iva": 1234.56}]
+    assert data["items"][0]["cantidad"] == 2.0
+    assert data["items"][0]["bonificacion"] is None
+
+
+def test_local_fields_are_not_asked_but_filled():
+    afip = INVOICE_JSON_SCHEMA["properties"]["datos_fiscales_afip"]["properties"]
+    assert "numero_documento_receptor" not in afip and "codigo_barras_qr" not in afip
+    # los importes que valen 0 si faltan siguen siendo nullables para el modelo
+    totales = INVOICE_JSON_SCHEMA["properties"]["totales"]["properties"]
+    assert totales["percepciones_iva"] == {"type": ["number", "null"]}
+
+    data = coerce_invoice({"receptor": {"tipo_documento": "DNI", "numero_documento": "20123456"}})
+    assert data["datos_fiscales_afip"]["tipo_documento_receptor"] == "DNI"
+    assert data["datos_fiscales_afip"]["numero_documento_receptor"] == "20123456"
+    assert data["datos_fiscales_afip"]["codigo_barras_qr"] == ""
+
+
+def test_token_report_counts_the_schema():
+    report = prompt_token_report()
+    assert report["fixed_input_tokens"] == (
+        report["system_prompt_tokens"] + report["user_prompt_tokens"] + report["schema_tokens"]
+    )
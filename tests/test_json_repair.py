@@ -0,0 +1,48 @@
+from json_repair import repair_json
+
+
+def test_valid_json_needs_no_fixes():
+    assert repair_json('{"a": 1, "b": [1, 2]}') == ({"a": 1, "b": [1, 2]}, [], False)
+
+
+def test_truncated_number_is_dropped():
+    obj, fixes, cut = repair_json('{"a": 1, "b": 12')
+    assert obj == {"a": 1}
+    assert fixes == ["cortado"]
+    assert cut
+
+
+def test_truncated_string_is_dropped():
+    assert repair_json('{"a": 1, "t": "cort') == ({"a": 1}, ["cortado"], True)
+
+
+def test_incomplete_last_item_is_dropped():
+    obj, _, cut = repair_json('{"a": "x", "items": [{"c": 1}, {"c": 2, "d"')
+    assert obj == {"a": "x", "items": [{"c": 1}]}
+    assert cut
+
+
+def test_wrapped_text_and_trailing_commas():
+    text = 'Aquí está el JSON:\n```json\n{"a": [1, 2,], "b": "x",}\n```'
+    obj, fixes, cut = repair_json(text)
+    assert obj == {"a": [1, 2], "b": "x"}
+    assert fixes == ["coma_final", "texto_antes", "texto_despues"]
+    assert not cut
+
+
+def test_missing_comma_and_unquoted_key():
+    obj, fixes, _ = repair_json('{a: 1 "b": 2}')
+    assert obj == {"a": 1, "b": 2}
+    assert fixes == ["clave_sin_comillas", "coma_faltante"]
+
+
+def test_extra_closing_brackets():
+    obj, fixes, cut = repair_json('{"a": {"b": 1}}}]')
+    assert obj == {"a": {"b": 1}}
+    assert fixes == ["texto_despues"]
+    assert not cut
+
+
+def test_no_json():
+    assert repair_json("no hay nada") == (None, [], False)
+    assert repair_json(None) == (None, [], False)
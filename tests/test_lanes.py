@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from lanes import BACKGROUND, BULK, INTERACTIVE, PriorityGate, pick_lane
+
+
+def test_pick_lane_by_weight():
+    # Con los pesos por defecto (8/2/1), sin nada corriendo gana interactivo
+    assert pick_lane([BULK, INTERACTIVE, BACKGROUND], {}) == INTERACTIVE
+    # ... pero bulk no se queda sin turno: 8 interactivas corriendo pesan más que 1 bulk
+    assert pick_lane([BULK, INTERACTIVE], {INTERACTIVE: 8, BULK: 1}) == BULK
+
+
+async def _grab(gate, lane, order):
+    await gate.acquire(lane)
+    order.append(lane)
+
+
+def test_gate_serves_waiting_lanes_by_weight():
+    async def scenario():
+        gate = PriorityGate(1)
+        await gate.acquire(BULK)
+        order = []
+        waiters = [asyncio.create_task(_grab(gate, lane, order)) for lane in (BULK, BACKGROUND, INTERACTIVE)]
+        await asyncio.sleep(0)
+        for _ in waiters:
+            gate.release(order[-1] if order else BULK)
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+        return order, gate
+
+    order, gate = asyncio.run(scenario())
+    # llegó última pero pasa primero; bulk antes que background por peso
+    assert order == [INTERACTIVE, BULK, BACKGROUND]
+    assert gate.running == {BULK: 0, INTERACTIVE: 0, BACKGROUND: 1}
+
+
+def test_gate_fifo_within_a_lane():
+    async def scenario():
+        gate = PriorityGate(1)
+        await gate.acquire(BULK)
+        order = []
+
+        async def grab(tag):
+            await gate.acquire(BULK)
+            order.append(tag)
+            gate.release(BULK)
+
+        waiters = [asyncio.create_task(grab(n)) for n in range(3)]
+        await asyncio.sleep(0)
+        gate.release(BULK)
+        await asyncio.gather(*waiters)
+        return order
+
+    assert asyncio.run(scenario()) == [0, 1, 2]
+
+
+def test_cancelled_waiter_gives_its_turn_away():
+    async def scenario():
+        gate = PriorityGate(1)
+        await gate.acquire(BULK)
+        cancelled = asyncio.create_task(gate.acquire(INTERACTIVE))
+        order = []
+        waiting = asyncio.create_task(_grab(gate, BULK, order))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        gate.release(BULK)
+        await waiting
+        return order, gate
+
+    order, gate = asyncio.run(scenario())
+    assert order == [BULK]
+    assert gate._busy == 1
+    assert gate.running == {BULK: 1}
+
+
+def test_cancel_after_grant_releases_the_slot():
+    async def scenario():
+        gate = PriorityGate(1)
+        await gate.acquire(BULK)
+        waiter = asyncio.create_task(gate.acquire(INTERACTIVE))
+        await asyncio.sleep(0)
+        gate.release(BULK)  # el lugar se le da a la espera ...
+        waiter.cancel()     # ... que se cancela antes de enterarse
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return gate
+
+    gate = asyncio.run(scenario())
+    assert gate._busy == 0
+    assert gate.running == {BULK: 0, INTERACTIVE: 0}
@@ -0,0 +1,101 @@
+import pytest
+
+import check_layouts
+from layouts import RIGHT, compile_layout, conformance_errors, field, fmt_date8, split_line
+
+FIXED = {
+    "name": "prueba",
+    "kind": "fixed",
+    "fields": [
+        field("tipo", 3, "tipo"),
+        field("punto_venta", 5, "dc.punto_venta", fmt="digits", align=RIGHT, fill="0"),
+        field("fecha", 8, "dc.fecha", fmt="date8"),
+        field("marca", 2, const="AB"),
+        field("razon", 10, "em.razon"),
+        field("total", 12, "tot.total", fmt="amount", align=RIGHT),
+    ],
+}
+DELIMITED = {
+    "name": "prueba_csv",
+    "kind": "delimited",
+    "sep": ";",
+    "header": True,
+    "fields": [
+        field("razon", source="em.razon", label="RAZON"),
+        field("total", source="tot.total", fmt="num2", label="TOTAL"),
+        field("pais", const="AR;G", label="PAIS"),
+    ],
+}
+RECORD = {
+    "tipo": "FA",
+    "dc": {"punto_venta": "N° 3", "fecha": "15/03/2025"},
+    "em": {"razon": "Distribuidora\nNorte S.A."},
+    "tot": {"total": 1240.5},
+}
+
+
+GOOD = "FA 0000320250315ABDistribuid     1240.50"
+
+
+def test_fixed_line_and_offsets():
+    line_of = compile_layout(FIXED)
+    line = line_of(RECORD)
+    assert line == GOOD
+    assert line_of.width == len(line) == 40
+    assert line_of.offsets[1] == ("punto_venta", 3, 8)
+    assert split_line(FIXED, line)["fecha"] == "20250315"
+    assert conformance_errors(FIXED, line) == []
+
+
+def test_fixed_missing_values():
+    line = compile_layout(FIXED)({})
+    assert line == "   0000000000000AB" + " " * 18 + "0.00"
+    assert conformance_errors(FIXED, line) == []
+
+
+def test_delimited_line_header_and_separator_inside_values():
+    line_of = compile_layout(DELIMITED)
+    assert line_of.header == "RAZON;TOTAL;PAIS"
+    rec = {"em": {"razon": "López;Pérez"}, "tot": {"total": None}}
+    line = line_of(rec)
+    assert line == "López,Pérez;;AR,G"
+    assert conformance_errors(DELIMITED, line) == []
+
+
+@pytest.mark.parametrize("line, error", [
+    (GOOD[:-1], "largo 39, esperado 40"),
+    (GOOD.replace("AB", "XX"), "marca: constante"),
+    (GOOD.replace("0315AB", "03  AB"), "fecha:"),       # offset corrido / valor truncado
+    (GOOD.replace(" 1240.50", "1240.500"), "total:"),
+    (GOOD.replace("D", "\n"), "salto de línea"),
+])
+def test_conformance_errors(line, error):
+    errors = conformance_errors(FIXED, line)
+    assert errors and error in errors[0]
+
+
+def test_conformance_delimited_field_count():
+    assert conformance_errors(DELIMITED, "a;1.00") == ["2 campos, esperados 3"]
+    assert conformance_errors(DELIMITED, "a;1.0;AR,G") == ["total: '1.0' no es num2"]
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("15/03/2025", "20250315"),
+    ("2025-03-15", "20250315"),
+    ("2025/03/15", "20250315"),
+    ("15032025", "20250315"),
+    ("", "00000000"),
+    ("mañana", "00000000"),
+])
+def test_fmt_date8(value, expected):
+    assert fmt_date8(value) == expected
+
+
+@pytest.mark.parametrize("name, layout, build, expected, fields", check_layouts.GOLDEN,
+                         ids=[g[0] for g in check_layouts.GOLDEN])
+def test_export_golden_lines(name, layout, build, expected, fields):
+    line = build(check_layouts.SAMPLE)
+    assert conformance_errors(layout, line) == []
+    assert line == expected
+    got = split_line(layout, line)
+    assert {k: got[k] for k in fields} == fields
@@ -0,0 +1,63 @@
+import libro_iva
+import store
+
+
+def _comprobante(tipo, numero, neto, iva, total, percepcion=0.0):
+    return {
+        "datos_comprobante": {"tipo": tipo, "letra": "A", "punto_venta": "0003",
+                              "numero_comprobante": numero, "fecha_emision": "15/03/2025"},
+        "emisor": {"razon_social": "Distribuidora Norte S.A.", "cuit": "30-71234567-8"},
+        "receptor": {"cuit": "30-70000000-1"},
+        "totales": {"importe_neto_gravado": neto, "ivAs": [{"alicuota": 21.0, "importe_iva": iva}],
+                    "percepciones_iva": percepcion, "total_comprobante": total},
+    }
+
+
+FACTURA = _comprobante("Factura", "00001234", 1000.0, 210.0, 1240.0, percepcion=30.0)
+NOTA_CREDITO = _comprobante("Nota de Crédito", "00000077", 200.0, 42.0, 242.0)
+
+
+def test_contributions():
+    aporte = libro_iva.invoice_contributions(FACTURA)
+    assert aporte["periodo"] == "2025-03"
+    assert aporte["receptor"] == "30700000001" and aporte["emisor"] == "30712345678"
+    assert aporte["alicuotas"] == {21.0: [1000.0, 210.0]}
+    assert aporte["totales"]["total"] == 1240.0 and aporte["totales"]["percepciones_iva"] == 30.0
+    assert libro_iva.invoice_contributions({"error": "x"}) is None
+    assert libro_iva.invoice_contributions({"emisor": {"cuit": ""}}) is None
+
+
+def test_credit_note_subtracts():
+    rows = [libro_iva.invoice_contributions(d) for d in (FACTURA, NOTA_CREDITO)]
+    por_alicuota = [{"tipo": r["tipo"], "alicuota": 21.0, "neto": r["alicuotas"][21.0][0],
+                     "iva": r["alicuotas"][21.0][1]} for r in rows]
+    por_comprobante = [{"letra": r["letra"], "tipo": r["tipo"], "emisor": r["emisor"],
+                        "razon_social": r["razon_social"], "comprobantes": 1, **r["totales"]} for r in rows]
+    out = libro_iva.summarize(por_alicuota, por_comprobante)
+
+    assert out["por_alicuota"] == [{"alicuota": 21.0, "neto": 800.0, "iva": 168.0}]
+    assert out["resumen"]["total"] == 998.0
+    assert out["resumen"]["iva"] == 168.0
+    assert out["resumen"]["comprobantes"] == 2
+    # por tipo se ve cada uno con su signo original
+    assert {t["tipo"]: t["total"] for t in out["por_tipo"]} == {"Factura": 1240.0, "Nota de Crédito": 242.0}
+
+
+def _save(batch_id, seq, data):
+    task_id = store.add_file(batch_id, seq, f"f{seq}.pdf", "application/pdf", [bytes([seq])])
+    (task,) = store.claim_tasks("w1", batch_id=batch_id)
+    assert task["id"] == task_id
+    assert store.complete_task(task_id, "w1", [{"filename": f"f{seq}.pdf", "data": data, "meta": {}}])
+
+
+def test_store_books_credit_note_and_replaces_reextraction(data_dir):
+    batch_id = store.open_batch("generico")
+    _save(batch_id, 0, FACTURA)
+    _save(batch_id, 1, NOTA_CREDITO)
+    _save(batch_id, 2, FACTURA)  # la misma factura extraída otra vez no suma dos veces
+
+    out = libro_iva.summarize(*store.libro_iva_rows("2025-03", cuit="30700000001"))
+    assert out["resumen"]["comprobantes"] == 2
+    assert out["resumen"]["total"] == 998.0
+    assert out["resumen"]["neto_gravado"] == 800.0
+    assert out["resumen"]["percepciones_iva"] == 30.0
@@ -0,0 +1,44 @@
+import main
+
+
+def test_groups_respect_image_cap(monkeypatch):
+    monkeypatch.setattr(main, "PACK_MAX_IMAGES", 3)
+    monkeypatch.setattr(main, "PACK_TOKEN_BUDGET", 10_000)
+    groups = main.plan_pack_groups([100] * 7)
+    assert [len(g) for g in groups] == [3, 3, 1]
+    assert sorted(i for g in groups for i in g) == list(range(7))
+
+
+def test_groups_respect_token_budget_largest_first(monkeypatch):
+    monkeypatch.setattr(main, "PACK_MAX_IMAGES", 6)
+    monkeypatch.setattr(main, "PACK_TOKEN_BUDGET", 1000)
+    tokens = [200, 900, 300, 500, 100]
+    groups = main.plan_pack_groups(tokens)
+    assert groups == [[1], [3, 2, 0], [4]]
+    for g in groups:
+        assert len(g) == 1 or sum(tokens[i] for i in g) <= 1000
+
+
+def test_oversized_image_goes_alone(monkeypatch):
+    monkeypatch.setattr(main, "PACK_TOKEN_BUDGET", 1000)
+    assert main.plan_pack_groups([5000, 10]) == [[0], [1]]
+    assert main.plan_pack_groups([]) == []
+
+
+def test_image_tokens():
+    # tamaño desconocido: se asume el peor caso
+    assert main.image_tokens({}) == main.estimate_image_tokens(2048, 2048)
+    small = main.image_tokens({"width": 320, "height": 320})
+    assert small == main.estimate_image_tokens(320, 320)
+    assert small < main.image_tokens({"width": 1600, "height": 2400})
+    # el proveedor achica las grandes hasta 1536 parches
+    assert main.estimate_image_tokens(8000, 8000) == main.estimate_image_tokens(16000, 16000)
+
+
+def test_is_packable_image(monkeypatch):
+    monkeypatch.setattr(main, "PACK_MAX_BYTES", 10)
+    monkeypatch.setattr(main, "PACK_MAX_IMAGES", 6)
+    assert main.is_packable_image(b"x" * 10)
+    assert not main.is_packable_image(b"x" * 11)
+    monkeypatch.setattr(main, "PACK_MAX_IMAGES", 1)
+    assert not main.is_packable_image(b"x")
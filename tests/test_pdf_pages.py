@@ -0,0 +1,101 @@
+import fitz
+
+import main
+from invoice_schema import coerce_invoice
+from pdf_pages import classify_pdf
+
+HEADER = (
+    "FACTURA A  {copy}\n"
+    "Distribuidora Norte S.A.  CUIT: 30-71234567-8\n"
+    "Punto de Venta: 00003  Comp. Nro: {numero}\n"
+)
+ITEMS = "\n".join(f"Item {n}  Resma A4 x {n}  $ {n * 121},00" for n in range(1, 25))
+
+
+def _pdf(pages):
+    """PDF con una página por elemento: texto, None (en blanco) o ("scan", patrón)."""
+    doc = fitz.open()
+    for content in pages:
+        page = doc.new_page()
+        if isinstance(content, tuple):
+            page.insert_image(page.rect, pixmap=_pattern(content[1]))
+        elif content:
+            page.insert_text((50, 72), content, fontsize=9)
+    return fitz.open("pdf", doc.tobytes())
+
+
+def _pattern(seed: int):
+    """Imagen en grises con rayas distintas según `seed` (simula una hoja escaneada)."""
+    w, h = 170, 220
+    samples = bytes(
+        0 if ((x // (4 + seed) + y // (6 + 2 * seed)) % 2) else 255
+        for y in range(h) for x in range(w)
+    )
+    return fitz.Pixmap(fitz.csGRAY, w, h, samples, 0)
+
+
+def _pages(result):
+    return [inv["pages"] for inv in result["invoices"]]
+
+
+def _skipped(result):
+    return {s["page"]: s["reason"] for s in result["skipped"]}
+
+
+def test_copies_blank_and_non_fiscal_pages_are_skipped():
+    result = classify_pdf(_pdf([
+        HEADER.format(copy="ORIGINAL", numero="00001234") + ITEMS,
+        HEADER.format(copy="DUPLICADO", numero="00001234") + ITEMS,
+        None,
+        "REMITO R 0001-00000077\nEntrega de mercadería",
+        HEADER.format(copy="ORIGINAL", numero="00001235") + "Item 1  Tóner",
+    ]))
+    assert _pages(result) == [[0], [4]]
+    assert _skipped(result) == {1: "copia", 2: "en_blanco", 3: "no_fiscal"}
+
+
+def test_continuation_page_with_copy_legend():
+    result = classify_pdf(_pdf([
+        HEADER.format(copy="ORIGINAL", numero="00001234") + ITEMS,
+        "FACTURA  ORIGINAL  Hoja 2\n" + ITEMS.replace("Resma", "Carpeta"),
+        HEADER.format(copy="DUPLICADO", numero="00001234") + ITEMS,
+        "FACTURA  DUPLICADO  Hoja 2\nOtro detalle de la copia",
+    ]))
+    assert _pages(result) == [[0, 1]]
+    assert _skipped(result) == {2: "copia", 3: "copia"}
+
+
+def test_continuation_page_without_legend():
+    result = classify_pdf(_pdf([
+        HEADER.format(copy="", numero="00001234") + ITEMS,
+        "Detalle (continuación)\n" + ITEMS.replace("Resma", "Sobre"),
+    ]))
+    assert _pages(result) == [[0, 1]]
+
+
+def test_scanned_pages():
+    result = classify_pdf(_pdf([("scan", 0), ("scan", 0), None, ("scan", 3)]))
+    assert _pages(result) == [[0], [3]]
+    assert all(inv["scan"] for inv in result["invoices"])
+    assert _skipped(result) == {1: "copia", 2: "en_blanco"}
+
+
+def test_unidentified_page_is_merged_as_continuation():
+    first = coerce_invoice({
+        "emisor": {"cuit": "30-71234567-8"}, "datos_comprobante": {"numero_comprobante": "00001234"},
+        "items": [{"descripcion": "Resma A4"}],
+    })
+    cont = coerce_invoice({
+        "items": [{"descripcion": "Tóner"}],
+        "totales": {"total_comprobante": 1240.0, "percepciones_iva": 30.0},
+        "datos_fiscales_afip": {"cae": "75123456789012"},
+    })
+    assert not main.is_unidentified(first)
+    assert main.is_unidentified(cont)
+    assert not main.is_unidentified({"error": "x"})
+
+    main.merge_continuation(first, cont)
+    assert [i["descripcion"] for i in first["items"]] == ["Resma A4", "Tóner"]
+    assert first["totales"]["total_comprobante"] == 1240.0
+    assert first["totales"]["percepciones_iva"] == 30.0
+    assert first["datos_fiscales_afip"]["cae"] == "75123456789012"
@@ -0,0 +1,24 @@
+import asyncio
+
+import main
+
+
+def test_warm_up_failure_is_reported_on_health(data_dir, monkeypatch, capsys):
+    def broken_client():
+        raise RuntimeError("sin red")
+
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-prueba")
+    monkeypatch.setattr(main, "get_client", broken_client)
+    monkeypatch.setattr(main, "_startup", dict(main._startup, warm=False, warm_error=None))
+
+    asyncio.run(main.warm_up_client())
+    health = asyncio.run(main.health())
+    assert health["warm"] is False
+    assert "sin red" in health["warm_error"]
+    assert capsys.readouterr().out == ""
+
+
+def test_no_warm_up_without_api_key(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setattr(main, "get_client", lambda: (_ for _ in ()).throw(AssertionError("no debería")))
+    asyncio.run(main.warm_up_client())
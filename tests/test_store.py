@@ -0,0 +1,72 @@
+import time
+
+import store
+
+
+def _enqueue(n=1, content=b"x"):
+    batch_id = store.open_batch("generico")
+    ids = [store.add_file(batch_id, seq, f"f{seq}.pdf", "application/pdf", [content + bytes([seq])])
+           for seq in range(n)]
+    return batch_id, ids
+
+
+def _expire(task_id):
+    conn = store.connect()
+    try:
+        conn.execute("UPDATE tasks SET lease_until = ? WHERE id = ?", (time.time() - 1, task_id))
+    finally:
+        conn.close()
+
+
+def _task(task_id):
+    conn = store.connect()
+    try:
+        return dict(conn.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone())
+    finally:
+        conn.close()
+
+
+def test_claim_takes_a_lease(data_dir):
+    _, (task_id,) = _enqueue()
+    (task,) = store.claim_tasks("w1")
+    assert task["id"] == task_id
+    assert task["status"] == "running" and task["lease_owner"] == "w1" and task["attempts"] == 1
+    assert task["lease_until"] > time.time()
+    assert store.claim_tasks("w2") == []
+
+
+def test_expired_lease_is_claimed_again(data_dir):
+    _, (task_id,) = _enqueue()
+    store.claim_tasks("w1")
+    _expire(task_id)
+    (task,) = store.claim_tasks("w2")
+    assert task["lease_owner"] == "w2" and task["attempts"] == 2
+    # el worker que perdió el lease ya no puede guardar ni renovar
+    assert store.heartbeat([task_id], "w1") == 0
+    assert not store.complete_task(task_id, "w1", [{"filename": "f0.pdf", "data": {}, "meta": {}}])
+    assert store.complete_task(task_id, "w2", [{"filename": "f0.pdf", "data": {}, "meta": {}}])
+    assert _task(task_id)["status"] == "done"
+
+
+def test_no_claim_after_max_attempts(data_dir, monkeypatch):
+    monkeypatch.setattr(store, "TASK_MAX_ATTEMPTS", 2)
+    _, (task_id,) = _enqueue()
+    for worker in ("w1", "w2"):
+        assert store.claim_tasks(worker)
+        _expire(task_id)
+    assert store.claim_tasks("w3") == []
+
+
+def test_reap_abandoned_only_exhausted_expired_leases(data_dir, monkeypatch):
+    monkeypatch.setattr(store, "TASK_MAX_ATTEMPTS", 1)
+    _, (vencida, vigente) = _enqueue(2)
+    store.claim_tasks("w1", limit=2)
+    _expire(vencida)
+
+    assert store.reap_abandoned() == 1
+    assert _task(vencida)["status"] == "failed"
+    assert _task(vigente)["status"] == "running"
+    (row,) = store.task_results(vencida)
+    assert "lease vencido" in row["data"]["error"]
+    assert store.reap_abandoned() == 0
+
@@ -0,0 +1,117 @@
+import store
+import supplier_templates as st
+from invoice_schema import coerce_invoice
+
+
+def _layout(numero, fecha, cliente, neto, iva, total):
+    """Página de un proveedor con diseño fijo: mismos textos y posiciones, otros valores."""
+    spans = [
+        ["Distribuidora Norte S.A.", 40, 40, 220, 52],
+        ["CUIT: 30-71234567-1", 40, 60, 180, 72],
+        ["FACTURA", 400, 40, 470, 52],
+        ["A", 480, 40, 490, 52],
+        [f"Nº 0003-{numero}", 400, 60, 520, 72],
+        [f"Fecha: {fecha}", 400, 80, 520, 92],
+        ["Cliente:", 40, 120, 90, 132],
+        [cliente, 100, 120, 300, 132],
+        ["Neto gravado", 300, 600, 400, 612],
+        [neto, 450, 600, 520, 612],
+        ["IVA 21%", 300, 620, 400, 632],
+        [iva, 450, 620, 520, 632],
+        ["Total", 300, 640, 400, 652],
+        [total, 450, 640, 520, 652],
+    ]
+    return {"width": 595, "height": 842, "spans": [[t, *map(float, box)] for t, *box in spans]}
+
+
+def _data(numero, fecha, cliente, neto, iva, total):
+    return coerce_invoice({
+        "datos_comprobante": {
+            "tipo": "FACTURA", "letra": "A", "punto_venta": "0003",
+            "numero_comprobante": numero, "fecha_emision": fecha, "moneda": "PES",
+        },
+        "emisor": {"razon_social": "Distribuidora Norte S.A.", "cuit": "30-71234567-1"},
+        "receptor": {"razon_social": cliente},
+        "totales": {
+            "importe_neto_gravado": neto,
+            "ivAs": [{"alicuota": 21, "importe_iva": iva}],
+            "total_comprobante": total,
+        },
+    })
+
+
+MARZO = _layout("00001234", "15/03/2025", "Ferretería Sur SRL", "1.000,00", "210,00", "1.210,00")
+ABRIL = _layout("00001301", "14/04/2025", "Almacén Oeste SA", "2.500,50", "525,11", "3.025,61")
+
+
+def _learned():
+    fields = st.learn_template(_data("00001234", "15/03/2025", "Ferretería Sur SRL", 1000, 210, 1210), MARZO)
+    assert fields is not None
+    return fields
+
+
+def test_learn_apply_misma_pagina():
+    data = _data("00001234", "15/03/2025", "Ferretería Sur SRL", 1000, 210, 1210)
+    replay = coerce_invoice(st.apply_rules(_learned(), MARZO))
+    for path, kind, value in st._leaf_paths(data):
+        if not st._empty(value):
+            assert st._same_value(st._get(replay, path), value, kind), path
+
+
+def test_apply_otro_mes():
+    out = coerce_invoice(st.apply_rules(_learned(), ABRIL))
+    assert out["emisor"]["cuit"] == "30-71234567-1"
+    assert out["emisor"]["razon_social"] == "Distribuidora Norte S.A."
+    assert out["datos_comprobante"]["numero_comprobante"] == "00001301"
+    assert out["datos_comprobante"]["fecha_emision"] == "14/04/2025"
+    assert out["datos_comprobante"]["moneda"] == "PES"  # constante: no está en la página
+    assert out["receptor"]["razon_social"] == "Almacén Oeste SA"
+    assert out["totales"]["importe_neto_gravado"] == 2500.50
+    assert out["totales"]["ivAs"] == [{"alicuota": 21.0, "importe_iva": 525.11}]
+    assert out["totales"]["total_comprobante"] == 3025.61
+
+
+def test_sin_campo_obligatorio_no_hay_plantilla():
+    data = _data("00001234", "15/03/2025", "Ferretería Sur SRL", 1000, 210, 1210)
+    sin_total = {**MARZO, "spans": [s for s in MARZO["spans"] if s[0] != "1.210,00"]}
+    assert st.learn_template(data, sin_total) is None
+
+
+def test_apply_sin_obligatorio_devuelve_none():
+    sin_numero = {**ABRIL, "spans": [s for s in ABRIL["spans"] if not s[0].startswith("Nº")]}
+    assert st.apply_rules(_learned(), sin_numero) is None
+
+
+def test_huella_ignora_valores():
+    fields = _learned()
+    assert st.fingerprint(MARZO, fields) == st.fingerprint(ABRIL, fields)
+    otro = _layout("00001234", "15/03/2025", "Ferretería Sur SRL", "1.000,00", "210,00", "1.210,00")
+    otro["spans"][0][0] = "Otra Empresa SRL"
+    otro["spans"][8][0] = "Subtotal"
+    assert st.fingerprint(otro, fields)[0] != st.fingerprint(MARZO, fields)[0]
+
+
+def test_round_trip_por_store(data_dir):
+    fields = _learned()
+    cuit = st.layout_cuits(MARZO)[0]
+    assert cuit == "30712345671"
+    fp, tokens = st.fingerprint(MARZO, fields)
+    store.save_template(cuit, fp, tokens, fields)
+
+    tpl = st.match_template(ABRIL, store.find_templates(st.layout_cuits(ABRIL)))
+    assert tpl is not None and tpl["similarity"] == 1.0
+    out = coerce_invoice(st.apply_rules(tpl["fields"], ABRIL))
+    assert out["totales"]["total_comprobante"] == 3025.61
+
+    assert store.find_templates(["20123456786"]) == []
+
+
+def test_plantilla_descartada_tras_fallos(data_dir):
+    fields = _learned()
+    fp, tokens = st.fingerprint(MARZO, fields)
+    store.save_template("30712345671", fp, tokens, fields)
+    for _ in range(st.TEMPLATE_MAX_MISSES - 1):
+        store.template_miss("30712345671", fp, st.TEMPLATE_MAX_MISSES)
+    assert store.find_templates(["30712345671"])
+    store.template_miss("30712345671", fp, st.TEMPLATE_MAX_MISSES)
+    assert store.find_templates(["30712345671"]) == []
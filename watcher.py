@@ -0,0 +1,219 @@
+"""
+Daemon de carpetas vigiladas: los escáneres y las reglas de mail dejan los
+comprobantes en una carpeta por cliente y esto los va encolando solo, sin
+pasar por la página de subida.
+
+    python watcher.py                                   # carpetas de WATCH_DIRS
+    python watcher.py --dir /scans/clienteA=holistor --dir /scans/clienteB=bejerman
+    python watcher.py --concurrency 4                   # 0 = sólo workers externos (worker.py)
+
+Por carpeta hay un lote por mes (store.watch_batch): cada archivo nuevo se
+agrega al lote del mes, se procesa con los workers de siempre y las
+exportaciones del mes se reescriben a medida que avanzan, así a fin de mes
+ya están hechas:
+
+    carpeta/                       lo que dejan el escáner / el mail
+    carpeta/procesados/AAAA-MM/    originales ya encolados
+    carpeta/salida/AAAA-MM/        Holistor.txt, CCabecer.txt, ... del mes
+
+Se recorre cada carpeta con os.scandir (sin dependencias ni inotify). Un
+archivo se toma recién cuando su tamaño y fecha no cambian durante
+WATCH_SETTLE_SECONDS (el escáner o el cliente de mail pueden seguir
+escribiéndolo); los temporales y ocultos se ignoran.
+
+  WATCH_DIRS            "carpeta=sistema;carpeta=sistema"
+  WATCH_POLL_SECONDS    cada cuánto se recorre cada carpeta
+  WATCH_SETTLE_SECONDS  tiempo sin cambios para tomar un archivo
+  WATCH_MAX_QUEUED      archivos de una carpeta en cola a la vez (el resto
+                        espera en disco: una tanda de 2.000 no llena la cola)
+  WATCH_EXPORT_SECONDS  con la cola andando, cada cuánto se reescriben las
+                        exportaciones (al vaciarse la cola se escriben siempre)
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+import store
+from ingest import ingest_uploads
+from worker import WORKER_CONCURRENCY, run_worker
+
+
+WATCH_DIRS = os.getenv("WATCH_DIRS", "")
+WATCH_POLL_SECONDS = float(os.getenv("WATCH_POLL_SECONDS", "2"))
+WATCH_SETTLE_SECONDS = float(os.getenv("WATCH_SETTLE_SECONDS", "5"))
+WATCH_MAX_QUEUED = int(os.getenv("WATCH_MAX_QUEUED", "50"))
+WATCH_EXPORT_SECONDS = float(os.getenv("WATCH_EXPORT_SECONDS", "60"))
+
+PROCESSED_DIR = "procesados"
+OUTPUT_DIR = "salida"
+
+_TEMP_SUFFIXES = (".tmp", ".part", ".partial", ".crdownload", ".download", "~")
+_JUNK_NAMES = ("Thumbs.db", "desktop.ini")
+
+
+def parse_dirs(specs: list) -> list:
+    """["carpeta=sistema", ...] -> estado por carpeta."""
+    folders = []
+    for spec in specs:
+        path, _, sistema = spec.strip().rpartition("=")
+        if not path or not sistema:
+            raise ValueError(f"Carpeta mal indicada (carpeta=sistema): {spec!r}")
+        path = os.path.abspath(path)
+        folders.append({
+            "path": path,
+            "sistema": sistema,
+            "seen": {},
+            # {período: {"batch_id", "exported": tareas terminadas al exportar, "at"}}
+            "batches": {
+                periodo: {"batch_id": batch_id, "exported": -1, "at": 0.0}
+                for periodo, batch_id in sorted(store.watch_batches(path).items())[-2:]
+            },
+        })
+    return folders
+
+
+def _ignored(name: str) -> bool:
+    return name.startswith((".", "~$")) or name.endswith(_TEMP_SUFFIXES) or name in _JUNK_NAMES
+
+
+def scan_ready(folder: dict, now: float) -> list:
+    """Archivos de la carpeta que no cambiaron durante WATCH_SETTLE_SECONDS."""
+    seen = {}
+    ready = []
+    with os.scandir(folder["path"]) as entries:
+        for entry in entries:
+            if _ignored(entry.name) or not entry.is_file():
+                continue
+            st = entry.stat()
+            sig = (st.st_size, st.st_mtime_ns)
+            prev = folder["seen"].get(entry.name)
+            since = prev[1] if prev and prev[0] == sig else now
+            seen[entry.name] = (sig, since)
+            if st.st_size and now - since >= WATCH_SETTLE_SECONDS:
+                ready.append(entry.name)
+    folder["seen"] = seen
+    return sorted(ready)
+
+
+def _free_name(directory: str, name: str) -> str:
+    """Ruta en `directory` que no pise un archivo existente (factura.pdf, factura (2).pdf, ...)."""
+    path = os.path.join(directory, name)
+    stem, ext = os.path.splitext(name)
+    n = 2
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{stem} ({n}){ext}")
+        n += 1
+    return path
+
+
+def _pending(batch_id: str) -> int:
+    progress = store.batch_progress(batch_id)
+    return progress.get("queued", 0) + progress.get("running", 0)
+
+
+def ingest_ready(folder: dict, names: list, periodo: str) -> int:
+    """Encola los archivos listos en el lote del mes y los mueve a procesados/. Devuelve cuántos."""
+    batch_id = store.watch_batch(folder["path"], periodo, folder["sistema"])
+    folder["batches"].setdefault(periodo, {"batch_id": batch_id, "exported": -1, "at": 0.0})
+    names = names[:max(WATCH_MAX_QUEUED - _pending(batch_id), 0)]
+    if not names:
+        return 0
+
+    done_dir = os.path.join(folder["path"], PROCESSED_DIR, periodo)
+    os.makedirs(done_dir, exist_ok=True)
+    seq = store.get_batch(batch_id)["total"]
+    for name in names:
+        src = os.path.join(folder["path"], name)
+        with open(src, "rb") as fh:
+            seq += ingest_uploads(batch_id, [(name, fh)], start_seq=seq)
+        os.replace(src, _free_name(done_dir, name))
+        folder["seen"].pop(name, None)
+    return len(names)
+
+
+def write_exports(folder: dict, periodo: str, batch_id: str):
+    """Reescribe las exportaciones del mes (archivo temporal + rename: nunca quedan a medias)."""
+    from main import EXPORTS, _joined, export_lines
+
+    out_dir = os.path.join(folder["path"], OUTPUT_DIR, periodo)
+    os.makedirs(out_dir, exist_ok=True)
+    for archivo, filename in EXPORTS.get(folder["sistema"], []):
+        path = os.path.join(out_dir, filename)
+        with open(path + ".tmp", "w", encoding="utf-8", newline="") as fh:
+            for chunk in _joined(export_lines(archivo, store.iter_batch_results(batch_id))):
+                fh.write(chunk)
+        os.replace(path + ".tmp", path)
+
+
+def refresh_exports(folder: dict, now: float):
+    """Exporta los lotes de la carpeta que avanzaron (ver WATCH_EXPORT_SECONDS)."""
+    for periodo, b in list(folder["batches"].items()):
+        progress = store.batch_progress(b["batch_id"])
+        finished = progress.get("done", 0) + progress.get("failed", 0)
+        pending = progress.get("queued", 0) + progress.get("running", 0)
+        if finished == b["exported"] or (pending and now - b["at"] < WATCH_EXPORT_SECONDS):
+            continue
+        write_exports(folder, periodo, b["batch_id"])
+        b["exported"], b["at"] = finished, now
+        if not pending and periodo != max(folder["batches"]):
+            del folder["batches"][periodo]  # mes anterior ya cerrado y exportado
+
+
+def cycle(folder: dict, periodo: str, now: float) -> int:
+    """Una pasada por la carpeta: encolar lo listo y actualizar exportaciones."""
+    ready = scan_ready(folder, now)
+    n = ingest_ready(folder, ready, periodo) if ready else 0
+    refresh_exports(folder, now)
+    return n
+
+
+async def watch(folders: list, stop: asyncio.Event):
+    for folder in folders:
+        print(f"Vigilando {folder['path']} ({folder['sistema']})")
+    while not stop.is_set():
+        periodo = datetime.now().strftime("%Y-%m")
+        for folder in folders:
+            try:
+                n = await asyncio.to_thread(cycle, folder, periodo, time.time())
+            except OSError as e:
+                print(f"{folder['path']}: {e}")
+                continue
+            if n:
+                print(f"{folder['path']}: {n} archivo(s) encolado(s)")
+        try:
+            await asyncio.wait_for(stop.wait(), WATCH_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _main(folders: list, concurrency: int):
+    stop = asyncio.Event()
+    jobs = [watch(folders, stop)]
+    if concurrency > 0:
+        jobs.append(run_worker(concurrency, stop))
+    try:
+        await asyncio.gather(*jobs)
+    finally:
+        from main import close_client
+
+        await close_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vigila carpetas y procesa los comprobantes que aparecen")
+    parser.add_argument("--dir", action="append", default=[], help="carpeta=sistema (se puede repetir)")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    args = parser.parse_args()
+
+    specs = args.dir or [s for s in WATCH_DIRS.split(";") if s.strip()]
+    if not specs:
+        parser.error("no hay carpetas: usar --dir carpeta=sistema o WATCH_DIRS")
+    folders = parse_dirs(specs)
+    for folder in folders:
+        os.makedirs(folder["path"], exist_ok=True)
+    try:
+        asyncio.run(_main(folders, args.concurrency))
+    except KeyboardInterrupt:
+        pass
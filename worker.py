@@ -0,0 +1,124 @@
+"""
+Worker de extracción: toma tareas de la cola durable (store.py) y las procesa.
+
+Se corre como proceso aparte, tantos como haga falta (en la misma máquina o
+en otras que compartan FACTURAS_DATA_DIR):
+
+    python worker.py                 # WORKER_CONCURRENCY tareas a la vez
+    python worker.py --concurrency 4
+
+El proceso web también levanta EMBEDDED_WORKERS loops propios (por defecto 1)
+para que una instalación de un solo proceso siga andando; con workers
+externos se pone EMBEDDED_WORKERS=0.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import time
+import traceback
+
+import store
+from lanes import INTERACTIVE, LANE_RESERVED_WORKERS, LANES, current_lane
+
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "0.5"))
+REAP_EVERY_SECONDS = 30.0
+
+
+def _worker_id(n: int) -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{n}"
+
+
+async def _heartbeat(task_ids: list, worker_id: str):
+    """Renueva el lease mientras se trabaja (cada tercio del lease)."""
+    while True:
+        await asyncio.sleep(store.TASK_LEASE_SECONDS / 3)
+        await asyncio.to_thread(store.heartbeat, task_ids, worker_id)
+
+
+async def _claim(worker_id: str, lanes: tuple = LANES) -> list:
+    """Una tarea; si es un ticket chico, se suman otros del mismo lote para empaquetar."""
+    from main import PACK_MAX_BYTES, PACK_MAX_IMAGES
+
+    tasks = await asyncio.to_thread(store.claim_tasks, worker_id, 1, lanes=lanes)
+    if not tasks:
+        return []
+    first = tasks[0]
+    if first["kind"] == "image" and first["size"] <= PACK_MAX_BYTES and PACK_MAX_IMAGES > 1:
+        tasks += await asyncio.to_thread(
+            store.claim_tasks,
+            worker_id,
+            PACK_MAX_IMAGES - 1,
+            "image",
+            first["batch_id"],
+            PACK_MAX_BYTES,
+        )
+    return tasks
+
+
+async def _worker_loop(worker_id: str, stop: asyncio.Event, lanes: tuple = LANES):
+    from main import process_tasks
+
+    last_reap = 0.0
+    while not stop.is_set():
+        tasks = await _claim(worker_id, lanes)
+        if not tasks:
+            if time.time() - last_reap > REAP_EVERY_SECONDS:
+                await asyncio.to_thread(store.reap_abandoned)
+                last_reap = time.time()
+            try:
+                await asyncio.wait_for(stop.wait(), WORKER_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        ids = [t["id"] for t in tasks]
+        hb = asyncio.create_task(_heartbeat(ids, worker_id))
+        token = current_lane.set(tasks[0]["lane"])  # CPU y modelo se reparten por carril
+        try:
+            rows_by_task = await process_tasks(tasks)
+            for task in tasks:
+                await asyncio.to_thread(store.complete_task, task["id"], worker_id, rows_by_task[task["id"]])
+        except Exception as e:
+            traceback.print_exc()
+            for task in tasks:
+                await asyncio.to_thread(store.fail_task, task["id"], worker_id, repr(e))
+        finally:
+            current_lane.reset(token)
+            hb.cancel()
+
+
+async def run_worker(concurrency: int = WORKER_CONCURRENCY, stop: asyncio.Event = None):
+    """
+    Corre `concurrency` loops de worker hasta que se setee `stop`. Los
+    primeros LANE_RESERVED_WORKERS sólo toman tareas interactivas (si queda
+    al menos un loop para el resto).
+    """
+    stop = stop or asyncio.Event()
+    reserved = LANE_RESERVED_WORKERS if concurrency > LANE_RESERVED_WORKERS else 0
+    await asyncio.gather(*(
+        _worker_loop(_worker_id(n), stop, (INTERACTIVE,) if n < reserved else LANES)
+        for n in range(concurrency)
+    ))
+
+
+async def _main(concurrency: int):
+    try:
+        await run_worker(concurrency)
+    finally:
+        # El cliente del modelo (y su pool de conexiones) es uno por proceso
+        from main import close_client
+
+        await close_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker de extracción de comprobantes")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_main(args.concurrency))
+    except KeyboardInterrupt:
+        pass